@@ -11,7 +11,9 @@ import torchaudio
 
 from tortoise.api import MODELS_DIR, TextToSpeech
 from tortoise.utils.audio import get_voices, load_voices, load_audio
-from tortoise.utils.text import split_and_recombine_text
+from tortoise.utils.cache import SynthesisCache, voice_digest
+from tortoise.utils.text import split_and_recombine_text, iter_split_by_token_budget
+from tortoise.utils.tokenizer import VoiceBpeTokenizer
 
 parser = argparse.ArgumentParser(
     description='TorToiSe is a text-to-speech program that is capable of synthesizing speech '
@@ -73,7 +75,15 @@ advanced_group.add_argument(
          '~/.cache/tortoise/.models, so this should only be specified if you have custom checkpoints.')
 advanced_group.add_argument(
     '--text-split', type=str, default=None,
-    help='How big chunks to split the text into, in the format <desired_length>,<max_length>.')
+    help='How big chunks to split the text into, in the format <desired_length>,<max_length>. By default, chunks are '
+         'filled up to the token budget of the autoregressive model.')
+advanced_group.add_argument(
+    '--cache-dir', type=str, default=None,
+    help='Keep rendered clips in this directory and reuse them when the same text is rendered again with the same '
+         'voice, settings and seed (or with no seed given), so that re-reading an edited text only renders what changed.')
+advanced_group.add_argument(
+    '--cache-size', type=int, default=2048,
+    help='Maximum size of the clip cache in MB. The least recently used clips are evicted first.')
 advanced_group.add_argument(
     '--disable-redaction', default=False, action='store_true',
     help='Normally text enclosed in brackets are automatically redacted from the spoken output '
@@ -183,7 +193,9 @@ if args.text_split:
         parser.error(f'--text-split: desired_length ({desired_length}) must be <= max_length ({max_length})')
     texts = split_and_recombine_text(text, desired_length, max_length)
 else:
-    texts = split_and_recombine_text(text)
+    # Pack as much text into each clip as the autoregressive model can take.
+    max_mel_tokens = 500 if args.max_mel_tokens is None else args.max_mel_tokens
+    texts = list(iter_split_by_token_budget(text, VoiceBpeTokenizer(), max_mel_tokens=max_mel_tokens))
 if len(texts) == 0:
     parser.error('no text provided')
 
@@ -220,11 +232,14 @@ tuning_options = [
 for option in tuning_options:
     if getattr(args, option) is not None:
         gen_settings[option] = getattr(args, option)
+cache = SynthesisCache(args.cache_dir, args.cache_size * 1024 ** 2) if args.cache_dir else None
+cache_settings = {k: v for k, v in gen_settings.items() if k not in ('use_deterministic_seed', 'verbose')}
 total_clips = len(texts) * len(selected_voices)
 regenerate_clips = [int(x) for x in args.regenerate.split(',')] if args.regenerate else None
 for voice_idx, voice in enumerate(selected_voices):
     audio_parts = []
     voice_samples, conditioning_latents = load_voices(voice, extra_voice_dirs)
+    voice_id = voice_digest(voice_samples, conditioning_latents)
     for text_idx, text in enumerate(texts):
         clip_name = f'{"-".join(voice)}_{text_idx:02d}'
         if args.output_dir:
@@ -237,8 +252,17 @@ for voice_idx, voice in enumerate(selected_voices):
         if not args.quiet:
             print(f'Rendering {clip_name} ({(voice_idx * len(texts) + text_idx + 1)} of {total_clips})...')
             print('  ' + text)
-        gen = tts.tts_with_preset(
-            text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
+        key = cache.key(tts, text, voice_id, args.seed, **cache_settings) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            if not args.quiet:
+                print('  (cached)')
+            gen = cached['audio']
+        else:
+            gen = tts.tts_with_preset(
+                text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
+            if cache:
+                cache.put(key, gen, seed=seed, text=text)
         gen = gen if args.candidates > 1 else [gen]
         for candidate_idx, audio in enumerate(gen):
             audio = audio.squeeze(0).cpu()
@@ -0,0 +1,83 @@
+import time
+import unittest
+from unittest import mock
+
+import torch
+
+from tortoise.api import TextToSpeech
+from tortoise.utils.cancellation import CancellationToken
+
+
+class StubModule(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+
+
+class StubAutoregressive(StubModule):
+    stop_mel_token = 8193
+
+    def inference_speech(self, conditioning, text_tokens, num_return_sequences=1, max_generate_length=500, **kwargs):
+        codes = torch.randint(0, 8000, (num_return_sequences, 20))
+        codes[:, 15] = self.stop_mel_token
+        return codes
+
+    def forward(self, conditioning, text_tokens, text_lengths, codes, wav_lengths, **kwargs):
+        return torch.zeros(codes.shape[0], codes.shape[1], 1024)
+
+
+class StubCLVP(StubModule):
+    def forward(self, text_tokens, codes, return_loss=False):
+        return torch.rand(codes.shape[0])
+
+
+class StubVocoder(StubModule):
+    def inference(self, mel):
+        return torch.zeros(1, 1, mel.shape[-1] * 256)
+
+
+def stub_tts():
+    tts = object.__new__(TextToSpeech)
+    tts.device = torch.device('cpu')
+    tts.half = False
+    tts.enable_redaction = False
+    tts.autoregressive_batch_size = 2
+    tts.diffusion_step_cost = {}
+    tts.tokenizer = mock.Mock(encode=lambda text: [1] * len(text))
+    tts.autoregressive, tts.clvp, tts.diffusion, tts.vocoder = StubAutoregressive(), StubCLVP(), StubModule(), StubVocoder()
+    tts.cvvp = None
+    return tts
+
+
+class DeadlineTest(unittest.TestCase):
+    def generate(self, k, expire_after_first_candidate):
+        cancel_token = CancellationToken(timeout=3600)
+
+        def diffusion(*args, **kwargs):
+            if expire_after_first_candidate:
+                cancel_token.deadline = time.monotonic() - 1
+            return torch.zeros(1, 100, 40)
+
+        conditioning = (torch.zeros(1, 1024), torch.zeros(1, 2048))
+        with mock.patch('tortoise.api.do_spectrogram_diffusion', diffusion):
+            return stub_tts().tts('Hello there.', conditioning_latents=conditioning, k=k, verbose=False,
+                                  num_autoregressive_samples=4, diffusion_iterations=4, cancel_token=cancel_token)
+
+    def test_candidates_stay_a_list_when_the_deadline_cuts_them(self):
+        result = self.generate(k=2, expire_after_first_candidate=True)
+        self.assertIsInstance(result, list)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].shape, (1, 1, 40 * 256))
+
+    def test_all_candidates_without_a_deadline_problem(self):
+        result = self.generate(k=2, expire_after_first_candidate=False)
+        self.assertIsInstance(result, list)
+        self.assertEqual(len(result), 2)
+
+    def test_single_candidate_is_a_tensor(self):
+        result = self.generate(k=1, expire_after_first_candidate=True)
+        self.assertIsInstance(result, torch.Tensor)
+
+
+if __name__ == '__main__':
+    unittest.main()
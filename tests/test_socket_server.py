@@ -0,0 +1,117 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tortoise'))
+
+from tortoise.socket_server import ModelWorker, TTSServer
+from tortoise.utils import protocol
+
+
+class FloodingWorker(ModelWorker):
+    # Renders far more audio than a client that does not read can take, without loading any model.
+    def __init__(self, jobs, stall_timeout):
+        threading.Thread.__init__(self, daemon=True)
+        self.jobs = jobs
+        self.stall_timeout = stall_timeout
+
+    def render(self, job):
+        for _ in range(200):
+            job.emit('audio', np.zeros(2 ** 18, dtype=np.float32), self.stall_timeout)
+        job.emit('end', None, self.stall_timeout)
+
+
+class FailingWorker(FloodingWorker):
+    # Fails outside render's own error handling, as a failing emit('error', ...) would.
+    def render(self, job):
+        raise RuntimeError('model crashed')
+
+
+class ServerTestCase(unittest.TestCase):
+    # Serves on a random port from a background event loop, with one worker of the given class.
+    worker = FloodingWorker
+
+    def setUp(self):
+        self.server = TTSServer(workers=0)
+        self.server.workers.append(self.worker(self.server.jobs, stall_timeout=1))
+        self.server.workers[0].start()
+        self.loop = asyncio.new_event_loop()
+        listening = threading.Event()
+
+        async def serve():
+            self.listener = await asyncio.start_server(self.server.handle_client, '127.0.0.1', 0)
+            self.port = self.listener.sockets[0].getsockname()[1]
+            listening.set()
+
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(serve(), self.loop)
+        listening.wait(5)
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.listener.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class StalledClientTest(ServerTestCase):
+
+    def test_request_ends_with_an_error_when_the_client_stops_reading(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        sock.sendall(protocol.encode_frame(protocol.HELLO, payload={'formats': ['float32']}))
+        self.assertEqual(protocol.read_frame(sock)[0], protocol.HELLO)
+        sock.sendall(protocol.encode_frame(protocol.REQUEST, 1, payload={'voice': 'random', 'text': 'Hello.'}))
+        time.sleep(3)  # Long past the stall timeout, with the socket buffers full.
+
+        frame_types = []
+        while not frame_types or frame_types[-1] == protocol.AUDIO:
+            frame = protocol.read_frame(sock)
+            self.assertIsNotNone(frame)
+            frame_types.append(frame[0])
+        self.assertEqual(frame_types[-1], protocol.ERROR)
+        self.assertIn(b'stalled', frame[4])
+
+        # The worker moved on: the next request on the same connection is answered too.
+        sock.sendall(protocol.encode_frame(protocol.REQUEST, 2, payload={'voice': 'random', 'text': 'Hello.'}))
+        frame = protocol.read_frame(sock)
+        self.assertEqual(frame[:2], (protocol.AUDIO, 2))
+        sock.close()
+
+    def test_handshake_split_after_one_byte(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        hello = protocol.encode_frame(protocol.HELLO, payload={'formats': ['int16']})
+        sock.sendall(hello[:1])
+        time.sleep(.2)
+        sock.sendall(hello[1:])
+        self.assertEqual(protocol.read_frame(sock)[0], protocol.HELLO)
+        sock.close()
+
+    def test_malformed_legacy_request(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        sock.sendall(b'\xff\xfe no separator')
+        self.assertEqual(protocol.recv_exact(sock, len(b'END_OF_AUDIO')), b'END_OF_AUDIO')
+        sock.close()
+
+
+class FailingWorkerTest(ServerTestCase):
+    worker = FailingWorker
+
+    def test_worker_survives_a_failed_request(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        sock.sendall(protocol.encode_frame(protocol.HELLO, payload={'formats': ['float32']}))
+        protocol.read_frame(sock)
+        for request_id in (1, 2):
+            sock.sendall(protocol.encode_frame(protocol.REQUEST, request_id, payload={'voice': 'random', 'text': 'Hi.'}))
+            frame = protocol.read_frame(sock)
+            self.assertEqual(frame[:2], (protocol.ERROR, request_id))
+            self.assertIn(b'model crashed', frame[4])
+        self.assertTrue(self.server.workers[0].is_alive())
+        sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import os
 import random
-from time import time
+from time import monotonic, time
 
 import torch
 import torch.nn.functional as F
@@ -10,18 +10,24 @@ from tortoise.models.classifier import AudioMiniEncoderWithClassifierHead
 from tortoise.models.diffusion_decoder import DiffusionTts
 from tortoise.models.autoregressive import UnifiedVoice
 from tqdm import tqdm
-from tortoise.models.arch_util import TorchMelSpectrogram
+from tortoise.models.arch_util import get_torch_mel_spectrogram
 from tortoise.models.clvp import CLVP
 from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
-from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, TacotronSTFT
-from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.cancellation import CancellationToken, batch_fits, releases_memory_on_cancel, with_cancellation
+from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, score_conditioning_windows, TacotronSTFT
+from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule, MIN_STEPS_BEFORE_DEADLINE
+from tortoise.utils.metrics import CONDITIONING_SECONDS, instrumented
+from tortoise.utils.progress import ProgressReporter
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
-from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
+from tortoise.utils.wav2vec_alignment import LazyWav2VecAlignment
 from contextlib import contextmanager
 from huggingface_hub import hf_hub_download
 
+# Share of the time left before a deadline that autoregressive sampling may use; CLVP, diffusion and the vocoder get the rest.
+AUTOREGRESSIVE_DEADLINE_SHARE = .6
+
 DEFAULT_MODELS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tortoise', 'models')
 MODELS_DIR = os.environ.get('TORTOISE_MODELS_DIR', DEFAULT_MODELS_DIR)
 MODELS = {
@@ -44,6 +50,9 @@ def get_model_path(model_name, models_dir=MODELS_DIR):
     model_path = hf_hub_download(repo_id="Manmay/tortoise-tts", filename=model_name, cache_dir=models_dir)
     return model_path
 
+# Only this many of the best scoring reference clips are fed to the conditioning encoders.
+MAX_CONDITIONING_CLIPS = 16
+
 
 def pad_or_truncate(t, length):
     """
@@ -74,12 +83,37 @@ def format_conditioning(clip, cond_length=132300, device="cuda" if not torch.bac
     if gap < 0:
         clip = F.pad(clip, pad=(0, abs(gap)))
     elif gap > 0:
-        rand_start = random.randint(0, gap)
-        clip = clip[:, rand_start:rand_start + cond_length]
-    mel_clip = TorchMelSpectrogram()(clip.unsqueeze(0)).squeeze(0)
+        (start,), _ = score_conditioning_windows([clip], cond_length)
+        clip = clip[:, start:start + cond_length]
+    mel_clip = get_torch_mel_spectrogram(clip.device)(clip.unsqueeze(0)).squeeze(0)
     return mel_clip.unsqueeze(0).to(device)
 
 
+def select_conditioning_windows(clips, cond_length=132300, max_clips=None):
+    """
+    Deterministically picks the best cond_length window of every clip, scored by speech energy, SNR and voiced ratio (see
+    score_conditioning_windows). When max_clips is given, only the max_clips best scoring clips are kept, in their
+    original order. Clips shorter than cond_length are returned whole.
+    """
+    starts, scores = score_conditioning_windows(clips, cond_length)
+    keep = range(len(clips))
+    if max_clips is not None and len(clips) > max_clips:
+        keep = sorted(sorted(keep, key=lambda i: scores[i], reverse=True)[:max_clips])
+    return [clips[i][..., starts[i]:starts[i] + cond_length] for i in keep]
+
+
+def format_conditioning_batch(clips, cond_length=132300, device="cuda" if not torch.backends.mps.is_available() else 'mps'):
+    """
+    Batched version of format_conditioning(). Every clip is clipped to its best cond_length window (or padded), then all
+    of them are converted to MEL spectrograms in a single pass.
+    :return: A (1,n,80,s) tensor as expected by UnifiedVoice.get_conditioning(), where n is the number of clips.
+    """
+    if any(clip.shape[-1] > cond_length for clip in clips):
+        clips = select_conditioning_windows(clips, cond_length)
+    windows = torch.stack([pad_or_truncate(clip.reshape(-1), cond_length) for clip in clips], dim=0).unsqueeze(0)
+    return get_torch_mel_spectrogram(windows.device)(windows).to(device)
+
+
 def fix_autoregressive_output(codes, stop_token, complain=True):
     """
     This function performs some padding on coded audio that fixes a mismatch issue between what the diffusion model was
@@ -110,7 +144,8 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     return codes
 
 
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, cancel_token=None,
+                             step_callback=None):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
     """
@@ -122,7 +157,7 @@ def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_la
         noise = torch.randn(output_shape, device=latents.device) * temperature
         mel = diffuser.p_sample_loop(diffusion_model, output_shape, noise=noise,
                                       model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
-                                     progress=verbose)
+                                     progress=verbose, cancel_token=cancel_token, step_callback=step_callback)
         return denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
 
 
@@ -174,7 +209,7 @@ class TextToSpeech:
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, warm_up_aligner=False, aligner_idle_timeout=None):
 
         """
         Constructor
@@ -186,6 +221,10 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param warm_up_aligner: The redaction aligner is only loaded when a text with brackets is first spoken. When true,
+                                it is loaded in a background thread at start-up instead.
+        :param aligner_idle_timeout: Seconds without redactions after which the aligner is unloaded to free memory. It is
+                                     reloaded on demand. None keeps it loaded. While loaded it stays on device.
         """
         self.models_dir = models_dir
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
@@ -198,7 +237,7 @@ class TextToSpeech:
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
         if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
+            self.aligner = LazyWav2VecAlignment(warm_up=warm_up_aligner, idle_timeout=aligner_idle_timeout, device=self.device)
 
         self.tokenizer = VoiceBpeTokenizer(
             vocab_file=tokenizer_vocab_file,
@@ -238,11 +277,22 @@ class TextToSpeech:
         # Random latent generators (RLGs) are loaded lazily.
         self.rlg_auto = None
         self.rlg_diffusion = None
+
+        # Measured seconds per diffusion step and latent frame, by cond_free; used to fit diffusion into a deadline.
+        self.diffusion_step_cost = {}
     @contextmanager
-    def temporary_cuda(self, model):
+    def temporary_cuda(self, model, progress=None):
+        moved = progress and next(model.parameters()).device.type != torch.device(self.device).type
         m = model.to(self.device)
-        yield m
-        m = model.cpu()
+        if moved:
+            progress.transfer(model, self.device)
+        try:
+            yield m
+        finally:
+            # Also when generation was cancelled, so the model does not stay on the GPU.
+            m = model.cpu()
+            if moved:
+                progress.transfer(model, 'cpu')
 
     
     def load_cvvp(self):
@@ -251,22 +301,26 @@ class TextToSpeech:
                          speech_enc_depth=8, speech_mask_percentage=0, latent_multiplier=1).cpu().eval()
         self.cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
 
-    def get_conditioning_latents(self, voice_samples, return_mels=False):
+    @CONDITIONING_SECONDS.time(api='tts')
+    def get_conditioning_latents(self, voice_samples, return_mels=False, max_clips=MAX_CONDITIONING_CLIPS):
         """
         Transforms one or more voice_samples into a tuple (autoregressive_conditioning_latent, diffusion_conditioning_latent).
         These are expressive learned latents that encode aspects of the provided clips like voice, intonation, and acoustic
         properties.
         :param voice_samples: List of 2 or more ~10 second reference clips, which should be torch tensors containing 22.05kHz waveform data.
+        :param max_clips: Maximum number of clips fed to the conditioning encoders. The best scoring clips are used. None
+                          uses every clip.
         """
         with torch.no_grad():
-            voice_samples = [v.to(self.device) for v in voice_samples]
-
-            auto_conds = []
             if not isinstance(voice_samples, list):
                 voice_samples = [voice_samples]
-            for vs in voice_samples:
-                auto_conds.append(format_conditioning(vs, device=self.device))
-            auto_conds = torch.stack(auto_conds, dim=1)
+            voice_samples = [v.to(self.device) for v in voice_samples]
+            # The best window of each clip (and the best clips) are picked deterministically, so the same voice always
+            # produces the same latents.
+            voice_samples = select_conditioning_windows(voice_samples, max_clips=max_clips)
+
+            # All clips are encoded as one batch: (1,n,80,s) mels in, a single conditioning encoder pass out.
+            auto_conds = format_conditioning_batch(voice_samples, device=self.device)
             self.autoregressive = self.autoregressive.to(self.device)
             auto_latent = self.autoregressive.get_conditioning(auto_conds)
             self.autoregressive = self.autoregressive.cpu()
@@ -275,15 +329,15 @@ class TextToSpeech:
                 # Initialize STFT
                 self.stft = TacotronSTFT(1024, 256, 1024, 100, 24000, 0, 12000).to(self.device)
 
-            diffusion_conds = []
-            for sample in voice_samples:
-                # The diffuser operates at a sample rate of 24000 (except for the latent inputs)
-                sample = torchaudio.functional.resample(sample, 22050, 24000)
-                sample = pad_or_truncate(sample, 102400)
-                cond_mel = wav_to_univnet_mel(sample.to(self.device), do_normalization=False,
-                                              device=self.device, stft=self.stft)
-                diffusion_conds.append(cond_mel)
-            diffusion_conds = torch.stack(diffusion_conds, dim=1)
+            # The diffuser operates at a sample rate of 24000 (except for the latent inputs). Only the first 102400
+            # resampled samples are kept, so every clip is cut to just enough 22kHz input (plus headroom for the
+            # resampling filter) to produce them before the whole stack is resampled at once.
+            diffusion_input_length = 102400 * 22050 // 24000 + 1024
+            samples = torch.stack([pad_or_truncate(vs, diffusion_input_length).reshape(-1) for vs in voice_samples], dim=0)
+            samples = torchaudio.functional.resample(samples, 22050, 24000)
+            samples = pad_or_truncate(samples, 102400)
+            diffusion_conds = wav_to_univnet_mel(samples, do_normalization=False, device=self.device, stft=self.stft)
+            diffusion_conds = diffusion_conds.unsqueeze(0)
 
             self.diffusion = self.diffusion.to(self.device)
             diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
@@ -327,8 +381,10 @@ class TextToSpeech:
         settings.update(kwargs) # allow overriding of preset settings with kwargs
         return self.tts(text, **settings)
 
+    @releases_memory_on_cancel
+    @instrumented('tts')
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
-            return_deterministic_state=False,
+            return_deterministic_state=False, cancel_token=None, progress_callback=None,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             # CVVP parameters follow
@@ -375,24 +431,33 @@ class TextToSpeech:
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
         ~~OTHER STUFF~~
+        :param cancel_token: A CancellationToken (tortoise.utils.cancellation) to cancel the generation from another
+                             thread, which raises GenerationCancelled, or to give it a deadline, which lowers the number
+                             of samples, diffusion steps and returned candidates as needed to meet it.
+        :param progress_callback: Called with a dict for every stage start and end, autoregressive batch, CLVP batch,
+                                  diffusion step and model transfer; see tortoise.utils.progress.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
         :return: Generated audio clip(s) as a torch tensor. Shape 1,S if k=1 else, (k,1,S) where S is the sample length.
-                 Sample rate is 24kHz.
+                 Sample rate is 24kHz. With k>1 this is a list, which a deadline can leave shorter than k.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        hf_generate_kwargs = with_cancellation(hf_generate_kwargs, cancel_token)
+        cancel_token = cancel_token or CancellationToken()
+        progress = ProgressReporter(progress_callback)
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
         auto_conds = None
-        if voice_samples is not None:
-            auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
-        elif conditioning_latents is not None:
-            auto_conditioning, diffusion_conditioning = conditioning_latents
-        else:
-            auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
+        with progress.stage('conditioning'):
+            if voice_samples is not None:
+                auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
+            elif conditioning_latents is not None:
+                auto_conditioning, diffusion_conditioning = conditioning_latents
+            else:
+                auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
         auto_conditioning = auto_conditioning.to(self.device)
         diffusion_conditioning = diffusion_conditioning.to(self.device)
 
@@ -403,12 +468,21 @@ class TextToSpeech:
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             stop_mel_token = self.autoregressive.stop_mel_token
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+            # With a deadline, sampling stops once the next batch would take more than AUTOREGRESSIVE_DEADLINE_SHARE of
+            # the time left. Enough samples for k candidates are always taken.
+            autoregressive_deadline = cancel_token.stage_deadline(AUTOREGRESSIVE_DEADLINE_SHARE)
+            min_batches = -(-k // self.autoregressive_batch_size)
+            autoregressive_start = monotonic()
             if verbose:
                 print("Generating autoregressive samples..")
             if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.autoregressive
+                with progress.stage('autoregressive', num_batches), self.temporary_cuda(self.autoregressive, progress
                 ) as autoregressive, torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half):
                     for b in tqdm(range(num_batches), disable=not verbose):
+                        if b >= min_batches and not batch_fits(autoregressive_deadline, autoregressive_start, b):
+                            if verbose:
+                                print(f"Deadline: keeping {b * self.autoregressive_batch_size} autoregressive samples")
+                            break
                         codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
                                                                     do_sample=True,
                                                                     top_p=top_p,
@@ -421,9 +495,14 @@ class TextToSpeech:
                         padding_needed = max_mel_tokens - codes.shape[1]
                         codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
                         samples.append(codes)
+                        progress.step(b + 1, num_batches, tokens=codes.shape[0] * (max_mel_tokens - padding_needed))
             else:
-                with self.temporary_cuda(self.autoregressive) as autoregressive:
+                with progress.stage('autoregressive', num_batches), self.temporary_cuda(self.autoregressive, progress) as autoregressive:
                     for b in tqdm(range(num_batches), disable=not verbose):
+                        if b >= min_batches and not batch_fits(autoregressive_deadline, autoregressive_start, b):
+                            if verbose:
+                                print(f"Deadline: keeping {b * self.autoregressive_batch_size} autoregressive samples")
+                            break
                         codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
                                                                     do_sample=True,
                                                                     top_p=top_p,
@@ -436,11 +515,12 @@ class TextToSpeech:
                         padding_needed = max_mel_tokens - codes.shape[1]
                         codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
                         samples.append(codes)
+                        progress.step(b + 1, num_batches, tokens=codes.shape[0] * (max_mel_tokens - padding_needed))
 
             clip_results = []
             
             if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
+                with progress.stage('clvp', len(samples)), self.temporary_cuda(self.clvp, progress) as clvp, torch.autocast(
                     device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
                 ):
                     if cvvp_amount > 0:
@@ -452,7 +532,8 @@ class TextToSpeech:
                             print("Computing best candidates using CLVP")
                         else:
                             print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
+                    for b, batch in enumerate(tqdm(samples, disable=not verbose)):
+                        cancel_token.check()
                         for i in range(batch.shape[0]):
                             batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
                         if cvvp_amount != 1:
@@ -468,11 +549,12 @@ class TextToSpeech:
                                 clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
                         else:
                             clip_results.append(clvp_out)
+                        progress.step(b + 1, len(samples))
                     clip_results = torch.cat(clip_results, dim=0)
                     samples = torch.cat(samples, dim=0)
                     best_results = samples[torch.topk(clip_results, k=k).indices]
             else:
-                with self.temporary_cuda(self.clvp) as clvp:
+                with progress.stage('clvp', len(samples)), self.temporary_cuda(self.clvp, progress) as clvp:
                     if cvvp_amount > 0:
                         if self.cvvp is None:
                             self.load_cvvp()
@@ -482,7 +564,8 @@ class TextToSpeech:
                             print("Computing best candidates using CLVP")
                         else:
                             print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
+                    for b, batch in enumerate(tqdm(samples, disable=not verbose)):
+                        cancel_token.check()
                         for i in range(batch.shape[0]):
                             batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
                         if cvvp_amount != 1:
@@ -498,6 +581,7 @@ class TextToSpeech:
                                 clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
                         else:
                             clip_results.append(clvp_out)
+                        progress.step(b + 1, len(samples))
                     clip_results = torch.cat(clip_results, dim=0)
                     samples = torch.cat(samples, dim=0)
                     best_results = samples[torch.topk(clip_results, k=k).indices]
@@ -509,8 +593,8 @@ class TextToSpeech:
             # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
             # results, but will increase memory usage.
             if not torch.backends.mps.is_available():
-                with self.temporary_cuda(
-                    self.autoregressive
+                with progress.stage('latents'), self.temporary_cuda(
+                    self.autoregressive, progress
                 ) as autoregressive, torch.autocast(
                     device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
                 ):
@@ -520,8 +604,8 @@ class TextToSpeech:
                                                     return_latent=True, clip_inputs=False)
                     del auto_conditioning
             else:
-                with self.temporary_cuda(
-                    self.autoregressive
+                with progress.stage('latents'), self.temporary_cuda(
+                    self.autoregressive, progress
                 ) as autoregressive:
                     best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
                                                     torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
@@ -529,14 +613,27 @@ class TextToSpeech:
                                                     return_latent=True, clip_inputs=False)
                     del auto_conditioning
 
+            diffusion_steps = self.fit_diffusion_steps(cancel_token, best_latents.shape[0] * best_latents.shape[1],
+                                                       diffusion_iterations, cond_free)
+            if diffusion_steps < diffusion_iterations:
+                if verbose:
+                    print(f"Deadline: {diffusion_steps} diffusion steps instead of {diffusion_iterations}")
+                diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_steps, cond_free=cond_free, cond_free_k=cond_free_k)
+
             if verbose:
                 print("Transforming autoregressive outputs into audio..")
             wav_candidates = []
+            # Diffusion steps are counted over all candidates; the vocoder runs after each candidate's last step.
+            diffusion_total = diffusion_steps * best_results.shape[0]
             if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
-                    self.vocoder
+                with progress.stage('diffusion', diffusion_total), self.temporary_cuda(
+                    self.diffusion, progress
+                ) as diffusion, self.temporary_cuda(
+                    self.vocoder, progress
                 ) as vocoder:
                     for b in range(best_results.shape[0]):
+                        if b > 0 and cancel_token.expired():
+                            break  # Out of time: return the candidates decoded so far.
                         codes = best_results[b].unsqueeze(0)
                         latents = best_latents[b].unsqueeze(0)
 
@@ -550,39 +647,51 @@ class TextToSpeech:
                             if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
                                 latents = latents[:, :k]
                                 break
+                        diffusion_start = monotonic()
                         mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                    verbose=verbose)
+                                                    verbose=verbose, cancel_token=cancel_token,
+                                                    step_callback=lambda step: progress.step(b * diffusion_steps + step, diffusion_total))
+                        self.record_diffusion_speed(cancel_token, diffusion_start, diffusion_steps, latents.shape[1], cond_free)
+                        cancel_token.check()
                         wav = vocoder.inference(mel)
                         wav_candidates.append(wav.cpu())
             else:
                 diffusion, vocoder = self.diffusion, self.vocoder
                 diffusion_conditioning = diffusion_conditioning.cpu()
-                for b in range(best_results.shape[0]):
-                    codes = best_results[b].unsqueeze(0).cpu()
-                    latents = best_latents[b].unsqueeze(0).cpu()
-
-                    # Find the first occurrence of the "calm" token and trim the codes to that.
-                    ctokens = 0
-                    for k in range(codes.shape[-1]):
-                        if codes[0, k] == calm_token:
-                            ctokens += 1
-                        else:
-                            ctokens = 0
-                        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                            latents = latents[:, :k]
-                            break
-                    mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                verbose=verbose)
-                    wav = vocoder.inference(mel)
-                    wav_candidates.append(wav.cpu())
-
-            def potentially_redact(clip, text):
-                if self.enable_redaction:
-                    return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
-                return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
-
-            if len(wav_candidates) > 1:
+                with progress.stage('diffusion', diffusion_total):
+                    for b in range(best_results.shape[0]):
+                        if b > 0 and cancel_token.expired():
+                            break  # Out of time: return the candidates decoded so far.
+                        codes = best_results[b].unsqueeze(0).cpu()
+                        latents = best_latents[b].unsqueeze(0).cpu()
+
+                        # Find the first occurrence of the "calm" token and trim the codes to that.
+                        ctokens = 0
+                        for k in range(codes.shape[-1]):
+                            if codes[0, k] == calm_token:
+                                ctokens += 1
+                            else:
+                                ctokens = 0
+                            if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+                                latents = latents[:, :k]
+                                break
+                        diffusion_start = monotonic()
+                        mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
+                                                    verbose=verbose, cancel_token=cancel_token,
+                                                    step_callback=lambda step: progress.step(b * diffusion_steps + step, diffusion_total))
+                        self.record_diffusion_speed(cancel_token, diffusion_start, diffusion_steps, latents.shape[1], cond_free)
+                        cancel_token.check()
+                        wav = vocoder.inference(mel)
+                        wav_candidates.append(wav.cpu())
+
+            if self.enable_redaction and '[' in text:
+                # All candidates are redacted together, in one forward of the resident aligner.
+                with progress.stage('redaction'):
+                    wav_candidates = self.aligner.redact_batch([c.squeeze(1) for c in wav_candidates], text)
+                wav_candidates = [c.unsqueeze(1) for c in wav_candidates]
+
+            # The shape follows k (best_results has k rows), also when a deadline left fewer candidates decoded.
+            if best_results.shape[0] > 1:
                 res = wav_candidates
             else:
                 res = wav_candidates[0]
@@ -591,6 +700,28 @@ class TextToSpeech:
                 return res, (deterministic_seed, text, voice_samples, conditioning_latents)
             else:
                 return res
+
+    def fit_diffusion_steps(self, cancel_token, frames, diffusion_iterations, cond_free):
+        """
+        Number of diffusion steps for frames latent frames that fits in the time cancel_token has left, judging by the
+        speed measured on earlier runs. diffusion_iterations when there is no deadline or no measurement yet.
+        """
+        remaining = cancel_token.remaining()
+        cost = self.diffusion_step_cost.get(cond_free)
+        if remaining is None or cost is None:
+            return diffusion_iterations
+        return min(diffusion_iterations, max(int(remaining / (cost * frames)), MIN_STEPS_BEFORE_DEADLINE))
+
+    def record_diffusion_speed(self, cancel_token, start, steps, frames, cond_free):
+        # Only runs with a deadline need the measurement; it costs a device synchronization.
+        if cancel_token.deadline is None or cancel_token.expired() or frames == 0:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        cost = (monotonic() - start) / (steps * frames)
+        previous = self.diffusion_step_cost.get(cond_free)
+        self.diffusion_step_cost[cond_free] = cost if previous is None else .7 * previous + .3 * cost
+
     def deterministic_state(self, seed=None):
         """
         Sets the random seeds that tortoise uses to the current time() and returns that seed so results can be
@@ -9,16 +9,19 @@ from tortoise.models.classifier import AudioMiniEncoderWithClassifierHead
 from tortoise.models.diffusion_decoder import DiffusionTts
 from tortoise.models.autoregressive import UnifiedVoice
 from tqdm import tqdm
-from tortoise.models.arch_util import TorchMelSpectrogram
+from tortoise.models.arch_util import get_torch_mel_spectrogram
 from tortoise.models.clvp import CLVP
 from tortoise.models.cvvp import CVVP
 from tortoise.models.hifigan_decoder import HifiganGenerator
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
-from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
+from tortoise.utils.cancellation import GenerationCancelled, release_memory, releases_memory_on_cancel, with_cancellation
+from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, score_conditioning_windows
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.metrics import CONDITIONING_SECONDS, instrumented, instrumented_stream
+from tortoise.utils.progress import ProgressReporter
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
-from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
+from tortoise.utils.wav2vec_alignment import LazyWav2VecAlignment
 from contextlib import contextmanager
 from tortoise.models.stream_generator import init_stream_support
 from huggingface_hub import hf_hub_download
@@ -42,6 +45,9 @@ def get_model_path(model_name, models_dir=MODELS_DIR):
     model_path = hf_hub_download(repo_id="Manmay/tortoise-tts", filename=model_name, cache_dir=models_dir)
     return model_path
 
+# Only this many of the best scoring reference clips are fed to the conditioning encoders.
+MAX_CONDITIONING_CLIPS = 16
+
 
 def pad_or_truncate(t, length):
     """
@@ -72,12 +78,37 @@ def format_conditioning(clip, cond_length=132300, device="cuda" if not torch.bac
     if gap < 0:
         clip = F.pad(clip, pad=(0, abs(gap)))
     elif gap > 0:
-        rand_start = random.randint(0, gap)
-        clip = clip[:, rand_start:rand_start + cond_length]
-    mel_clip = TorchMelSpectrogram()(clip.unsqueeze(0)).squeeze(0)
+        (start,), _ = score_conditioning_windows([clip], cond_length)
+        clip = clip[:, start:start + cond_length]
+    mel_clip = get_torch_mel_spectrogram(clip.device)(clip.unsqueeze(0)).squeeze(0)
     return mel_clip.unsqueeze(0).to(device)
 
 
+def select_conditioning_windows(clips, cond_length=132300, max_clips=None):
+    """
+    Deterministically picks the best cond_length window of every clip, scored by speech energy, SNR and voiced ratio (see
+    score_conditioning_windows). When max_clips is given, only the max_clips best scoring clips are kept, in their
+    original order. Clips shorter than cond_length are returned whole.
+    """
+    starts, scores = score_conditioning_windows(clips, cond_length)
+    keep = range(len(clips))
+    if max_clips is not None and len(clips) > max_clips:
+        keep = sorted(sorted(keep, key=lambda i: scores[i], reverse=True)[:max_clips])
+    return [clips[i][..., starts[i]:starts[i] + cond_length] for i in keep]
+
+
+def format_conditioning_batch(clips, cond_length=132300, device="cuda" if not torch.backends.mps.is_available() else 'mps'):
+    """
+    Batched version of format_conditioning(). Every clip is clipped to its best cond_length window (or padded), then all
+    of them are converted to MEL spectrograms in a single pass.
+    :return: A (1,n,80,s) tensor as expected by UnifiedVoice.get_conditioning(), where n is the number of clips.
+    """
+    if any(clip.shape[-1] > cond_length for clip in clips):
+        clips = select_conditioning_windows(clips, cond_length)
+    windows = torch.stack([pad_or_truncate(clip.reshape(-1), cond_length) for clip in clips], dim=0).unsqueeze(0)
+    return get_torch_mel_spectrogram(windows.device)(windows).to(device)
+
+
 def fix_autoregressive_output(codes, stop_token, complain=True):
     """
     This function performs some padding on coded audio that fixes a mismatch issue between what the diffusion model was
@@ -172,7 +203,7 @@ class TextToSpeech:
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, warm_up_aligner=False, aligner_idle_timeout=None):
 
         """
         Constructor
@@ -184,6 +215,10 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param warm_up_aligner: The redaction aligner is only loaded when a text with brackets is first spoken. When true,
+                                it is loaded in a background thread at start-up instead.
+        :param aligner_idle_timeout: Seconds without redactions after which the aligner is unloaded to free memory. It is
+                                     reloaded on demand. None keeps it loaded. While loaded it stays on device.
         """
         self.models_dir = models_dir
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
@@ -196,7 +231,7 @@ class TextToSpeech:
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
         if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
+            self.aligner = LazyWav2VecAlignment(warm_up=warm_up_aligner, idle_timeout=aligner_idle_timeout, device=self.device)
 
         self.tokenizer = VoiceBpeTokenizer(
             vocab_file=tokenizer_vocab_file,
@@ -222,22 +257,26 @@ class TextToSpeech:
         self.hifi_decoder.load_state_dict(hifi_model, strict=False)
         # Random latent generators (RLGs) are loaded lazily.
         self.rlg_auto = None
-    def get_conditioning_latents(self, voice_samples, return_mels=False):
+    @CONDITIONING_SECONDS.time(api='fast_tts')
+    def get_conditioning_latents(self, voice_samples, return_mels=False, max_clips=MAX_CONDITIONING_CLIPS):
         """
         Transforms one or more voice_samples into a tuple (autoregressive_conditioning_latent, diffusion_conditioning_latent).
         These are expressive learned latents that encode aspects of the provided clips like voice, intonation, and acoustic
         properties.
         :param voice_samples: List of 2 or more ~10 second reference clips, which should be torch tensors containing 22.05kHz waveform data.
+        :param max_clips: Maximum number of clips fed to the conditioning encoders. The best scoring clips are used. None
+                          uses every clip.
         """
         with torch.no_grad():
-            voice_samples = [v.to(self.device) for v in voice_samples]
-
-            auto_conds = []
             if not isinstance(voice_samples, list):
                 voice_samples = [voice_samples]
-            for vs in voice_samples:
-                auto_conds.append(format_conditioning(vs, device=self.device))
-            auto_conds = torch.stack(auto_conds, dim=1)
+            voice_samples = [v.to(self.device) for v in voice_samples]
+            # The best window of each clip (and the best clips) are picked deterministically, so the same voice always
+            # produces the same latents.
+            voice_samples = select_conditioning_windows(voice_samples, max_clips=max_clips)
+
+            # All clips are encoded as one batch: (1,n,80,s) mels in, a single conditioning encoder pass out.
+            auto_conds = format_conditioning_batch(voice_samples, device=self.device)
             auto_latent = self.autoregressive.get_conditioning(auto_conds)
 
         if return_mels:
@@ -303,8 +342,10 @@ class TextToSpeech:
         return wav_chunk, wav_gen_prev, wav_overlap
 
 
+    @instrumented_stream('fast_tts_stream')
     def tts_stream(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
-            return_deterministic_state=False, overlap_wav_len=1024, stream_chunk_size=40,
+            return_deterministic_state=False, overlap_wav_len=1024, stream_chunk_size=40, cancel_token=None,
+            progress_callback=None,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             # CVVP parameters follow
@@ -344,6 +385,11 @@ class TextToSpeech:
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
         ~~OTHER STUFF~~
+        :param cancel_token: A CancellationToken (tortoise.utils.cancellation) to cancel the generation from another
+                             thread; it then raises GenerationCancelled within one token or vocoder call. Deadlines
+                             are not used here, there are no samples or diffusion steps to shed.
+        :param progress_callback: Called with a dict for every stage start and end and every decoded chunk; see
+                                  tortoise.utils.progress.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -351,15 +397,20 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        progress = ProgressReporter(progress_callback)
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
-        if voice_samples is not None:
-            auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
-        else:
-            auto_conditioning  = self.get_random_conditioning_latents()
-        auto_conditioning = auto_conditioning.to(self.device)
+        with progress.stage('conditioning'):
+            if voice_samples is not None:
+                auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+            elif conditioning_latents is not None:
+                # Precomputed voices (<voice>.pth) hold (autoregressive, diffusion) latents; only the first is used here.
+                auto_conditioning = conditioning_latents[0] if isinstance(conditioning_latents, (tuple, list)) else conditioning_latents
+            else:
+                auto_conditioning  = self.get_random_conditioning_latents()
+            auto_conditioning = auto_conditioning.to(self.device)
 
         with torch.no_grad():
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
@@ -384,7 +435,7 @@ class TextToSpeech:
                     repetition_penalty=float(repetition_penalty),
                     output_attentions=False,
                     output_hidden_states=True,
-                    **hf_generate_kwargs,
+                    **with_cancellation(hf_generate_kwargs, cancel_token),
                 )
             all_latents = []
             codes_ = []
@@ -392,28 +443,41 @@ class TextToSpeech:
             wav_overlap = None
             is_end = False
             first_buffer = 60
-            while not is_end:
-                try:
-                    with torch.autocast(
-                        device_type="cuda", dtype=torch.float16, enabled=self.half
-                    ):
-                        codes, latent = next(gpt_generator)
-                        all_latents += [latent]
-                        codes_ += [codes]
-                except StopIteration:
-                    is_end = True
-
-                if is_end or (stream_chunk_size > 0 and len(codes_) >= max(stream_chunk_size, first_buffer)):
-                    first_buffer = 0
-                    gpt_latents = torch.cat(all_latents, dim=0)[None, :]
-                    wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
-                    wav_gen = wav_gen.squeeze()
-                    wav_chunk, wav_gen_prev, wav_overlap = self.handle_chunks(
-                        wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
-                    )
-                    codes_ = []
-                    yield wav_chunk
-    def tts(self, text, voice_samples=None, k=1, verbose=True, use_deterministic_seed=None,
+            try:
+                chunks = 0
+                with progress.stage('stream'):
+                    while not is_end:
+                        try:
+                            with torch.autocast(
+                                device_type="cuda", dtype=torch.float16, enabled=self.half
+                            ):
+                                codes, latent = next(gpt_generator)
+                                all_latents += [latent]
+                                codes_ += [codes]
+                        except StopIteration:
+                            is_end = True
+
+                        if is_end or (stream_chunk_size > 0 and len(codes_) >= max(stream_chunk_size, first_buffer)):
+                            first_buffer = 0
+                            gpt_latents = torch.cat(all_latents, dim=0)[None, :]
+                            if cancel_token is not None:
+                                cancel_token.check()
+                            wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+                            wav_gen = wav_gen.squeeze()
+                            wav_chunk, wav_gen_prev, wav_overlap = self.handle_chunks(
+                                wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
+                            )
+                            chunks += 1
+                            progress.step(chunks, tokens=len(codes_))
+                            codes_ = []
+                            yield wav_chunk
+            except GenerationCancelled:
+                release_memory()
+                raise
+    @releases_memory_on_cancel
+    @instrumented('fast_tts')
+    def tts(self, text, voice_samples=None, k=1, verbose=True, use_deterministic_seed=None, cancel_token=None,
+            progress_callback=None,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, 
             top_p=.8, max_mel_tokens=500,
@@ -452,6 +516,10 @@ class TextToSpeech:
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
         ~~OTHER STUFF~~
+        :param cancel_token: A CancellationToken (tortoise.utils.cancellation) to cancel the generation from another
+                             thread; it then raises GenerationCancelled within one token or vocoder call. Deadlines
+                             are not used here, there are no samples or diffusion steps to shed.
+        :param progress_callback: Called with a dict for every stage start and end; see tortoise.utils.progress.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -459,21 +527,23 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        progress = ProgressReporter(progress_callback)
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
-        if voice_samples is not None:
-            auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
-        else:
-            auto_conditioning  = self.get_random_conditioning_latents()
-        auto_conditioning = auto_conditioning.to(self.device)
+        with progress.stage('conditioning'):
+            if voice_samples is not None:
+                auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+            else:
+                auto_conditioning  = self.get_random_conditioning_latents()
+            auto_conditioning = auto_conditioning.to(self.device)
 
         with torch.no_grad():
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
             if verbose:
                 print("Generating autoregressive samples..")
-            with torch.autocast(
+            with progress.stage('autoregressive'), torch.autocast(
                     device_type="cuda" , dtype=torch.float16, enabled=self.half
                 ):
                 codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
@@ -487,14 +557,18 @@ class TextToSpeech:
                                                             repetition_penalty=float(repetition_penalty),
                                                             output_attentions=False,
                                                             output_hidden_states=True,
-                                                            **hf_generate_kwargs)
+                                                            **with_cancellation(hf_generate_kwargs, cancel_token))
+                progress.step(1, 1, tokens=codes.numel())
                 gpt_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
                                 torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
                                 torch.tensor([codes.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
                                 return_latent=True, clip_inputs=False)
+            if cancel_token is not None:
+                cancel_token.check()
             if verbose:
                 print("generating audio..")
-            wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+            with progress.stage('vocoder'):
+                wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
             return wav_gen
     def deterministic_state(self, seed=None):
         """
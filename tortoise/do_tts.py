@@ -6,6 +6,7 @@ import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
 from utils.audio import load_voices
+from utils.progress import ProgressTracker
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -38,8 +39,11 @@ if __name__ == '__main__':
             voice_sel = [selected_voice]
         voice_samples, conditioning_latents = load_voices(voice_sel)
 
+        progress = ProgressTracker()
         gen, dbg_state = tts.tts_with_preset(args.text, k=args.candidates, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                  preset=args.preset, use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount)
+                                  preset=args.preset, use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount,
+                                  progress_callback=progress)
+        print(f'Timings: {progress.summary()}')
         if isinstance(gen, list):
             for j, g in enumerate(gen):
                 torchaudio.save(os.path.join(args.output_path, f'{selected_voice}_{k}_{j}.wav'), g.squeeze(0).cpu(), 24000)
@@ -1,6 +1,7 @@
 import os
 import functools
 import math
+import threading
 
 import torch
 import torch.nn as nn
@@ -291,6 +292,20 @@ class AudioMiniEncoder(nn.Module):
 
 DEFAULT_MEL_NORM_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/mel_norms.pth')
 
+_mel_norms_cache = {}
+_mel_spectrogram_cache = {}
+_mel_cache_lock = threading.RLock()
+
+
+def load_mel_norms(mel_norm_file=DEFAULT_MEL_NORM_FILE):
+    """
+    Loads the given mel norms file from disk once and returns the same (CPU) tensor on every later call.
+    """
+    with _mel_cache_lock:
+        if mel_norm_file not in _mel_norms_cache:
+            _mel_norms_cache[mel_norm_file] = torch.load(mel_norm_file, map_location='cpu')
+        return _mel_norms_cache[mel_norm_file]
+
 
 class TorchMelSpectrogram(nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024, n_mel_channels=80, mel_fmin=0, mel_fmax=8000,
@@ -311,26 +326,51 @@ class TorchMelSpectrogram(nn.Module):
                                                              norm="slaney")
         self.mel_norm_file = mel_norm_file
         if self.mel_norm_file is not None:
-            self.mel_norms = torch.load(self.mel_norm_file)
+            # Registered as a buffer so that it follows the module across devices instead of being moved every call.
+            self.register_buffer('mel_norms', load_mel_norms(self.mel_norm_file).clone(), persistent=False)
         else:
             self.mel_norms = None
 
     def forward(self, inp):
-        if len(inp.shape) == 3:  # Automatically squeeze out the channels dimension if it is present (assuming mono-audio)
-            inp = inp.squeeze(1)
+        """
+        Accepts (b,s) or (b,1,s) waveforms and returns (b,n_mel_channels,t) MELs. Many clips can be computed at once by
+        passing (b,n,s) waveforms, in which case (b,n,n_mel_channels,t) MELs are returned.
+        """
+        clip_dims = None
+        if len(inp.shape) == 3:
+            if inp.shape[1] == 1:  # Automatically squeeze out the channels dimension if it is present (assuming mono-audio)
+                inp = inp.squeeze(1)
+            else:
+                clip_dims = inp.shape[:2]
+                inp = inp.reshape(-1, inp.shape[-1])
         assert len(inp.shape) == 2
         if torch.backends.mps.is_available():
             inp = inp.to('cpu')
-        self.mel_stft = self.mel_stft.to(inp.device)
+        if self.mel_stft.spectrogram.window.device != inp.device:
+            self.to(inp.device)
         mel = self.mel_stft(inp)
         # Perform dynamic range compression
         mel = torch.log(torch.clamp(mel, min=1e-5))
         if self.mel_norms is not None:
-            self.mel_norms = self.mel_norms.to(mel.device)
             mel = mel / self.mel_norms.unsqueeze(0).unsqueeze(-1)
+        if clip_dims is not None:
+            mel = mel.reshape(*clip_dims, *mel.shape[1:])
         return mel
 
 
+def get_torch_mel_spectrogram(device='cpu', **kwargs):
+    """
+    Returns a TorchMelSpectrogram built with the given kwargs that lives on the given device. Instances are cached per
+    (device, kwargs), so the filterbank and mel norms are only built and loaded once and then stay resident.
+    """
+    device = torch.device('cpu') if torch.backends.mps.is_available() else torch.device(device)
+    key = (str(device), tuple(sorted(kwargs.items())))
+    with _mel_cache_lock:
+        if key not in _mel_spectrogram_cache:
+            _mel_spectrogram_cache[key] = TorchMelSpectrogram(**kwargs).to(device).eval()
+        return _mel_spectrogram_cache[key]
+
+
 class CheckpointedLayer(nn.Module):
     """
     Wraps a module. When forward() is called, passes kwargs that require_grad through torch.checkpoint() and bypasses
@@ -444,10 +444,10 @@ class UnifiedVoice(nn.Module):
     def get_conditioning(self, speech_conditioning_input):
         speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(
             speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
+        # Fold the clip dimension into the batch so every conditioning clip is encoded in a single pass.
+        b, n = speech_conditioning_input.shape[:2]
+        conds = self.conditioning_encoder(speech_conditioning_input.reshape(b * n, *speech_conditioning_input.shape[2:]))
+        conds = conds.reshape(b, n, -1)
         conds = conds.mean(dim=1)
         return conds
 
@@ -222,11 +222,12 @@ class DiffusionTts(nn.Module):
     def get_conditioning(self, conditioning_input):
         speech_conditioning_input = conditioning_input.unsqueeze(1) if len(
             conditioning_input.shape) == 3 else conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.contextual_embedder(speech_conditioning_input[:, j]))
-        conds = torch.cat(conds, dim=-1)
-        conds = conds.mean(dim=-1)
+        # Fold the clip dimension into the batch so every conditioning clip is embedded in a single pass. All clips
+        # share the same length, so averaging over (clip, time) matches concatenating along time and averaging.
+        b, n = speech_conditioning_input.shape[:2]
+        conds = self.contextual_embedder(speech_conditioning_input.reshape(b * n, *speech_conditioning_input.shape[2:]))
+        conds = conds.reshape(b, n, *conds.shape[1:])
+        conds = conds.mean(dim=(1, 3))
         return conds
 
     def timestep_independent(self, aligned_conditioning, conditioning_latent, expected_seq_len, return_code_pred):
@@ -7,7 +7,9 @@ import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
 from utils.audio import load_audio, load_voices
-from utils.text import split_and_recombine_text
+from utils.cache import SynthesisCache, voice_digest
+from utils.progress import ProgressTracker
+from utils.text import iter_split_by_token_budget
 
 
 if __name__ == '__main__':
@@ -27,6 +29,9 @@ if __name__ == '__main__':
     parser.add_argument('--use_deepspeed', type=bool, help='Use deepspeed for speed bump.', default=False)
     parser.add_argument('--kv_cache', type=bool, help='If you disable this please wait for a long a time to get the output', default=True)
     parser.add_argument('--half', type=bool, help="float16(half) precision inference if True it's faster and take less vram and ram", default=True)
+    parser.add_argument('--cache_dir', type=str, help='Where to keep rendered clips so that re-reading a text (even an edited one) only renders the clips that changed. '
+                                                      'Caching is disabled unless this is given. Clips are only reused when --seed is given or was not given for them either.', default=None)
+    parser.add_argument('--cache_size', type=int, help='Maximum size of the clip cache in MB. The least recently used clips are evicted first.', default=2048)
 
 
     args = parser.parse_args()
@@ -49,8 +54,9 @@ if __name__ == '__main__':
               "your intent, please remove all '|' characters from the input.")
         texts = text.split('|')
     else:
-        texts = split_and_recombine_text(text)
+        texts = list(iter_split_by_token_budget(text, tts.tokenizer))
 
+    cache = SynthesisCache(args.cache_dir, args.cache_size * 1024 ** 2) if args.cache_dir else None
     seed = int(time()) if args.seed is None else args.seed
     for selected_voice in selected_voices:
         voice_outpath = os.path.join(outpath, selected_voice)
@@ -62,13 +68,25 @@ if __name__ == '__main__':
             voice_sel = [selected_voice]
 
         voice_samples, conditioning_latents = load_voices(voice_sel)
+        voice = voice_digest(voice_samples, conditioning_latents)
+        progress = ProgressTracker()  # Stage times add up over all of this voice's clips.
         all_parts = []
         for j, text in enumerate(texts):
             if regenerate is not None and j not in regenerate:
                 all_parts.append(load_audio(os.path.join(voice_outpath, f'{j}.wav'), 24000))
                 continue
-            gen = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                      preset=args.preset, k=args.candidates, use_deterministic_seed=seed)
+            key = cache.key(tts, text, voice, args.seed, preset=args.preset, k=args.candidates, half=args.half,
+                            kv_cache=args.kv_cache, use_deepspeed=args.use_deepspeed) if cache else None
+            cached = cache.get(key) if cache else None
+            if cached is not None:
+                print(f'Reusing cached clip {j}')
+                gen = cached['audio']
+            else:
+                gen = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
+                                          preset=args.preset, k=args.candidates, use_deterministic_seed=seed,
+                                          progress_callback=progress)
+                if cache:
+                    cache.put(key, gen, seed=seed, text=text)
             if args.candidates == 1:
                 audio_ = gen.squeeze(0).cpu()
                 torchaudio.save(os.path.join(voice_outpath, f'{j}.wav'), audio_, 24000)
@@ -79,6 +97,8 @@ if __name__ == '__main__':
                     torchaudio.save(os.path.join(candidate_dir, f'{k}.wav'), g.squeeze(0).cpu(), 24000)
                 audio_ = gen[0].squeeze(0).cpu()
             all_parts.append(audio_)
+        if progress.stages:
+            print(f'Timings for {selected_voice}: {progress.summary()}')
 
         if args.candidates == 1:
             full_audio = torch.cat(all_parts, dim=-1)
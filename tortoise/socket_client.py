@@ -1,47 +1,38 @@
-import socket
 import sounddevice as sd
 import numpy as np
 
-def play_audio_stream(client_socket):
-    buffer = b''
-    stream = sd.OutputStream(samplerate=24000, channels=1, dtype='float32')
+from tortoise.utils.protocol import TTSClient
+
+
+def play_audio_stream(client, request_id):
+    stream = sd.OutputStream(samplerate=client.sample_rate, channels=1, dtype='float32')
     stream.start()
 
     try:
-        while True:
-            chunk = client_socket.recv(1024)
-            if b"END_OF_AUDIO" in chunk:
-                buffer += chunk.replace(b"END_OF_AUDIO", b"")
-                if buffer:
-                    audio_array = np.frombuffer(buffer, dtype=np.float32)
-                    stream.write(audio_array)
-                break
-
-            buffer += chunk
-            while len(buffer) >= 4096:
-                audio_chunk = buffer[:4096]
-                audio_array = np.frombuffer(audio_chunk, dtype=np.float32)
-                stream.write(audio_array)
-                buffer = buffer[4096:]
+        for audio_array in client.stream(request_id):
+            stream.write(np.ascontiguousarray(audio_array))
 
     finally:
         stream.stop()
         stream.close()
 
-def send_text_to_server(character_name, text, server_ip='localhost', server_port=5000):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((server_ip, server_port))
-
-    try:
-        data = f"{character_name}|{text}"
-        client_socket.sendall(data.encode('utf-8'))
+def send_text_to_server(character_name, text, server_ip='localhost', server_port=5000, formats=('int16', 'float32')):
+    with TTSClient(server_ip, server_port, formats=formats) as client:
+        request_id = client.submit(character_name, text)
 
-        play_audio_stream(client_socket)
+        play_audio_stream(client, request_id)
 
         print("Audio playback finished.")
 
-    finally:
-        client_socket.close()
+
+def send_texts_to_server(character_name, texts, server_ip='localhost', server_port=5000, formats=('int16', 'float32')):
+    # All texts are requested up front so the server never idles between them; they are played back in order.
+    with TTSClient(server_ip, server_port, formats=formats) as client:
+        request_ids = [client.submit(character_name, text) for text in texts]
+        for request_id in request_ids:
+            play_audio_stream(client, request_id)
+
+        print("Audio playback finished.")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,27 @@
-import spacy
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import queue
 import threading
-import socket
+import time
+import torch
 from tortoise.api_fast import TextToSpeech
+from tortoise.utils import protocol
+from tortoise.utils.encoding import make_encoder
+from tortoise.utils.metrics import (SERVER_CONNECTIONS, SERVER_QUEUE_DEPTH, SERVER_QUEUE_SECONDS, SERVER_REQUESTS,
+                                    serve_metrics_http)
+from tortoise.utils.cancellation import CancellationToken, GenerationCancelled
+from tortoise.utils.progress import ProgressTracker
+from tortoise.utils.cache import PhraseCache, SynthesisCache, stream_audio_chunks, voice_digest
+from tortoise.utils.text import split_and_recombine_text, iter_split_by_token_budget
+from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from utils.audio import load_voices
 
-tts = TextToSpeech()
-nlp = spacy.load("en_core_web_sm")
+SEGMENTERS = ('budget', 'rules', 'sentencizer', 'spacy')
 
 
-def generate_audio_stream(text, tts, voice_samples):
+def generate_audio_stream(text, tts, voice_samples, cancel_token=None, progress_callback=None):
     print(f"Generating audio stream...: {text}")
     voice_samples, conditioning_latents = load_voices([voice_samples])
     stream = tts.tts_stream(
@@ -16,25 +29,26 @@ def generate_audio_stream(text, tts, voice_samples):
         voice_samples=voice_samples,
         conditioning_latents=conditioning_latents,
         verbose=True,
-        stream_chunk_size=40  # Adjust chunk size as needed
+        stream_chunk_size=40,  # Adjust chunk size as needed
+        cancel_token=cancel_token,
+        progress_callback=progress_callback
     )
     for audio_chunk in stream:
         yield audio_chunk
 
 
-def split_text(text, max_length=200):
-    doc = nlp(text)
+def pack_sentences(sentences, max_length=200):
     chunks = []
     chunk = []
     length = 0
 
-    for sent in doc.sents:
-        sent_length = len(sent.text)
-        if length + sent_length > max_length:
+    for sent in sentences:
+        sent_length = len(sent)
+        if chunk and length + sent_length > max_length:
             chunks.append(' '.join(chunk))
             chunk = []
             length = 0
-        chunk.append(sent.text)
+        chunk.append(sent)
         length += sent_length + 1
 
     if chunk:
@@ -43,41 +57,380 @@ def split_text(text, max_length=200):
     return chunks
 
 
-def handle_client(client_socket, tts):
-    try:
+def make_segmenter(name='budget', max_length=200, tokenizer=None):
+    """
+    Returns a function splitting an incoming message into the chunks that are spoken one after the other.
+    budget: sentences packed up to the token budget of the autoregressive model (see iter_split_by_token_budget).
+    rules: split_and_recombine_text() with chunks of about max_length characters.
+    sentencizer: spaCy's rule-based sentencizer alone, sentences packed into max_length characters.
+    spacy: the full en_core_web_sm pipeline (tagger, parser, NER), sentences packed into max_length characters. Slow
+           to load and to run; only useful to compare against.
+    """
+    if name == 'budget':
+        tokenizer = VoiceBpeTokenizer() if tokenizer is None else tokenizer
+        return lambda text: list(iter_split_by_token_budget(text, tokenizer))
+    if name == 'rules':
+        return lambda text: split_and_recombine_text(text, desired_length=max_length, max_length=max_length * 3 // 2)
+    if name in ('sentencizer', 'spacy'):
+        import spacy
+        if name == 'sentencizer':
+            nlp = spacy.blank('en')
+            nlp.add_pipe('sentencizer')
+        else:
+            nlp = spacy.load('en_core_web_sm')
+        return lambda text: pack_sentences([sent.text for sent in nlp(text).sents], max_length)
+    raise ValueError(f'Unknown segmenter {name}, expected one of {", ".join(SEGMENTERS)}')
+
+
+def synthesize_chunks(text, character_name, tts, split_text, phrase_cache=None, cancel_token=None, progress_callback=None):
+    """
+    Speaks text with the given voice, yielding 1D float audio chunks as they are produced.
+    """
+    text_chunks = split_text(text)
+    print(text_chunks)
+    voice = voice_digest(*load_voices([character_name])) if phrase_cache is not None else None
+    for chunk in text_chunks:
+        # Repeated phrases are streamed straight from the cache without touching the models.
+        key = phrase_cache.key(tts, chunk, voice, stream_chunk_size=40) if phrase_cache is not None else None
+        cached = phrase_cache.get(key) if key is not None else None
+        if cached is not None:
+            audio_stream = stream_audio_chunks(cached)
+        else:
+            audio_stream = generate_audio_stream(chunk, tts, character_name, cancel_token, progress_callback)
+
+        rendered = []
+        for audio_chunk in audio_stream:
+            audio_chunk = audio_chunk.detach().cpu().reshape(-1)
+            yield audio_chunk
+            if cached is None and key is not None:
+                rendered.append(audio_chunk)
+        if rendered:
+            phrase_cache.put(key, torch.cat(rendered))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class SynthesisJob:
+    """
+    One request waiting for, or being rendered by, a model worker. The worker hands chunks over through a small
+    bounded queue owned by the event loop: when the client reads slower than the model speaks, the worker blocks on it
+    instead of piling audio up in memory. Cancelling cancel_token (the client went away) stops the model within one
+    step.
+    """
+    def __init__(self, loop, voice, text, max_buffered_chunks=16):
+        self.loop = loop
+        self.voice = voice
+        self.text = text
+        self.chunks = asyncio.Queue(maxsize=max_buffered_chunks)
+        self.cancel_token = CancellationToken()
+        self.progress = ProgressTracker()
+        self.submitted = time.monotonic()
+        self.first_chunk = None
+
+    def emit(self, kind, value, stall_timeout=30):
+        # Called from a worker thread.
+        future = asyncio.run_coroutine_threadsafe(self.chunks.put((kind, value)), self.loop)
+        waited = 0
+        while True:
+            try:
+                return future.result(timeout=.5)
+            except concurrent.futures.TimeoutError:
+                waited += .5
+                if self.cancel_token.cancelled or waited >= stall_timeout:
+                    future.cancel()
+                    self.cancel_token.cancel()
+                    raise JobCancelled('cancelled' if waited < stall_timeout else
+                                       f'stalled: the client did not read any audio for {stall_timeout}s')
+
+    def abort(self, reason):
+        """
+        Ends the job with an error, dropping the chunks the client has not read yet, so whoever waits on chunks always
+        gets a last item. Called from a worker thread; never blocks.
+        """
+        def finish():
+            while not self.chunks.empty():
+                self.chunks.get_nowait()
+            self.chunks.put_nowait(('error', reason))
+        try:
+            self.loop.call_soon_threadsafe(finish)
+        except RuntimeError:
+            pass  # The event loop is gone, and with it everyone who could wait.
+
+
+class ModelWorker(threading.Thread):
+    """
+    Owns one TextToSpeech instance and renders the queued jobs one at a time, so no two requests ever share a model
+    (the autoregressive model keeps per-request state such as store_mel_emb()).
+    """
+    def __init__(self, jobs, segmenter='budget', phrase_cache=None, stall_timeout=30):
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.phrase_cache = phrase_cache
+        self.stall_timeout = stall_timeout
+        self.tts = TextToSpeech()
+        self.split_text = make_segmenter(segmenter, tokenizer=self.tts.tokenizer)
+
+    def run(self):
         while True:
-            data = client_socket.recv(1024).decode('utf-8')
-            if not data:
-                break
-            character_name, text = data.split('|', 1)
-            text_chunks = split_text(text, max_length=200)
-            print(text_chunks)
-            for chunk in text_chunks:
-                audio_stream = generate_audio_stream(chunk, tts, character_name)
+            job = self.jobs.get()
+            try:
+                self.render(job)
+            except (JobCancelled, GenerationCancelled) as e:
+                print(f"Request abandoned: {e or 'cancelled'}")
+                job.abort(str(e) or 'cancelled')
+            except Exception as e:
+                # Anything else would end this thread and leave the queue without a consumer.
+                print(f"Request failed: {e}")
+                job.abort(str(e) or type(e).__name__)
+            finally:
+                self.jobs.task_done()
+
+    def render(self, job):
+        job.cancel_token.check()
+        SERVER_QUEUE_SECONDS.observe(time.monotonic() - job.submitted, server='socket')
+        try:
+            for audio_chunk in synthesize_chunks(job.text, job.voice, self.tts, self.split_text, self.phrase_cache,
+                                                 job.cancel_token, job.progress):
+                job.cancel_token.check()  # Phrases served from the cache never reach the model's checks.
+                if job.first_chunk is None:
+                    job.first_chunk = time.monotonic()
+                job.emit('audio', audio_chunk, self.stall_timeout)
+        except (JobCancelled, GenerationCancelled):
+            raise
+        except Exception as e:
+            print(f"Request failed: {e}")
+            job.emit('error', str(e), self.stall_timeout)
+            return
+        if job.first_chunk is not None:
+            print(f"Request done: first audio after {job.first_chunk - job.submitted:.2f}s; {job.progress.summary()}")
+        job.emit('end', None, self.stall_timeout)
+
+
+class TTSServer:
+    """
+    asyncio front end: connections are cheap and only ever wait on the network, while synthesis runs on a fixed pool
+    of model workers fed from a bounded queue. A request arriving while max_queue jobs are already waiting is rejected
+    with a "busy" ERROR frame instead of growing the backlog, and each connection has at most max_inflight requests
+    queued or rendering; further pipelined frames stay unread in the socket until one of them finishes.
+    """
+    def __init__(self, workers=1, max_queue=16, max_inflight=4, segmenter='budget', phrase_cache=None, stall_timeout=30):
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.max_inflight = max_inflight
+        self.formats = protocol.supported_formats()
+        self.workers = [ModelWorker(self.jobs, segmenter, phrase_cache, stall_timeout) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        SERVER_QUEUE_DEPTH.set_function(self.jobs.qsize, server='socket')
+
+    def submit(self, voice, text):
+        """
+        Queues a job, or returns None when the queue is full.
+        """
+        job = SynthesisJob(asyncio.get_running_loop(), voice, text)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            SERVER_REQUESTS.inc(server='socket', outcome='busy')
+            return None
+        SERVER_REQUESTS.inc(server='socket', outcome='accepted')
+        return job
+
+    async def serve(self, host='0.0.0.0', port=5000, metrics_port=None):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"Server listening on port {port} with {len(self.workers)} model worker(s)")
+        if metrics_port:
+            # Plain HTTP for Prometheus, on the same event loop.
+            await asyncio.start_server(serve_metrics_http, host, metrics_port)
+            print(f"Metrics at http://{host}:{metrics_port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        print(f"Accepted connection from {writer.get_extra_info('peername')}")
+        SERVER_CONNECTIONS.inc(server='socket')
+        try:
+            head = await reader.readexactly(len(protocol.MAGIC))
+            if head == protocol.MAGIC:
+                await self.handle_framed_client(reader, writer, head)
+            else:
+                await self.handle_legacy_client(reader, writer, head)
+        except asyncio.IncompleteReadError:
+            pass  # Closed before sending anything we could answer.
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Connection error: {e}")
+        finally:
+            writer.close()
+            SERVER_CONNECTIONS.dec(server='socket')
+            print("Client disconnected.")
+
+    async def handle_legacy_client(self, reader, writer, head):
+        # "voice|text" in a single message, raw float32 out, then END_OF_AUDIO. Kept for clients predating the framed
+        # protocol.
+        data = head + await reader.read(1024 - len(head))
+        while data:
+            try:
+                character_name, text = data.decode('utf-8').split('|', 1)
+            except ValueError:  # Also UnicodeDecodeError
+                print(f"Rejected a malformed legacy request: {data[:40]!r}")
+                SERVER_REQUESTS.inc(server='socket', outcome='invalid')
+                job = None
+            else:
+                job = self.submit(character_name, text)
+                if job is None:
+                    print("Rejected a legacy request: server busy.")
+            if job is not None:
+                try:
+                    while True:
+                        kind, value = await job.chunks.get()
+                        if kind != 'audio':
+                            break
+                        writer.write(value.numpy().astype('float32').tobytes())
+                        await writer.drain()
+                finally:
+                    job.cancel_token.cancel()
+            writer.write(b"END_OF_AUDIO")
+            await writer.drain()
+            data = await reader.read(1024)
 
-                for audio_chunk in audio_stream:
-                    audio_data = audio_chunk.cpu().numpy().flatten()
-                    client_socket.sendall(audio_data.tobytes())
+    async def handle_framed_client(self, reader, writer, head):
+        # See tortoise/utils/protocol.py. Every request gets its own task, so pipelined requests run on as many
+        # workers as are free and their frames interleave on the connection.
+        connection_format = protocol.FORMAT_FLOAT32
+        inflight = asyncio.Semaphore(self.max_inflight)
+        tasks = set()
+        try:
+            frame = await protocol.read_frame_async(reader, head)
+            while frame is not None:
+                frame_type, request_id, _, _, payload = frame
+                if frame_type == protocol.HELLO:
+                    connection_format = protocol.negotiate_format(json.loads(payload).get('formats'), self.formats)
+                    writer.write(protocol.encode_frame(protocol.HELLO, payload={
+                        'format': protocol.FORMAT_NAMES[connection_format],
+                        'sample_rate': protocol.SAMPLE_RATE,
+                        'formats': list(self.formats),
+                    }))
+                    await writer.drain()
+                elif frame_type == protocol.REQUEST:
+                    await inflight.acquire()
+                    task = asyncio.create_task(self.answer_request(writer, request_id, payload, connection_format))
+                    tasks.add(task)
+                    task.add_done_callback(lambda t: (tasks.discard(t), inflight.release()))
+                else:
+                    writer.write(protocol.encode_frame(protocol.ERROR, request_id, payload={
+                        'error': f'Unexpected frame type {frame_type}'}))
+                    await writer.drain()
+                frame = await protocol.read_frame_async(reader)
+            # The client is done sending; let it receive what it asked for.
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            client_socket.sendall(b"END_OF_AUDIO")
+    async def answer_request(self, writer, request_id, payload, fmt):
+        sequence = samples = 0
+        job = None
+        try:
+            try:
+                request = json.loads(payload)
+                if request.get('format') is not None:
+                    if request['format'] not in self.formats:
+                        raise ValueError(f"Unsupported format {request['format']}")
+                    fmt = self.formats[request['format']]
+                encoder = make_encoder(protocol.FORMAT_NAMES[fmt], protocol.SAMPLE_RATE)
+                job = self.submit(request['voice'], request['text'])
+                if job is None:
+                    raise ValueError('busy: too many requests are waiting, try again later')
+            except (ValueError, KeyError) as e:
+                if job is None and not str(e).startswith('busy'):
+                    SERVER_REQUESTS.inc(server='socket', outcome='invalid')
+                writer.write(protocol.encode_frame(protocol.ERROR, request_id, payload={'error': str(e)}))
+                await writer.drain()
+                return
+            while True:
+                kind, value = await job.chunks.get()
+                if kind == 'audio':
+                    data = encoder.encode(value)
+                    samples += value.shape[-1]
+                elif kind == 'end':
+                    data = encoder.finish()
+                else:
+                    data = b''
+                if data:  # Compressed formats may hold samples back until they fill a packet.
+                    writer.write(protocol.encode_frame(protocol.AUDIO, request_id, sequence, fmt, data))
+                    sequence += 1
+                if kind == 'end':
+                    writer.write(protocol.encode_frame(protocol.END, request_id, sequence,
+                                                       payload={'chunks': sequence, 'samples': samples}))
+                elif kind == 'error':
+                    writer.write(protocol.encode_frame(protocol.ERROR, request_id, sequence, payload={'error': value}))
+                await writer.drain()
+                if kind != 'audio':
+                    return
+        except OSError as e:
+            print(f"Request {request_id} dropped: {e}")
+        finally:
+            if job is not None:
+                job.cancel_token.cancel()
 
-    finally:
-        client_socket.close()
-        print("Client disconnected.")
 
+def start_server(host='0.0.0.0', port=5000, segmenter='budget', phrase_cache=None, workers=1, max_queue=16,
+                 max_inflight=4, metrics_port=None):
+    server = TTSServer(workers, max_queue, max_inflight, segmenter, phrase_cache)
+    asyncio.run(server.serve(host, port, metrics_port))
 
-def start_server():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('0.0.0.0', 5000))
-    server.listen(5)
-    print("Server listening on port 5000")
 
-    while True:
-        client_socket, addr = server.accept()
-        print(f"Accepted connection from {addr}")
-        client_handler = threading.Thread(target=handle_client, args=(client_socket, tts))
-        client_handler.start()
+def benchmark_segmenters(messages, names=SEGMENTERS, repeats=5):
+    """
+    Prints how long each segmenter takes to load and to split one message.
+    """
+    for name in names:
+        start = time.perf_counter()
+        try:
+            split_text = make_segmenter(name)
+        except Exception as e:
+            print(f'{name:>12}: unavailable ({e})')
+            continue
+        startup = time.perf_counter() - start
+        split_text(messages[0])  # Warm up lazily initialized state.
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for message in messages:
+                split_text(message)
+        latency = (time.perf_counter() - start) / (repeats * len(messages))
+        print(f'{name:>12}: startup {startup * 1000:8.1f}ms, {latency * 1000:7.2f}ms per message')
 
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, help='Address to listen on.', default='0.0.0.0')
+    parser.add_argument('--port', type=int, help='Port to listen on.', default=5000)
+    parser.add_argument('--segmenter', type=str, choices=SEGMENTERS, default='budget',
+                        help='How incoming text is split into the chunks that are spoken one after the other.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of model workers. Each one loads its own copy of the models and renders one request at a time.')
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help='Requests allowed to wait for a free worker; beyond that, new requests are rejected as busy.')
+    parser.add_argument('--max-inflight', type=int, default=4,
+                        help='Requests one connection may have queued or rendering at the same time.')
+    parser.add_argument('--phrase-cache', type=int, default=0, metavar='MB',
+                        help='Keep up to this many MB of rendered phrases in memory and stream repeats from there. 0 disables it.')
+    parser.add_argument('--phrase-cache-dir', type=str, default=None,
+                        help='Also keep every cached phrase on disk here, so the cache survives restarts.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics over HTTP on this port (GET /metrics).')
+    parser.add_argument('--benchmark-segmenters', type=str, default=None, metavar='TEXTFILE',
+                        help='Instead of serving, time every segmenter on the paragraphs of TEXTFILE.')
+    args = parser.parse_args()
+    if args.benchmark_segmenters:
+        with open(args.benchmark_segmenters, 'r', encoding='utf-8') as f:
+            paragraphs = [p.strip() for p in f.read().split('\n\n') if p.strip()]
+        benchmark_segmenters(paragraphs)
+    else:
+        phrase_cache = None
+        if args.phrase_cache > 0:
+            disk_cache = SynthesisCache(args.phrase_cache_dir) if args.phrase_cache_dir else None
+            phrase_cache = PhraseCache(args.phrase_cache * 1024 ** 2, disk_cache=disk_cache)
+        start_server(args.host, args.port, args.segmenter, phrase_cache, args.workers, args.max_queue, args.max_inflight,
+                     args.metrics_port)
@@ -7,7 +7,7 @@ import torchaudio
 
 from api_fast import TextToSpeech, MODELS_DIR
 from utils.audio import load_audio, load_voices
-from utils.text import split_and_recombine_text
+from utils.text import iter_split_by_token_budget
 import sounddevice as sd
 import queue
 import threading
@@ -56,7 +56,10 @@ if __name__ == '__main__':
               "your intent, please remove all '|' characters from the input.")
         texts = text.split('|')
     else:
-        texts = split_and_recombine_text(text)
+        # Chunks are split lazily so the first one is spoken as soon as it is found. Several voices walk them repeatedly.
+        texts = iter_split_by_token_budget(text, tts.tokenizer)
+        if len(selected_voices) > 1:
+            texts = list(texts)
     audio_queue = queue.Queue()
     playback_thread = threading.Thread(target=play_audio, args=(audio_queue,))
     playback_thread.start()
@@ -1,8 +1,11 @@
 import os
+import shutil
+import subprocess
 from glob import glob
 
 import librosa
 import torch
+import torch.nn.functional as F
 import torchaudio
 import numpy as np
 from scipy.io.wavfile import read
@@ -56,6 +59,158 @@ def load_audio(audiopath, sampling_rate):
     return audio.unsqueeze(0)
 
 
+def stream_audio(audiopath, sampling_rate, block_seconds=10):
+    """
+    Decodes audiopath to mono float32 audio at sampling_rate and yields it in blocks of block_seconds, so long files are
+    never held in memory at once. ffmpeg is used when it is on the PATH (it is required for formats like WebM), streaming
+    raw samples from its stdout. Otherwise the file is loaded with torchaudio and sliced into blocks.
+    Closing the generator early stops the decoder.
+    """
+    block_len = int(block_seconds * sampling_rate)
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        if audiopath.lower().endswith('.webm'):
+            raise RuntimeError("FFmpeg is required to decode WebM audio. Please install FFmpeg and add it to PATH.")
+        audio, lsr = torchaudio.load(audiopath)
+        audio = audio.mean(dim=0)
+        if lsr != sampling_rate:
+            audio = torchaudio.functional.resample(audio, lsr, sampling_rate)
+        for start in range(0, audio.shape[-1], block_len):
+            yield audio[start:start + block_len]
+        return
+
+    proc = subprocess.Popen([ffmpeg, '-nostdin', '-loglevel', 'error', '-i', audiopath,
+                             '-f', 'f32le', '-ac', '1', '-ar', str(sampling_rate), '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(block_len * 4)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % 4]
+            yield torch.from_numpy(np.frombuffer(data, dtype=np.float32).copy())
+        if proc.wait() != 0:
+            raise RuntimeError(f"FFmpeg failed to decode {audiopath}: {proc.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def trim_silence(audio, sampling_rate, threshold_db=-40, floor_db=-60, frame_ms=20, keep_ms=200, reference=None):
+    """
+    Energy based voice activity detection. Drops every frame whose RMS is more than threshold_db below reference (the
+    peak amplitude of audio by default) or below floor_db full scale. Frames within keep_ms of a voiced frame are kept
+    so that word onsets and tails survive.
+    :param audio: 1D waveform tensor.
+    :return: 1D waveform tensor containing only the voiced portions of audio.
+    """
+    frame_len = int(sampling_rate * frame_ms / 1000)
+    n_frames = audio.shape[-1] // frame_len
+    if n_frames == 0:
+        return audio
+    reference = audio.abs().max() if reference is None else reference
+    frames = audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms_db = 20 * torch.log10(frames.pow(2).mean(dim=-1).sqrt().clamp(min=1e-10))
+    ref_db = 20 * torch.log10(torch.as_tensor(reference, dtype=rms_db.dtype).clamp(min=1e-10))
+    voiced = (rms_db > ref_db + threshold_db) & (rms_db > floor_db)
+
+    keep = max(int(keep_ms / frame_ms), 0)
+    voiced = F.max_pool1d(voiced.float()[None, None], kernel_size=2 * keep + 1, stride=1, padding=keep)[0, 0] > 0
+    trimmed = frames[voiced].reshape(-1)
+    if voiced[-1]:
+        trimmed = torch.cat([trimmed, audio[n_frames * frame_len:]])
+    return trimmed
+
+
+def iter_voice_segments(audiopath, sampling_rate=22050, segment_seconds=10, min_segment_seconds=1, trim=True):
+    """
+    Streams audiopath through decoding, silence trimming, segmentation and normalization, yielding (1,S) clips of
+    segment_seconds (the last one may be shorter, but never shorter than min_segment_seconds). Each clip has its DC offset
+    removed and is peak normalized to [-1,1], which is what the conditioning encoders expect.
+    """
+    segment_len = int(segment_seconds * sampling_rate)
+    min_segment_len = int(min_segment_seconds * sampling_rate)
+    pending = []
+    pending_len = 0
+    peak = 0.
+
+    def finish(segment):
+        segment = segment - segment.mean()
+        max_val = segment.abs().max()
+        if max_val <= 0 or not torch.isfinite(segment).all():
+            return None
+        return (segment / max_val).unsqueeze(0)
+
+    for block in stream_audio(audiopath, sampling_rate, block_seconds=segment_seconds):
+        if trim:
+            # Silence is judged against the loudest sample seen so far, so quiet stretches are not kept just because
+            # a whole block happens to be quiet.
+            peak = max(peak, block.abs().max().item() if block.numel() > 0 else 0.)
+            block = trim_silence(block, sampling_rate, reference=peak)
+        if block.numel() == 0:
+            continue
+        pending.append(block)
+        pending_len += block.shape[-1]
+        while pending_len >= segment_len:
+            buffered = torch.cat(pending)
+            segment = finish(buffered[:segment_len])
+            pending = [buffered[segment_len:]]
+            pending_len = pending[0].shape[-1]
+            if segment is not None:
+                yield segment
+
+    if pending_len >= min_segment_len:
+        segment = finish(torch.cat(pending))
+        if segment is not None:
+            yield segment
+
+
+def score_conditioning_windows(clips, window_length, frame_length=1024, floor_db=-50, snr_margin_db=10):
+    """
+    Scores every window_length window (on a frame_length grid) of every clip in one batched pass and picks the best window
+    of each clip. Frames count as voiced when they are snr_margin_db above their clip's noise floor (its 10th percentile
+    frame energy) and above floor_db full scale. A window scores its voiced ratio times the mean SNR of its voiced frames
+    (SNR capped at 60dB and scaled to [0,1]), so silent, clipped-short and noisy windows all lose to clean speech.
+    Windows never run past the end of a clip unless the clip is shorter than a window.
+    :param clips: list of 1D or (1,S) waveform tensors, all on the same device.
+    :return: (starts, scores): the start sample and score (in [0,1]) of the best window of each clip.
+    """
+    clips = [c.reshape(-1) for c in clips]
+    device = clips[0].device
+    lengths = torch.tensor([c.shape[-1] for c in clips], device=device)
+    n_frames = (lengths + frame_length - 1) // frame_length
+    max_frames = int(n_frames.max().item())
+    padded = torch.zeros(len(clips), max_frames * frame_length, device=device)
+    for i, c in enumerate(clips):
+        padded[i, :c.shape[-1]] = c
+
+    energy_db = 10 * torch.log10(padded.reshape(len(clips), max_frames, frame_length).pow(2).mean(dim=-1).clamp(min=1e-10))
+    valid = torch.arange(max_frames, device=device)[None] < n_frames[:, None]
+    noise_floor = torch.nanquantile(energy_db.masked_fill(~valid, float('nan')), .1, dim=1, keepdim=True)
+    voiced = valid & (energy_db > noise_floor + snr_margin_db) & (energy_db > floor_db)
+    snr = ((energy_db - noise_floor).clamp(0, 60) / 60) * voiced
+
+    window_frames = max(1, window_length // frame_length)
+
+    def window_sums(x):
+        # Sliding sums over window_frames frames, computed from cumulative sums.
+        sums = F.pad(x.cumsum(dim=1), (1, 0))
+        if max_frames < window_frames:
+            return sums[:, -1:]
+        return sums[:, window_frames:] - sums[:, :-window_frames]
+
+    voiced_frames = window_sums(voiced.float())
+    scores = (voiced_frames / window_frames) * (window_sums(snr) / voiced_frames.clamp(min=1))
+    last_start = (n_frames - window_frames).clamp(min=0)
+    scores = scores.masked_fill(torch.arange(scores.shape[1], device=device)[None] > last_start[:, None], -1)
+    best_scores, best_starts = scores.max(dim=1)
+    starts = torch.minimum(best_starts * frame_length, (lengths - window_length).clamp(min=0))
+    return starts.tolist(), best_scores.tolist()
+
+
 TACOTRON_MEL_MAX = 2.3143386840820312
 TACOTRON_MEL_MIN = -11.512925148010254
 
@@ -157,11 +312,11 @@ def load_voices(voices, extra_voice_dirs=[]):
 class TacotronSTFT(torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
                  n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
-                 mel_fmax=8000.0):
+                 mel_fmax=8000.0, stft_backend='fft'):
         super(TacotronSTFT, self).__init__()
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
-        self.stft_fn = STFT(filter_length, hop_length, win_length)
+        self.stft_fn = STFT(filter_length, hop_length, win_length, backend=stft_backend)
         from librosa.filters import mel as librosa_mel_fn
         mel_basis = librosa_mel_fn(
             sr=sampling_rate, n_fft=filter_length, n_mels=n_mel_channels, fmin=mel_fmin, fmax=mel_fmax)
@@ -190,7 +345,7 @@ class TacotronSTFT(torch.nn.Module):
         assert(torch.max(y.data) <= 10)
         y = torch.clip(y, min=-1, max=1)
 
-        magnitudes, phases = self.stft_fn.transform(y)
+        magnitudes, _ = self.stft_fn.transform(y, return_phase=False)
         magnitudes = magnitudes.data
         mel_output = torch.matmul(self.mel_basis, magnitudes)
         mel_output = self.spectral_normalize(mel_output)
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+
+from tortoise.utils.metrics import CACHE_LOOKUPS
+
+
+def tensor_digest(tensors):
+    """
+    Hashes a tensor, or a (nested) list or tuple of tensors, by value. Returns None when there is nothing to hash.
+    """
+    if tensors is None:
+        return None
+    if isinstance(tensors, torch.Tensor):
+        tensors = [tensors]
+    digest = hashlib.sha256()
+    for t in tensors:
+        if isinstance(t, (list, tuple)):
+            digest.update((tensor_digest(t) or '').encode())
+            continue
+        t = t.detach().float().cpu().contiguous()
+        digest.update(str(tuple(t.shape)).encode())
+        digest.update(t.numpy().tobytes())
+    return digest.hexdigest()
+
+
+def voice_digest(voice_samples, conditioning_latents):
+    """
+    Identifies a voice by what TextToSpeech.tts() conditions on: the reference clips, or the conditioning latents when
+    there are no clips. Pass exactly what is passed to the engine. Returns None for the random voice, which cannot be
+    cached.
+    """
+    if voice_samples is not None:
+        return 'samples:' + tensor_digest(voice_samples)
+    if conditioning_latents is not None:
+        return 'latents:' + tensor_digest(conditioning_latents)
+    return None
+
+
+_checkpoint_fingerprints = {}
+
+
+def checkpoint_fingerprint(models_dir):
+    """
+    Cheap checksum of the model checkpoints under models_dir, from their names, sizes and modification times. Hashing
+    the weights themselves would take seconds; any re-download or replacement changes these too.
+    """
+    models_dir = os.path.realpath(models_dir)
+    if models_dir not in _checkpoint_fingerprints:
+        digest = hashlib.sha256()
+        for root, _, files in sorted(os.walk(models_dir)):
+            for name in sorted(files):
+                if name.endswith(('.pth', '.ptt', '.bin', '.safetensors')):
+                    stat = os.stat(os.path.join(root, name))
+                    digest.update(f'{os.path.relpath(os.path.join(root, name), models_dir)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        _checkpoint_fingerprints[models_dir] = digest.hexdigest()
+    return _checkpoint_fingerprints[models_dir]
+
+
+def synthesis_key(tts, text, voice, seed=None, **settings):
+    """
+    Key identifying a rendered clip.
+    :param tts: The TextToSpeech instance that renders the clip. Its text normalization, implementation and models are
+                part of the key.
+    :param voice: voice_digest() of the voice samples and conditioning latents.
+    :param seed: The seed requested by the user. None means any seed is acceptable.
+    :param settings: Every other generation setting that changes the output (preset, k, sampling parameters...).
+    :return: The key, or None when the clip cannot be cached.
+    """
+    if voice is None:
+        return None
+    description = json.dumps({
+        'text': tts.tokenizer.preprocess_text(text),
+        'voice': voice,
+        'seed': seed,
+        'settings': settings,
+        'implementation': type(tts).__module__,
+        'models': checkpoint_fingerprint(tts.models_dir),
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class SynthesisCache:
+    """
+    Persistent cache of synthesized clips, stored as one torch file per entry under cache_dir. Entries are keyed by the
+    normalized text, the voice, the generation settings, the seed and the model checkpoints, so a clip is only reused
+    when regenerating it would be pointless. Once the cache grows past max_bytes, the least recently used entries are
+    evicted.
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._sizes = {}
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pth'):
+                self._sizes[name[:-4]] = os.path.getsize(os.path.join(cache_dir, name))
+
+    def key(self, tts, text, voice, seed=None, **settings):
+        return synthesis_key(tts, text, voice, seed, **settings)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pth')
+
+    def get(self, key):
+        """
+        Returns the entry stored under key (a dict holding at least 'audio'), or None.
+        """
+        if key is None:
+            return None
+        entry = self._load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        CACHE_LOOKUPS.inc(cache='synthesis', result='miss' if entry is None else 'hit')
+        return entry
+
+    def _load(self, key):
+        # get() without counting the lookup, for PhraseCache, which counts its own.
+        path = self._path(key)
+        try:
+            entry = torch.load(path, map_location='cpu')
+            os.utime(path)  # Marks the entry as recently used.
+        except Exception:  # Missing, or left corrupt by an interrupted run.
+            return None
+        return entry
+
+    def put(self, key, audio, **extra):
+        """
+        Stores audio (a tensor or a list of candidate tensors) and any extra tensors or values under key.
+        """
+        if key is None:
+            return
+        entry = dict(extra, audio=[a.detach().cpu() for a in audio] if isinstance(audio, (list, tuple)) else audio.detach().cpu())
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            torch.save(entry, tmp_path)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._sizes[key] = os.path.getsize(self._path(key))
+            self._evict()
+
+    def _evict(self):
+        # Must be called with the lock held.
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        entries = []
+        for key in self._sizes:
+            try:
+                entries.append((os.path.getmtime(self._path(key)), key))
+            except FileNotFoundError:
+                entries.append((0, key))
+        for _, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+class PhraseCache:
+    """
+    In-memory LRU cache of complete responses, meant for short phrases that are requested over and over (greetings,
+    IVR prompts, game barks). Entries that do not fit in memory any more can fall back to an on-disk SynthesisCache.
+    Keys come from synthesis_key(). hits and misses count lookups; disk_hits counts the hits served from disk.
+    """
+    def __init__(self, max_bytes=256 * 1024 ** 2, disk_cache=None, max_text_length=200):
+        """
+        :param disk_cache: Optional SynthesisCache holding every entry, consulted on memory misses.
+        :param max_text_length: Longer texts are not worth caching and are never stored.
+        """
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self.max_text_length = max_text_length
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, tts, text, voice, seed=None, **settings):
+        if len(text) > self.max_text_length:
+            return None
+        return synthesis_key(tts, text, voice, seed, **settings)
+
+    def get(self, key):
+        """
+        Returns the audio stored under key, or None.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache='phrase', result='hit')
+                return audio
+        entry = self.disk_cache._load(key) if self.disk_cache is not None else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache='phrase', result='miss')
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            CACHE_LOOKUPS.inc(cache='phrase', result='hit')
+        self._remember(key, entry['audio'])
+        return entry['audio']
+
+    def put(self, key, audio):
+        if key is None:
+            return
+        audio = [a.detach().cpu() for a in audio] if isinstance(audio, (list, tuple)) else audio.detach().cpu()
+        self._remember(key, audio)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, audio)
+
+    def _remember(self, key, audio):
+        size = self._size_of(audio)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._size_of(self._entries.pop(key))
+            self._entries[key] = audio
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size_of(evicted)
+
+    @staticmethod
+    def _size_of(audio):
+        return sum(a.numel() * a.element_size() for a in (audio if isinstance(audio, list) else [audio]))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+def stream_audio_chunks(audio, chunk_size=24000 // 4):
+    """
+    Yields a cached (1,S) or (S,) clip in chunks of chunk_size samples, the way tts_stream() yields fresh audio.
+    """
+    audio = audio.reshape(-1)
+    for start in range(0, audio.shape[-1], chunk_size):
+        yield audio[start:start + chunk_size]
@@ -0,0 +1,111 @@
+import functools
+import gc
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    Stops a generation from another thread, or bounds how long it may take. Pass it as cancel_token to
+    TextToSpeech.tts(), tts_with_preset() or tts_stream().
+
+    cancel() makes the generation raise GenerationCancelled within one step: one autoregressive token, one CLVP batch,
+    one diffusion step or one vocoder call. The models are moved off the GPU and its cache is emptied before the
+    exception reaches the caller.
+
+    With a deadline, tts() trades quality for time instead of overrunning: it takes fewer autoregressive samples, fewer
+    diffusion steps and decodes fewer candidates, and a diffusion run that is still out of time returns its current
+    estimate of the spectrogram.
+    """
+    def __init__(self, timeout=None, deadline=None):
+        """
+        :param timeout: Seconds from now the generation may take.
+        :param deadline: Absolute deadline as a time.monotonic() value, instead of timeout.
+        """
+        self._cancelled = threading.Event()
+        self.deadline = time.monotonic() + timeout if timeout is not None else deadline
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise GenerationCancelled()
+
+    def remaining(self):
+        """
+        Seconds left before the deadline (negative once it passed), or None without a deadline.
+        """
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def stage_deadline(self, share):
+        """
+        Deadline for a stage that may use share of the time that is left, or None without a deadline.
+        """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + max(self.remaining(), 0) * share
+
+
+def batch_fits(deadline, started, batches_done):
+    """
+    Whether one more batch, taking as long as the batches since started did on average, would end before deadline.
+    """
+    if deadline is None or batches_done == 0:
+        return True
+    now = time.monotonic()
+    return now + (now - started) / batches_done <= deadline
+
+
+class _CancellationCriteria(StoppingCriteria):
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.token.check()
+        return False
+
+
+def with_cancellation(hf_generate_kwargs, token):
+    """
+    Returns generate() kwargs that make the autoregressive model check token after every generated token.
+    """
+    if token is None:
+        return hf_generate_kwargs
+    criteria = StoppingCriteriaList(hf_generate_kwargs.get('stopping_criteria') or [])
+    criteria.append(_CancellationCriteria(token))
+    return dict(hf_generate_kwargs, stopping_criteria=criteria)
+
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def releases_memory_on_cancel(fn):
+    """
+    Decorator emptying the CUDA cache when fn was cancelled.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except GenerationCancelled:
+            release_memory()
+            raise
+    return wrapper
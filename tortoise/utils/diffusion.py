@@ -15,6 +15,9 @@ import torch
 import torch as th
 from tqdm import tqdm
 
+# A deadline never cuts p_sample_loop() short before this many steps; earlier x_0 predictions are mostly noise.
+MIN_STEPS_BEFORE_DEADLINE = 10
+
 
 def normal_kl(mean1, logvar1, mean2, logvar2):
     """
@@ -541,6 +544,8 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        cancel_token=None,
+        step_callback=None,
     ):
         """
         Generate samples from the model.
@@ -559,10 +564,16 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param cancel_token: if not None, a CancellationToken checked before
+            every step. Once its deadline passed (and at least
+            MIN_STEPS_BEFORE_DEADLINE steps ran), the current prediction of
+            x_0 is returned instead of finishing the remaining steps.
+        :param step_callback: if not None, called with the number of steps
+            done after every step.
         :return: a non-differentiable batch of samples.
         """
         final = None
-        for sample in self.p_sample_loop_progressive(
+        for step, sample in enumerate(self.p_sample_loop_progressive(
             model,
             shape,
             noise=noise,
@@ -572,8 +583,13 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             progress=progress,
-        ):
+            cancel_token=cancel_token,
+        )):
             final = sample
+            if step_callback is not None:
+                step_callback(step + 1)
+            if cancel_token is not None and step + 1 >= MIN_STEPS_BEFORE_DEADLINE and cancel_token.expired():
+                return final["pred_xstart"]
         return final["sample"]
 
     def p_sample_loop_progressive(
@@ -587,6 +603,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        cancel_token=None,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -606,6 +623,8 @@ class GaussianDiffusion:
         indices = list(range(self.num_timesteps))[::-1]
 
         for i in tqdm(indices, disable=not progress):
+            if cancel_token is not None:
+                cancel_token.check()
             t = th.tensor([i] * shape[0], device=device)
             with th.no_grad():
                 out = self.p_sample(
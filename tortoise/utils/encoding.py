@@ -0,0 +1,215 @@
+"""
+Incremental audio encoders for streaming generated speech to remote clients.
+
+Every encoder turns a sequence of float chunks in [-1, 1] into the bytes of one continuous stream: encode() returns the
+bytes that are ready after each chunk (possibly none), finish() whatever is left once the last chunk was given.
+Approximate bandwidth of one 24 kHz mono stream:
+
+    float32   96 KB/s   raw little-endian float samples
+    int16     48 KB/s   raw little-endian 16 bit PCM
+    mulaw     24 KB/s   raw 8 bit G.711 mu-law
+    wav       48 KB/s   16 bit PCM with a RIFF header, playable anywhere
+    opus     ~4 KB/s    Ogg Opus, needs PyAV (pip install av)
+"""
+import importlib.util
+import struct
+
+import numpy as np
+
+SAMPLE_RATE = 24000
+
+_MULAW_BIAS = 0x84
+_MULAW_CLIP = 32635
+
+
+def mulaw_encode(samples):
+    """
+    G.711 mu-law encoding of float samples in [-1, 1] to uint8.
+    """
+    pcm = (np.clip(np.asarray(samples, dtype=np.float32), -1, 1) * 32767).astype(np.int32)
+    sign = np.where(pcm < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(pcm), _MULAW_CLIP) + _MULAW_BIAS
+    exponent = np.clip(np.frexp(magnitude)[1] - 8, 0, 7)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+
+def mulaw_decode(encoded):
+    """
+    Inverse of mulaw_encode(), returning float32 samples in [-1, 1].
+    """
+    encoded = ~np.asarray(encoded, dtype=np.int32) & 0xFF
+    exponent = (encoded >> 4) & 0x07
+    magnitude = (((encoded & 0x0F) << 3) + _MULAW_BIAS << exponent) - _MULAW_BIAS
+    return (np.where(encoded & 0x80, -magnitude, magnitude) / 32767).astype(np.float32)
+
+
+def _to_numpy(samples):
+    if hasattr(samples, 'detach'):
+        samples = samples.detach().cpu().numpy()
+    return np.asarray(samples, dtype=np.float32).reshape(-1)
+
+
+class AudioEncoder:
+    name = None
+    mime_type = 'application/octet-stream'
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    def encode(self, samples):
+        raise NotImplementedError
+
+    def finish(self):
+        return b''
+
+
+class PCMEncoder(AudioEncoder):
+    """
+    Headerless samples; every chunk is encoded on its own.
+    """
+    def __init__(self, sample_format='int16', sample_rate=SAMPLE_RATE):
+        super().__init__(sample_rate)
+        if sample_format not in ('float32', 'int16', 'mulaw'):
+            raise ValueError(f'Unsupported sample format {sample_format}')
+        self.name = sample_format
+        self.mime_type = {'float32': 'audio/x-raw-float32', 'int16': 'audio/L16', 'mulaw': 'audio/basic'}[sample_format]
+
+    def encode(self, samples):
+        samples = _to_numpy(samples)
+        if self.name == 'float32':
+            return samples.astype('<f4').tobytes()
+        if self.name == 'int16':
+            return (np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes()
+        return mulaw_encode(samples).tobytes()
+
+
+class WavEncoder(AudioEncoder):
+    """
+    16 bit PCM or mu-law in a WAV file. When num_samples is not known up front the header claims the largest possible
+    size, which players treat as "until the end of the stream".
+    """
+    name = 'wav'
+    mime_type = 'audio/wav'
+
+    def __init__(self, sample_format='int16', sample_rate=SAMPLE_RATE, num_samples=None):
+        super().__init__(sample_rate)
+        if sample_format not in ('int16', 'mulaw'):
+            raise ValueError('WAV output is int16 or mulaw')
+        self.sample_format = sample_format
+        self.num_samples = num_samples
+        self._pcm = PCMEncoder(sample_format, sample_rate)
+        self._header_sent = False
+
+    def _header(self):
+        width, tag = (2, 1) if self.sample_format == 'int16' else (1, 7)
+        data_size = 0xFFFFFFFF - 36 if self.num_samples is None else self.num_samples * width
+        return (b'RIFF' + struct.pack('<I', data_size + 36) + b'WAVE' +
+                b'fmt ' + struct.pack('<IHHIIHH', 16, tag, 1, self.sample_rate, self.sample_rate * width, width, width * 8) +
+                b'data' + struct.pack('<I', data_size))
+
+    def encode(self, samples):
+        data = self._pcm.encode(samples)
+        if not self._header_sent:
+            self._header_sent = True
+            return self._header() + data
+        return data
+
+    def finish(self):
+        if not self._header_sent:
+            self._header_sent = True
+            return self._header()
+        return b''
+
+
+class OggOpusEncoder(AudioEncoder):
+    """
+    Opus in an Ogg container, through PyAV. Ogg pages are flushed at least every page_duration seconds, so the stream
+    can be played while it is being generated.
+    """
+    name = 'opus'
+    mime_type = 'audio/ogg; codecs=opus'
+
+    def __init__(self, sample_rate=SAMPLE_RATE, bitrate=32000, page_duration=.1):
+        super().__init__(sample_rate)
+        try:
+            import av
+        except ImportError as e:
+            raise ImportError('Opus output needs PyAV: pip install av') from e
+        self._av = av
+        self._sink = _ByteSink()
+        self._container = av.open(self._sink, mode='w', format='ogg',
+                                  options={'page_duration': str(int(page_duration * 1e6))})
+        self._stream = self._container.add_stream('libopus', rate=sample_rate)
+        self._stream.bit_rate = bitrate
+        self._stream.layout = 'mono'
+        self._pts = 0
+
+    def encode(self, samples):
+        samples = _to_numpy(samples).reshape(1, -1)
+        frame = self._av.AudioFrame.from_ndarray(samples, format='flt', layout='mono')
+        frame.sample_rate = self.sample_rate
+        frame.pts = self._pts
+        self._pts += samples.shape[1]
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
+        return self._sink.take()
+
+    def finish(self):
+        for packet in self._stream.encode(None):
+            self._container.mux(packet)
+        self._container.close()
+        return self._sink.take()
+
+
+class _ByteSink:
+    # Write-only file object collecting what the muxer produced since the last take().
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+ENCODINGS = ('float32', 'int16', 'mulaw', 'wav', 'opus')
+
+
+def available_encodings():
+    """
+    The encodings that can be produced here; opus is only listed when PyAV is installed.
+    """
+    have_av = importlib.util.find_spec('av') is not None
+    return tuple(name for name in ENCODINGS if name != 'opus' or have_av)
+
+
+def make_encoder(name, sample_rate=SAMPLE_RATE, **kwargs):
+    if name in ('float32', 'int16', 'mulaw'):
+        return PCMEncoder(name, sample_rate)
+    if name == 'wav':
+        return WavEncoder(sample_rate=sample_rate, **kwargs)
+    if name == 'opus':
+        return OggOpusEncoder(sample_rate, **kwargs)
+    raise ValueError(f'Unknown encoding {name}, expected one of {", ".join(ENCODINGS)}')
+
+
+def encode_chunks(chunks, encoder):
+    """
+    Encodes an iterable of audio chunks (e.g. from tts_stream()) with encoder as it is consumed, yielding non-empty
+    byte strings.
+    """
+    for chunk in chunks:
+        data = encoder.encode(chunk)
+        if data:
+            yield data
+    data = encoder.finish()
+    if data:
+        yield data
@@ -0,0 +1,356 @@
+"""
+Process-wide metrics in the Prometheus text format.
+
+TextToSpeech.tts() and tts_stream() (both engines), conditioning latent computation and the synthesis caches record
+into REGISTRY by themselves; the web UI serves it on /metrics and the socket server on an optional HTTP port
+(--metrics-port). The metrics are plain counters, gauges and histograms guarded by one lock each, so recording costs
+a dict lookup and an addition.
+"""
+import functools
+import math
+import threading
+import time
+
+import torch
+
+DEFAULT_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 25, 60, 120, 300, 600)
+RATIO_BUCKETS = (.05, .1, .25, .5, .75, 1, 1.5, 2, 5, 10, 25)
+RATE_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """
+        Reports function() whenever the metrics are collected, instead of a stored value. function returning None
+        leaves the sample out.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def _samples(self):
+        with self._lock:
+            samples = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            samples[key] = function()
+        return [(self.name, key, value) for key, value in samples.items() if value is not None]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """
+        Decorator recording how long every call of the decorated function takes.
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.monotonic()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.monotonic() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', key + (('le', _format_value(float(bound))),), cumulative))
+            samples.append((f'{self.name}_sum', key, total))
+            samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric {name} is already registered differently')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+GENERATIONS = REGISTRY.counter('tortoise_generations_total', 'Finished generations by outcome (ok, cancelled, error).',
+                               ('api', 'outcome'))
+GENERATION_SECONDS = REGISTRY.histogram('tortoise_generation_seconds', 'Wall time of successful generations.', ('api',))
+FIRST_CHUNK_SECONDS = REGISTRY.histogram('tortoise_time_to_first_chunk_seconds',
+                                         'Time from the start of a streamed generation to its first audio chunk.',
+                                         ('api',))
+REAL_TIME_FACTOR = REGISTRY.histogram('tortoise_real_time_factor',
+                                      'Generation time divided by the duration of the audio produced.', ('api',),
+                                      buckets=RATIO_BUCKETS)
+STAGE_SECONDS = REGISTRY.histogram('tortoise_stage_seconds', 'Wall time of each generation stage.', ('api', 'stage'))
+STAGE_PEAK_MEMORY = REGISTRY.gauge('tortoise_stage_peak_memory_bytes',
+                                   'Peak CUDA memory allocated during the last run of each stage.', ('api', 'stage'))
+AUTOREGRESSIVE_TOKENS = REGISTRY.counter('tortoise_autoregressive_tokens_total',
+                                         'Speech tokens produced by the autoregressive model.', ('api',))
+TOKENS_PER_SECOND = REGISTRY.histogram('tortoise_autoregressive_tokens_per_second',
+                                       'Autoregressive speech tokens per second, per generation.', ('api',),
+                                       buckets=RATE_BUCKETS)
+DIFFUSION_STEPS_PER_SECOND = REGISTRY.histogram('tortoise_diffusion_steps_per_second',
+                                                'Diffusion steps per second, per generation.', ('api',),
+                                                buckets=RATE_BUCKETS)
+TRANSFER_BYTES = REGISTRY.counter('tortoise_model_transfer_bytes_total', 'Model weights moved between devices.',
+                                  ('model', 'device'))
+CONDITIONING_SECONDS = REGISTRY.histogram('tortoise_conditioning_latents_seconds',
+                                          'Time to compute the conditioning latents of a voice.', ('api',))
+CACHE_LOOKUPS = REGISTRY.counter('tortoise_cache_lookups_total', 'Synthesis cache lookups by result (hit, miss).',
+                                 ('cache', 'result'))
+
+SERVER_REQUESTS = REGISTRY.counter('tortoise_server_requests_total',
+                                   'Requests received by a server, by outcome (accepted, busy, invalid).',
+                                   ('server', 'outcome'))
+SERVER_QUEUE_DEPTH = REGISTRY.gauge('tortoise_server_queue_depth', 'Requests waiting for a model worker.', ('server',))
+SERVER_QUEUE_SECONDS = REGISTRY.histogram('tortoise_server_queue_seconds',
+                                          'Time requests waited for a model worker.', ('server',))
+SERVER_CONNECTIONS = REGISTRY.gauge('tortoise_server_connections', 'Open client connections.', ('server',))
+
+CUDA_MEMORY = REGISTRY.gauge('tortoise_cuda_memory_bytes',
+                             'CUDA memory held by tensors (allocated) and by the caching allocator (reserved).',
+                             ('kind',))
+CUDA_MEMORY.set_function(lambda: torch.cuda.memory_allocated() if torch.cuda.is_available() else None, kind='allocated')
+CUDA_MEMORY.set_function(lambda: torch.cuda.memory_reserved() if torch.cuda.is_available() else None, kind='reserved')
+
+
+class GenerationMetrics:
+    """
+    progress_callback recording the stage events of one generation into REGISTRY, passing every event on to callback.
+    """
+    def __init__(self, api, callback=None):
+        self.api = api
+        self.callback = callback
+        self.started = time.monotonic()
+        self.first_chunk = None
+        self.tokens = 0
+        self.steps = {}  # stage -> steps done
+
+    def __call__(self, event):
+        kind, stage = event['event'], event['stage']
+        if kind == 'progress':
+            self.steps[stage] = event['done']
+            if event.get('tokens'):
+                self.tokens += event['tokens']
+                AUTOREGRESSIVE_TOKENS.inc(event['tokens'], api=self.api)
+        elif kind == 'transfer':
+            TRANSFER_BYTES.inc(event['bytes'], model=event['model'], device=event['device'])
+        elif kind == 'stage_end' and not event.get('cancelled'):
+            seconds = event['seconds']
+            STAGE_SECONDS.observe(seconds, api=self.api, stage=stage)
+            if event['peak_memory'] is not None:
+                STAGE_PEAK_MEMORY.set(event['peak_memory'], api=self.api, stage=stage)
+            if stage in ('autoregressive', 'stream') and self.tokens and seconds > 0:
+                TOKENS_PER_SECOND.observe(self.tokens / seconds, api=self.api)
+            if stage == 'diffusion' and self.steps.get(stage) and seconds > 0:
+                DIFFUSION_STEPS_PER_SECOND.observe(self.steps[stage] / seconds, api=self.api)
+        if self.callback is not None:
+            self.callback(event)
+
+    def chunk(self):
+        if self.first_chunk is None:
+            self.first_chunk = time.monotonic()
+            FIRST_CHUNK_SECONDS.observe(self.first_chunk - self.started, api=self.api)
+
+    def finish(self, outcome, samples=0, sample_rate=24000):
+        GENERATIONS.inc(api=self.api, outcome=outcome)
+        if outcome != 'ok':
+            return
+        seconds = time.monotonic() - self.started
+        GENERATION_SECONDS.observe(seconds, api=self.api)
+        if samples:
+            REAL_TIME_FACTOR.observe(seconds / (samples / sample_rate), api=self.api)
+
+
+def _num_samples(audio):
+    audio = audio if isinstance(audio, (list, tuple)) else [audio]
+    return audio[0].shape[-1] if audio else 0
+
+
+def _outcome(error):
+    return 'cancelled' if type(error).__name__ == 'GenerationCancelled' else 'error'
+
+
+def instrumented(api):
+    """
+    Decorator for TextToSpeech.tts(): records its latency, real-time factor and stage metrics under the label api.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, progress_callback=None, **kwargs):
+            metrics = GenerationMetrics(api, progress_callback)
+            try:
+                result = fn(*args, progress_callback=metrics, **kwargs)
+            except Exception as e:
+                metrics.finish(_outcome(e))
+                raise
+            audio = result[0] if kwargs.get('return_deterministic_state') else result
+            metrics.finish('ok', _num_samples(audio))
+            return result
+        return wrapper
+    return decorator
+
+
+def instrumented_stream(api):
+    """
+    instrumented() for generators of audio chunks such as tts_stream(); also records the time to the first chunk.
+    A stream closed before its end counts as cancelled.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, progress_callback=None, **kwargs):
+            metrics = GenerationMetrics(api, progress_callback)
+            samples = 0
+            try:
+                for chunk in fn(*args, progress_callback=metrics, **kwargs):
+                    metrics.chunk()
+                    samples += chunk.shape[-1]
+                    yield chunk
+            except GeneratorExit:
+                metrics.finish('cancelled')
+                raise
+            except Exception as e:
+                metrics.finish(_outcome(e))
+                raise
+            metrics.finish('ok', samples)
+        return wrapper
+    return decorator
+
+
+async def serve_metrics_http(reader, writer, registry=REGISTRY):
+    """
+    asyncio.start_server() handler answering GET /metrics with registry, for servers that do not speak HTTP otherwise.
+    """
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # Headers are not needed.
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, content_type, body = '200 OK', CONTENT_TYPE, registry.render().encode('utf-8')
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,148 @@
+"""
+Structured progress events from TextToSpeech.tts() and tts_stream(), for callers that want more than tqdm bars.
+
+Pass a callable as progress_callback; it is called from the generating thread with one dict per event. Every event has
+'event', 'stage' and 'time' (a time.monotonic() value):
+
+    stage_start  {'total'}                      total: number of progress steps the stage will take, None if unknown
+    progress     {'done', 'total'}              an autoregressive batch, a CLVP batch, a diffusion step or a streamed
+                                                chunk finished; autoregressive batches and streamed chunks also carry
+                                                'tokens', the number of speech tokens they produced
+    transfer     {'model', 'device', 'bytes'}   a model's weights were moved to device
+    stage_end    {'seconds', 'peak_memory'}     peak_memory: most bytes of CUDA memory allocated during the stage,
+                                                None without CUDA
+
+Stages of tts(), in order: conditioning, autoregressive, clvp, latents, diffusion (which also runs the vocoder) and,
+with redaction, redaction. tts_stream() has conditioning and stream. A stage cut short by a deadline ends early; a
+cancelled one ends with an extra 'cancelled': True.
+
+Callbacks should be quick, they run between model steps. ProgressTracker keeps the numbers most consumers need.
+"""
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+def model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+class ProgressReporter:
+    """
+    Emits events to callback; does nothing at all without one.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stage_name = None
+
+    def __bool__(self):
+        return self.callback is not None
+
+    def emit(self, event, stage=None, **fields):
+        if self.callback is None:
+            return
+        self.callback(dict(fields, event=event, stage=stage or self.stage_name, time=time.monotonic()))
+
+    @contextmanager
+    def stage(self, name, total=None):
+        if self.callback is None:
+            yield
+            return
+        measure_memory = torch.cuda.is_available()
+        if measure_memory:
+            torch.cuda.reset_peak_memory_stats()
+        outer, self.stage_name = self.stage_name, name
+        start = time.monotonic()
+        self.emit('stage_start', total=total)
+        cancelled = False
+        try:
+            yield
+        except BaseException:
+            cancelled = True
+            raise
+        finally:
+            fields = {'cancelled': True} if cancelled else {}
+            self.emit('stage_end', seconds=time.monotonic() - start,
+                      peak_memory=torch.cuda.max_memory_allocated() if measure_memory else None, **fields)
+            self.stage_name = outer
+
+    def step(self, done, total=None, **fields):
+        self.emit('progress', done=done, total=total, **fields)
+
+    def transfer(self, model, device):
+        if self.callback is not None:
+            self.emit('transfer', model=type(model).__name__, device=str(device), bytes=model_bytes(model))
+
+
+class ProgressTracker:
+    """
+    A progress_callback that keeps the state of the current stage and a summary of the finished ones:
+
+        tracker = ProgressTracker()
+        tts.tts_with_preset(text, progress_callback=tracker)
+        print(tracker.summary())
+
+    on_event, when given, is called with every event after the tracker has processed it.
+    """
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.stages = {}  # stage -> {'seconds', 'peak_memory'} of finished stages, in order
+        self.stage = None
+        self.stage_started = None
+        self.done = 0
+        self.total = None
+        self.bytes_moved = 0
+
+    def __call__(self, event):
+        kind = event['event']
+        if kind == 'stage_start':
+            self.stage, self.stage_started = event['stage'], event['time']
+            self.done, self.total = 0, event['total']
+        elif kind == 'progress':
+            self.done, self.total = event['done'], event['total']
+        elif kind == 'transfer':
+            self.bytes_moved += event['bytes']
+        elif kind == 'stage_end':
+            # Stages repeat when one tracker follows several generations; their times add up.
+            stage = self.stages.setdefault(event['stage'], {'seconds': 0.0, 'peak_memory': None})
+            stage['seconds'] += event['seconds']
+            if event['peak_memory'] is not None:
+                stage['peak_memory'] = max(stage['peak_memory'] or 0, event['peak_memory'])
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def fraction(self):
+        """
+        How much of the current stage is done, in [0, 1], or None when its length is not known.
+        """
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1.0)
+
+    def eta(self):
+        """
+        Seconds until the current stage ends, extrapolated from its steps so far, or None before the first step.
+        """
+        if not self.total or not self.done or self.stage_started is None:
+            return None
+        elapsed = time.monotonic() - self.stage_started
+        return elapsed / self.done * (self.total - self.done)
+
+    def peak_memory(self):
+        peaks = [s['peak_memory'] for s in self.stages.values() if s['peak_memory'] is not None]
+        return max(peaks) if peaks else None
+
+    def summary(self):
+        """
+        One line with the time (and CUDA memory peak) of every finished stage.
+        """
+        parts = []
+        for stage, info in self.stages.items():
+            part = f"{stage} {info['seconds']:.1f}s"
+            if info['peak_memory'] is not None:
+                part += f" ({info['peak_memory'] / 2**30:.1f} GiB)"
+            parts.append(part)
+        if self.bytes_moved:
+            parts.append(f"{self.bytes_moved / 2**30:.1f} GiB of weights moved")
+        return ', '.join(parts)
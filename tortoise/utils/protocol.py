@@ -0,0 +1,257 @@
+"""
+Framed binary protocol spoken by tortoise/socket_server.py and TTSClient.
+
+Every message is a frame: a fixed header followed by a payload of payload_length bytes.
+
+    magic (2 bytes, b'TT') | type (u8) | request_id (u32) | sequence (u32) | format (u8) | payload_length (u32)
+
+All integers are big-endian. Frame types:
+    HELLO    client -> server: JSON {"formats": [preferred formats, best first]}
+             server -> client: JSON {"format": chosen format, "sample_rate": 24000, "formats": [supported formats]}
+    REQUEST  client -> server: JSON {"voice": ..., "text": ..., "format": optional per-request format}
+    AUDIO    server -> client: one chunk of audio in the frame's format, sequence counting up from 0 per request.
+             float32, int16 and mulaw payloads stand alone; opus payloads are consecutive pieces of one Ogg Opus
+             stream per request.
+    END      server -> client: JSON {"chunks": number of AUDIO frames, "samples": number of samples}
+    ERROR    server -> client: JSON {"error": message}. Ends the request.
+
+Requests may be pipelined: a client can send several REQUEST frames without waiting, and tells the responses apart by
+request_id. A server with several model workers may answer them concurrently, interleaving their frames, and answers
+a request it has no room for with an ERROR frame ({"error": "busy", ...}) right away. Audio payloads are little-endian
+PCM.
+"""
+import asyncio
+import json
+import socket
+import struct
+import threading
+from collections import deque
+
+import numpy as np
+
+from tortoise.utils.encoding import available_encodings, mulaw_decode
+
+MAGIC = b'TT'
+HEADER = struct.Struct('!2sBIIBI')
+MAX_PAYLOAD = 16 * 1024 * 1024
+SAMPLE_RATE = 24000
+
+HELLO, REQUEST, AUDIO, END, ERROR = 1, 2, 3, 4, 5
+
+FORMAT_NONE, FORMAT_FLOAT32, FORMAT_INT16, FORMAT_MULAW, FORMAT_OPUS = 0, 1, 2, 3, 4
+FORMATS = {'float32': FORMAT_FLOAT32, 'int16': FORMAT_INT16, 'mulaw': FORMAT_MULAW, 'opus': FORMAT_OPUS}
+FORMAT_NAMES = {code: name for name, code in FORMATS.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class TTSServerError(Exception):
+    """
+    The server failed a request; the message is the one it sent in its ERROR frame.
+    """
+    pass
+
+
+def encode_frame(frame_type, request_id=0, sequence=0, fmt=FORMAT_NONE, payload=b''):
+    if isinstance(payload, dict):
+        payload = json.dumps(payload).encode('utf-8')
+    return HEADER.pack(MAGIC, frame_type, request_id, sequence, fmt, len(payload)) + payload
+
+
+def recv_exact(sock, n):
+    """
+    Reads exactly n bytes. Returns None if the connection is closed before the first byte, raises ProtocolError if it is
+    closed halfway.
+    """
+    buffer = bytearray()
+    while len(buffer) < n:
+        data = sock.recv(n - len(buffer))
+        if not data:
+            if not buffer:
+                return None
+            raise ProtocolError('Connection closed in the middle of a frame')
+        buffer.extend(data)
+    return bytes(buffer)
+
+
+def read_frame(sock):
+    """
+    Reads one frame from sock. Returns (type, request_id, sequence, format, payload), or None once the peer closed the
+    connection cleanly.
+    """
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    magic, frame_type, request_id, sequence, fmt, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f'Bad frame magic {magic!r}')
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f'Frame payload of {length} bytes is too large')
+    payload = recv_exact(sock, length) if length else b''
+    if length and payload is None:
+        raise ProtocolError('Connection closed in the middle of a frame')
+    return frame_type, request_id, sequence, fmt, payload
+
+
+async def read_frame_async(reader, prefix=b''):
+    """
+    read_frame() for an asyncio StreamReader. prefix holds header bytes that were already consumed from the stream.
+    """
+    try:
+        header = prefix + await reader.readexactly(HEADER.size - len(prefix))
+    except asyncio.IncompleteReadError as e:
+        if not prefix and not e.partial:
+            return None
+        raise ProtocolError('Connection closed in the middle of a frame')
+    magic, frame_type, request_id, sequence, fmt, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f'Bad frame magic {magic!r}')
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f'Frame payload of {length} bytes is too large')
+    try:
+        payload = await reader.readexactly(length) if length else b''
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed in the middle of a frame')
+    return frame_type, request_id, sequence, fmt, payload
+
+
+def decode_audio(payload, fmt):
+    """
+    Decodes the payload of an AUDIO frame to float32 samples in [-1, 1].
+    """
+    if fmt == FORMAT_FLOAT32:
+        return np.frombuffer(payload, dtype='<f4').astype(np.float32)
+    if fmt == FORMAT_INT16:
+        return np.frombuffer(payload, dtype='<i2').astype(np.float32) / 32767
+    if fmt == FORMAT_MULAW:
+        return mulaw_decode(np.frombuffer(payload, dtype=np.uint8))
+    raise ProtocolError(f'Unsupported audio format {fmt}')
+
+
+def supported_formats():
+    """
+    The formats this side can produce, by name; opus needs PyAV.
+    """
+    encodings = available_encodings()
+    return {name: code for name, code in FORMATS.items() if name in encodings}
+
+
+def negotiate_format(offered, supported=FORMATS):
+    """
+    Picks the first format in the client's preference list that the server supports, float32 otherwise.
+    """
+    for name in offered or []:
+        if name in supported:
+            return supported[name]
+    return FORMAT_FLOAT32
+
+
+class TTSClient:
+    """
+    Client for the framed protocol. Requests are sent as soon as they are submitted, so several of them can be in flight
+    on one connection; frames belonging to other requests are buffered until they are asked for.
+
+        with TTSClient('localhost', 5000, formats=('int16',)) as client:
+            first = client.submit('deniro', 'Hello there.')
+            second = client.submit('deniro', 'How are you?')
+            for chunk in client.stream(first):
+                play(chunk)
+            audio = client.result(second)
+    """
+    def __init__(self, host='localhost', port=5000, formats=('int16', 'float32'), timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self._next_id = 1
+        self._pending = {}  # request_id -> deque of chunks, then END/ERROR markers
+        self._abandoned = set()  # Requests whose stream was left early; their remaining frames are dropped.
+        self._lock = threading.Lock()
+        self.sock.sendall(encode_frame(HELLO, payload={'formats': list(formats)}))
+        frame = read_frame(self.sock)
+        if frame is None or frame[0] != HELLO:
+            raise ProtocolError('The server did not answer the handshake')
+        hello = json.loads(frame[4])
+        self.format = hello['format']
+        self.sample_rate = hello.get('sample_rate', SAMPLE_RATE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def submit(self, voice, text, fmt=None):
+        """
+        Sends a request and returns its id without waiting for any audio.
+        """
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = deque()
+        request = {'voice': voice, 'text': text}
+        if fmt is not None:
+            request['format'] = fmt
+        self.sock.sendall(encode_frame(REQUEST, request_id, payload=request))
+        return request_id
+
+    def _read_one(self):
+        frame = read_frame(self.sock)
+        if frame is None:
+            raise ProtocolError('The server closed the connection')
+        frame_type, request_id, sequence, fmt, payload = frame
+        queue = self._pending.get(request_id)
+        if queue is None:
+            if request_id not in self._abandoned:
+                raise ProtocolError(f'Received a frame for unknown request {request_id}')
+            if frame_type in (END, ERROR):
+                self._abandoned.discard(request_id)
+            return
+        if frame_type == AUDIO:
+            # Opus is a continuous Ogg stream, handed over as is (e.g. to be piped into a player or a file).
+            queue.append(('audio', sequence, payload if fmt == FORMAT_OPUS else decode_audio(payload, fmt)))
+        elif frame_type in (END, ERROR):
+            queue.append(('end' if frame_type == END else 'error', sequence, json.loads(payload)))
+        else:
+            raise ProtocolError(f'Unexpected frame type {frame_type}')
+
+    def stream(self, request_id):
+        """
+        Yields the float32 audio chunks of a request in order, or the bytes of its Ogg stream when the format is opus.
+        Raises TTSServerError if the server failed it.
+        """
+        queue = self._pending[request_id]
+        expected = 0
+        finished = False
+        try:
+            while True:
+                while not queue:
+                    self._read_one()
+                kind, sequence, value = queue.popleft()
+                if kind != 'audio':
+                    finished = True
+                    if kind == 'error':
+                        raise TTSServerError(value.get('error', 'unknown error'))
+                    return
+                if sequence != expected:
+                    raise ProtocolError(f'Chunk {sequence} of request {request_id} arrived, expected {expected}')
+                expected += 1
+                yield value
+        finally:
+            self._pending.pop(request_id, None)
+            if not finished:
+                self._abandoned.add(request_id)
+
+    def result(self, request_id):
+        """
+        Waits for a request to finish and returns its whole audio (an Ogg file's bytes for opus).
+        """
+        chunks = list(self.stream(request_id))
+        if chunks and isinstance(chunks[0], bytes):
+            return b''.join(chunks)
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+    def synthesize(self, voice, text, fmt=None):
+        return self.result(self.submit(voice, text, fmt))
@@ -92,25 +92,24 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
 
 
 class STFT(torch.nn.Module):
-    """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
+    """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft
+
+    backend selects how the forward transform is computed:
+      'fft':  torch.stft with a cached (zero-center-padded) window. This is the default.
+      'conv': the original conv1d against a dense Fourier basis. Kept for reference and numerical comparison.
+    The inverse basis (a pseudo-inverse of the Fourier basis) is only built the first time inverse() is called.
+    """
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='fft'):
         super(STFT, self).__init__()
+        assert backend in ('fft', 'conv'), f"Unknown STFT backend: {backend}"
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
+        self.backend = backend
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
-
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
-                                   np.imag(fourier_basis[:cutoff, :])])
-
-        forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-        inverse_basis = torch.FloatTensor(
-            np.linalg.pinv(scale * fourier_basis).T[:, None, :])
+        self.inverse_basis = None
 
         if window is not None:
             assert(filter_length >= win_length)
@@ -118,20 +117,50 @@ class STFT(torch.nn.Module):
             fft_window = get_window(window, win_length, fftbins=True)
             fft_window = pad_center(fft_window, size=filter_length)
             fft_window = torch.from_numpy(fft_window).float()
+        else:
+            fft_window = torch.ones(filter_length)
+        self.register_buffer('fft_window', fft_window)
 
-            # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
+        if backend == 'conv':
+            self.register_buffer('forward_basis', self._fourier_basis()[:, None, :] * self.fft_window)
 
-        self.register_buffer('forward_basis', forward_basis.float())
-        self.register_buffer('inverse_basis', inverse_basis.float())
+    def _fourier_basis(self):
+        fourier_basis = np.fft.fft(np.eye(self.filter_length))
+        cutoff = int((self.filter_length / 2 + 1))
+        fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
+                                   np.imag(fourier_basis[:cutoff, :])])
+        return torch.FloatTensor(fourier_basis)
 
-    def transform(self, input_data):
+    def _build_inverse_basis(self):
+        scale = self.filter_length / self.hop_length
+        fourier_basis = self._fourier_basis().numpy()
+        inverse_basis = torch.FloatTensor(
+            np.linalg.pinv(scale * fourier_basis).T[:, None, :])
+        if self.window is not None:
+            inverse_basis *= self.fft_window.cpu()
+        return inverse_basis
+
+    def transform(self, input_data, return_phase=True):
         num_batches = input_data.size(0)
         num_samples = input_data.size(1)
 
         self.num_samples = num_samples
 
+        if self.backend == 'fft':
+            # torch.stft(center=True) reflect-pads by filter_length/2 on both sides, exactly like the conv path below.
+            forward_transform = torch.stft(
+                input_data.view(num_batches, num_samples),
+                n_fft=self.filter_length,
+                hop_length=self.hop_length,
+                win_length=self.filter_length,
+                window=self.fft_window,
+                center=True,
+                pad_mode='reflect',
+                return_complex=True)
+            magnitude = forward_transform.abs()
+            phase = torch.angle(forward_transform) if return_phase else None
+            return magnitude, phase
+
         # similar to librosa, reflect-pad the input
         input_data = input_data.view(num_batches, 1, num_samples)
         input_data = F.pad(
@@ -152,11 +181,14 @@ class STFT(torch.nn.Module):
 
         magnitude = torch.sqrt(real_part**2 + imag_part**2)
         phase = torch.autograd.Variable(
-            torch.atan2(imag_part.data, real_part.data))
+            torch.atan2(imag_part.data, real_part.data)) if return_phase else None
 
         return magnitude, phase
 
     def inverse(self, magnitude, phase):
+        if self.inverse_basis is None or self.inverse_basis.device != magnitude.device:
+            self.inverse_basis = self._build_inverse_basis().to(magnitude.device)
+
         recombine_magnitude_phase = torch.cat(
             [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
 
@@ -190,4 +222,33 @@ class STFT(torch.nn.Module):
     def forward(self, input_data):
         self.magnitude, self.phase = self.transform(input_data)
         reconstruction = self.inverse(self.magnitude, self.phase)
-        return reconstruction
\ No newline at end of file
+        return reconstruction
+
+
+if __name__ == '__main__':
+    # Validates the FFT backend against the original conv1d backend and benchmarks both on long clips.
+    import argparse
+    from time import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=int, help='Length of the benchmark clips, in seconds.', default=60)
+    parser.add_argument('--batch', type=int, help='Number of clips transformed at once.', default=4)
+    parser.add_argument('--iters', type=int, help='Timed iterations per backend.', default=10)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    wav = (torch.rand(args.batch, 24000 * args.seconds, device=args.device) * 2 - 1)
+    stfts = {backend: STFT(1024, 256, 1024, backend=backend).to(args.device) for backend in ('conv', 'fft')}
+    with torch.no_grad():
+        mags = {backend: stft.transform(wav, return_phase=False)[0] for backend, stft in stfts.items()}
+        err = (mags['fft'] - mags['conv']).abs()
+        print(f"max abs error: {err.max().item():.3e}, max relative error: {(err / mags['conv'].abs().clamp(min=1e-3)).max().item():.3e}")
+        for backend, stft in stfts.items():
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            start = time()
+            for _ in range(args.iters):
+                stft.transform(wav, return_phase=False)
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            print(f"{backend}: {(time() - start) / args.iters * 1000:.1f}ms per {args.batch}x{args.seconds}s batch")
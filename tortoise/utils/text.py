@@ -1,76 +1,144 @@
 import re
+from itertools import accumulate
 
 
-def split_and_recombine_text(text, desired_length=200, max_length=300):
-    """Split text it into chunks of a desired length trying to keep sentences intact."""
+# Characters at which the splitter has to stop and look: sentence boundaries, quotes, and the character before a quote.
+_split_events_re = re.compile(r'[!?.\n"]|.(?=")', re.DOTALL)
+_punctuation_only_re = re.compile(r'^[\s\.,;:!?]*$')
+
+
+def iter_split_and_recombine_text(text, desired_length=200, max_length=300):
+    """
+    Generator version of split_and_recombine_text(): yields chunks as soon as they are found, so callers can start
+    working on the first chunk of a long text right away.
+    """
     # normalize text, remove redundant whitespace and convert non-ascii quotes to ascii
     text = re.sub(r'\n\n+', '\n', text)
     text = re.sub(r'\s+', ' ', text)
     text = re.sub(r'[“”]', '"', text)
 
-    rv = []
+    # The chunk being built is always text[start:pos + 1]; nothing is copied until it is emitted.
+    # quote_counts[i] is the number of quotes in text[:i], so the quote state over any span is a lookup.
+    quote_counts = [0, *accumulate(c == '"' for c in text)]
     in_quote = False
-    current = ""
+    start = 0
     split_pos = []
     pos = -1
     end_pos = len(text) - 1
 
     def seek(delta):
-        nonlocal pos, in_quote, current
-        is_neg = delta < 0
-        for _ in range(abs(delta)):
-            if is_neg:
-                pos -= 1
-                current = current[:-1]
-            else:
-                pos += 1
-                current += text[pos]
-            if text[pos] == '"':
-                in_quote = not in_quote
+        # Moving backwards toggles the quote state on the characters moved onto, like the original character walk.
+        nonlocal pos, in_quote
+        if delta > 0:
+            quotes = quote_counts[pos + delta + 1] - quote_counts[pos + 1]
+        else:
+            quotes = quote_counts[pos] - quote_counts[pos + delta]
+        pos += delta
+        in_quote ^= quotes % 2 == 1
         return text[pos]
 
     def peek(delta):
         p = pos + delta
         return text[p] if p < end_pos and p >= 0 else ""
 
-    def commit():
-        nonlocal rv, current, split_pos
-        rv.append(current)
-        current = ""
+    def emit():
+        # clean up, skip chunks with only whitespace or punctuation
+        nonlocal start, split_pos
+        chunk = text[start:pos + 1].strip()
+        start = pos + 1
         split_pos = []
+        if len(chunk) > 0 and not _punctuation_only_re.match(chunk):
+            return chunk
+        return None
 
     while pos < end_pos:
-        c = seek(1)
+        # Plain characters in between events only grow the chunk, so jump straight to the next event or to the
+        # character that makes the chunk reach max_length, whichever comes first.
+        event = _split_events_re.search(text, pos + 1)
+        target = min(event.start() if event else end_pos, max(start + max_length - 1, pos + 1), end_pos)
+        c = seek(target - pos)
         # do we need to force a split?
-        if len(current) >= max_length:
-            if len(split_pos) > 0 and len(current) > (desired_length / 2):
+        if pos - start + 1 >= max_length:
+            if len(split_pos) > 0 and pos - start + 1 > (desired_length / 2):
                 # we have at least one sentence and we are over half the desired length, seek back to the last split
-                d = pos - split_pos[-1]
-                seek(-d)
+                seek(split_pos[-1] - pos)
             else:
                 # no full sentences, seek back until we are not in the middle of a word and split there
-                while c not in '!?.\n ' and pos > 0 and len(current) > desired_length:
+                while c not in '!?.\n ' and pos > 0 and pos - start + 1 > desired_length:
                     c = seek(-1)
-            commit()
+            chunk = emit()
+            if chunk is not None:
+                yield chunk
         # check for sentence boundaries
         elif not in_quote and (c in '!?\n' or (c == '.' and peek(1) in '\n ')):
             # seek forward if we have consecutive boundary markers but still within the max length
-            while pos < len(text) - 1 and len(current) < max_length and peek(1) in '!?.':
+            while pos < len(text) - 1 and pos - start + 1 < max_length and peek(1) in '!?.':
                 c = seek(1)
             split_pos.append(pos)
-            if len(current) >= desired_length:
-                commit()
+            if pos - start + 1 >= desired_length:
+                chunk = emit()
+                if chunk is not None:
+                    yield chunk
         # treat end of quote as a boundary if its followed by a space or newline
         elif in_quote and peek(1) == '"' and peek(2) in '\n ':
             seek(2)
             split_pos.append(pos)
-    rv.append(current)
+    chunk = emit()
+    if chunk is not None:
+        yield chunk
+
+
+def split_and_recombine_text(text, desired_length=200, max_length=300):
+    """Split text it into chunks of a desired length trying to keep sentences intact."""
+    return list(iter_split_and_recombine_text(text, desired_length, max_length))
+
 
-    # clean up, remove lines with only whitespace or punctuation
-    rv = [s.strip() for s in rv]
-    rv = [s for s in rv if len(s) > 0 and not re.match(r'^[\s\.,;:!?]*$', s)]
+# The autoregressive model emits one mel token per 1024 samples of 22.05kHz audio and reads roughly this many
+# characters of normalized text per second.
+MEL_TOKENS_PER_SECOND = 22050 / 1024
+CHARACTERS_PER_SECOND = 14
+# tts() accepts fewer than 400 text tokens.
+MAX_TEXT_TOKENS = 399
 
-    return rv
+
+def iter_split_by_token_budget(text, tokenizer, max_text_tokens=MAX_TEXT_TOKENS, max_mel_tokens=500, headroom=.8):
+    """
+    Splits text into chunks sized by what the autoregressive model can actually take: at most max_text_tokens tokens
+    of the given VoiceBpeTokenizer, and an estimated spoken length of at most headroom * max_mel_tokens mel tokens, so
+    that generations end on a stop token instead of being truncated. Whole sentences are packed into each chunk until
+    the budget is full; only sentences that do not fit on their own are cut, at word boundaries.
+    """
+    # The mel token estimate is linear in the normalized length, so the mel budget is a character budget.
+    max_characters = int(max_mel_tokens * headroom / MEL_TOKENS_PER_SECOND * CHARACTERS_PER_SECOND)
+
+    def cost(piece):
+        return len(tokenizer.encode(piece)), len(tokenizer.preprocess_text(piece))
+
+    def fits(n_tokens, n_characters):
+        return n_tokens <= max_text_tokens and n_characters <= max_characters
+
+    def sentences(text, max_length):
+        for sentence in iter_split_and_recombine_text(text, desired_length=1, max_length=max_length):
+            sentence_cost = cost(sentence)
+            if fits(*sentence_cost) or max_length <= 1:
+                yield sentence, sentence_cost
+            else:
+                yield from sentences(sentence, max_length // 2)
+
+    # [SPACE] is a special token that BPE never merges across, so joining two pieces costs exactly one more token and
+    # one more character than the pieces themselves.
+    chunk, chunk_tokens, chunk_characters = [], 0, 0
+    for sentence, (n_tokens, n_characters) in sentences(text, max_characters):
+        if chunk and not fits(chunk_tokens + 1 + n_tokens, chunk_characters + 1 + n_characters):
+            yield ' '.join(chunk)
+            chunk, chunk_tokens, chunk_characters = [], 0, 0
+        if chunk:
+            n_tokens, n_characters = n_tokens + 1, n_characters + 1
+        chunk.append(sentence)
+        chunk_tokens += n_tokens
+        chunk_characters += n_characters
+    if chunk:
+        yield ' '.join(chunk)
 
 
 if __name__ == '__main__':
@@ -129,4 +197,22 @@ if __name__ == '__main__':
                 ]
             )
 
+        def test_split_by_token_budget(self):
+            try:
+                from tortoise.utils.tokenizer import VoiceBpeTokenizer
+            except ImportError as e:
+                self.skipTest(f'tokenizer unavailable: {e}')
+            text_src = os.path.join(os.path.dirname(__file__), '../data/riding_hood.txt')
+            with open(text_src, 'r') as f:
+                text = f.read()
+            tokenizer = VoiceBpeTokenizer()
+            chunks = list(iter_split_by_token_budget(text, tokenizer, max_mel_tokens=300))
+            max_characters = 300 * .8 / MEL_TOKENS_PER_SECOND * CHARACTERS_PER_SECOND
+            for chunk in chunks:
+                self.assertLessEqual(len(tokenizer.encode(chunk)), MAX_TEXT_TOKENS)
+                self.assertLessEqual(len(tokenizer.preprocess_text(chunk)), max_characters)
+            # Nothing is lost, and sentences are packed into fewer chunks than the character based splitter makes.
+            self.assertEqual(' '.join(chunks).split(), ' '.join(split_and_recombine_text(text)).split())
+            self.assertLess(len(chunks), len(split_and_recombine_text(text, desired_length=1, max_length=1000)))
+
     unittest.main()
@@ -1,5 +1,7 @@
 import os
 import re
+import threading
+from collections import OrderedDict
 
 import inflect
 import torch
@@ -12,8 +14,8 @@ from unidecode import unidecode
 _whitespace_re = re.compile(r'\s+')
 
 
-# List of (regular expression, replacement) pairs for abbreviations:
-_abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in [
+# Abbreviations and their expansions. They are all matched by a single regular expression:
+_abbreviations = dict([
   ('mrs', 'misess'),
   ('mr', 'mister'),
   ('dr', 'doctor'),
@@ -32,13 +34,26 @@ _abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in
   ('ltd', 'limited'),
   ('col', 'colonel'),
   ('ft', 'fort'),
-]]
+])
+_abbreviations_re = re.compile(r'\b(%s)\.' % '|'.join(_abbreviations), re.IGNORECASE)
+
+
+_abbreviation_order = {abbreviation: i for i, abbreviation in enumerate(_abbreviations)}
 
 
 def expand_abbreviations(text):
-  for regex, replacement in _abbreviations:
-    text = re.sub(regex, replacement, text)
-  return text
+  # Gives the same result as substituting each abbreviation in turn, in list order: an expansion glued to a following
+  # abbreviation ("dr.st.") removes the word boundary of that abbreviation if it comes later in the list.
+  previous = (-1, None)
+
+  def expand(m):
+    nonlocal previous
+    order = _abbreviation_order[m.group(1).lower()]
+    if m.start() == previous[0] and previous[1] < order:
+      return m.group(0)
+    previous = (m.end(), order)
+    return _abbreviations[m.group(1).lower()]
+  return _abbreviations_re.sub(expand, text)
 
 
 _inflect = inflect.engine()
@@ -48,6 +63,7 @@ _pounds_re = re.compile(r'£([0-9\,]*[0-9]+)')
 _dollars_re = re.compile(r'\$([0-9\.\,]*[0-9]+)')
 _ordinal_re = re.compile(r'[0-9]+(st|nd|rd|th)')
 _number_re = re.compile(r'[0-9]+')
+_digit_re = re.compile(r'[0-9]')
 
 
 def _remove_commas(m):
@@ -99,6 +115,8 @@ def _expand_number(m):
 
 
 def normalize_numbers(text):
+  if not _digit_re.search(text):
+    return text  # Every rule below needs a digit.
   text = re.sub(_comma_number_re, _remove_commas, text)
   text = re.sub(_pounds_re, r'\1 pounds', text)
   text = re.sub(_dollars_re, _expand_dollars, text)
@@ -170,7 +188,11 @@ DEFAULT_VOCAB_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '
 
 
 class VoiceBpeTokenizer:
-    def __init__(self, vocab_file=None, use_basic_cleaners=False):
+    def __init__(self, vocab_file=None, use_basic_cleaners=False, cache_size=4096):
+        """
+        :param cache_size: Number of encoded texts remembered, keyed by the raw text. Long-form jobs encode the same
+                           sentences again for every voice and regeneration. 0 disables the cache.
+        """
         self.tokenizer = Tokenizer.from_file(
           DEFAULT_VOCAB_FILE if vocab_file is None else vocab_file
         )
@@ -178,11 +200,49 @@ class VoiceBpeTokenizer:
             self.preprocess_text = basic_cleaners
         else:
             self.preprocess_text = english_cleaners
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
-    def encode(self, txt):
+    def _prepare(self, txt):
         txt = self.preprocess_text(txt)
-        txt = txt.replace(' ', '[SPACE]')
-        return self.tokenizer.encode(txt).ids
+        return txt.replace(' ', '[SPACE]')
+
+    def _cache_get(self, txt):
+        with self._cache_lock:
+            ids = self._cache.get(txt)
+            if ids is not None:
+                self._cache.move_to_end(txt)
+            return ids
+
+    def _cache_put(self, txt, ids):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[txt] = tuple(ids)
+            self._cache.move_to_end(txt)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def encode(self, txt):
+        ids = self._cache_get(txt)
+        if ids is None:
+            ids = self.tokenizer.encode(self._prepare(txt)).ids
+            self._cache_put(txt, ids)
+        return list(ids)
+
+    def encode_batch(self, txts):
+        """
+        Encodes a list of texts. Texts that are not cached yet are encoded in one call to the fast tokenizer's batch API.
+        """
+        encoded = [self._cache_get(txt) for txt in txts]
+        missing = list(dict.fromkeys(txt for txt, ids in zip(txts, encoded) if ids is None))
+        if missing:
+            fresh = {txt: enc.ids for txt, enc in zip(missing, self.tokenizer.encode_batch([self._prepare(txt) for txt in missing]))}
+            for txt, ids in fresh.items():
+                self._cache_put(txt, ids)
+            encoded = [fresh[txt] if ids is None else ids for txt, ids in zip(txts, encoded)]
+        return [list(ids) for ids in encoded]
 
     def decode(self, seq):
         if isinstance(seq, torch.Tensor):
@@ -1,130 +1,178 @@
+import gc
 import re
+import threading
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchaudio
 from transformers import Wav2Vec2ForCTC, Wav2Vec2FeatureExtractor, Wav2Vec2CTCTokenizer, Wav2Vec2Processor
 
 from tortoise.utils.audio import load_audio
 
 
-def max_alignment(s1, s2, skip_character='~', record=None):
+def ctc_forced_align(log_probs, targets, input_lengths, target_lengths, blank=0):
     """
-    A clever function that aligns s1 to s2 as best it can. Wherever a character from s1 is not found in s2, a '~' is
-    used to replace that character.
-
-    Finally got to use my DP skills!
+    Batched CTC forced alignment: finds the most likely (Viterbi) path through the CTC lattice of each target sequence.
+    The recursion over frames is sequential but every step updates all clips and lattice states at once.
+    :param log_probs: (b,t,v) log-probabilities.
+    :param targets: (b,l) target token ids. Entries past target_lengths are ignored.
+    :param input_lengths: (b,) number of valid frames of each clip.
+    :param target_lengths: (b,) number of valid tokens of each target.
+    :return: ((b,l) first frame of every target token, (b,) bool tensor which is False where no alignment exists, e.g.
+             when a clip has fewer frames than its target needs).
     """
-    if record is None:
-        record = {}
-    assert skip_character not in s1, f"Found the skip character {skip_character} in the provided string, {s1}"
-    if len(s1) == 0:
-        return ''
-    if len(s2) == 0:
-        return skip_character * len(s1)
-    if s1 == s2:
-        return s1
-    if s1[0] == s2[0]:
-        return s1[0] + max_alignment(s1[1:], s2[1:], skip_character, record)
-
-    take_s1_key = (len(s1), len(s2) - 1)
-    if take_s1_key in record:
-        take_s1, take_s1_score = record[take_s1_key]
-    else:
-        take_s1 = max_alignment(s1, s2[1:], skip_character, record)
-        take_s1_score = len(take_s1.replace(skip_character, ''))
-        record[take_s1_key] = (take_s1, take_s1_score)
-
-    take_s2_key = (len(s1) - 1, len(s2))
-    if take_s2_key in record:
-        take_s2, take_s2_score = record[take_s2_key]
-    else:
-        take_s2 = max_alignment(s1[1:], s2, skip_character, record)
-        take_s2_score = len(take_s2.replace(skip_character, ''))
-        record[take_s2_key] = (take_s2, take_s2_score)
-
-    return take_s1 if take_s1_score > take_s2_score else skip_character + take_s2
+    b, t, _ = log_probs.shape
+    device = log_probs.device
+    n_tokens = targets.shape[1]
+    n_states = 2 * n_tokens + 1
+    input_lengths = input_lengths.to(device)
+    target_lengths = target_lengths.to(device)
+
+    # Lattice states alternate between blanks and target tokens: blank, t0, blank, t1, ..., blank.
+    states = torch.full((b, n_states), blank, dtype=torch.long, device=device)
+    states[:, 1::2] = targets
+    emissions = log_probs.gather(2, states[:, None, :].expand(b, t, n_states))
+    # Blanks may only be skipped between two different tokens.
+    can_skip = torch.zeros(b, n_states, dtype=torch.bool, device=device)
+    can_skip[:, 2:] = (states[:, 2:] != blank) & (states[:, 2:] != states[:, :-2])
+
+    neg_inf = float('-inf')
+    alpha = torch.full((b, n_states), neg_inf, device=device)
+    alpha[:, :2] = emissions[:, 0, :2]
+    # How many states each state moved back from at every frame: 0 (stay), 1 (advance) or 2 (skip a blank).
+    backpointers = torch.zeros(b, t, n_states, dtype=torch.uint8, device=device)
+    for frame in range(1, t):
+        stay = alpha
+        advance = F.pad(alpha[:, :-1], (1, 0), value=neg_inf)
+        skip = F.pad(alpha[:, :-2], (2, 0), value=neg_inf).masked_fill(~can_skip, neg_inf)
+        best, choice = torch.stack([stay, advance, skip], dim=-1).max(dim=-1)
+        # Clips that already ended keep their state so the final frame holds their result.
+        active = (frame < input_lengths)[:, None]
+        alpha = torch.where(active, best + emissions[:, frame], alpha)
+        backpointers[:, frame] = choice.masked_fill(~active, 0)
+
+    # Paths end on the last token or the blank after it.
+    last_blank = 2 * target_lengths
+    last_token = (last_blank - 1).clamp(min=0)
+    end_blank = alpha.gather(1, last_blank[:, None]).squeeze(1)
+    end_token = alpha.gather(1, last_token[:, None]).squeeze(1)
+    on_token = (end_token > end_blank) & (target_lengths > 0)
+    state = torch.where(on_token, last_token, last_blank)
+    found = torch.maximum(end_blank, end_token).isfinite()
+
+    path = torch.empty(b, t, dtype=torch.long, device=device)
+    path[:, -1] = state
+    for frame in range(t - 1, 0, -1):
+        state = state - backpointers[:, frame].gather(1, state[:, None]).squeeze(1).long()
+        path[:, frame - 1] = state
+
+    # First frame spent in each token state. Blank frames are sent to a spare column.
+    token_index = torch.where(path % 2 == 1, (path - 1) // 2, n_tokens)
+    frames = torch.arange(t, device=device).expand(b, t)
+    starts = torch.full((b, n_tokens + 1), t, dtype=torch.long, device=device)
+    starts = starts.scatter_reduce(1, token_index, frames, reduce='amin')[:, :n_tokens]
+    return starts, found
 
 
 class Wav2VecAlignment:
     """
     Uses wav2vec2 to perform audio<->text alignment.
     """
-    def __init__(self, device='cuda' if not torch.backends.mps.is_available() else 'mps'):
-        self.model = Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli").cpu()
+    def __init__(self, device='cuda' if not torch.backends.mps.is_available() else 'mps', offload=True):
+        """
+        :param offload: When true, the model only lives on device while a batch is aligned and is moved back to the cpu
+                        afterwards. When false it stays resident on device, saving the transfers.
+        """
+        self.offload = offload
+        self.model = Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli")
+        self.model = self.model.cpu() if offload else self.model.to(device)
         self.feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(f"facebook/wav2vec2-large-960h")
         self.tokenizer = Wav2Vec2CTCTokenizer.from_pretrained('jbetker/tacotron-symbols')
+        self.vocab = self.tokenizer.get_vocab()
         self.device = device
 
+    def encode_characters(self, text):
+        """
+        Maps every character of text to its CTC token id, or None when the character cannot be emitted by the model.
+        """
+        delimiter = self.tokenizer.word_delimiter_token
+        blank = self.model.config.pad_token_id
+        tokens = []
+        for c in text:
+            token = self.vocab.get(delimiter if c == ' ' and delimiter in self.vocab else c)
+            tokens.append(None if token in (None, blank, self.tokenizer.unk_token_id) else token)
+        return tokens
+
     def align(self, audio, expected_text, audio_sample_rate=24000):
-        orig_len = audio.shape[-1]
+        return self.align_batch([audio], [expected_text], audio_sample_rate)[0]
+
+    def align_batch(self, audios, expected_texts, audio_sample_rate=24000):
+        """
+        Aligns every clip in audios to the matching string in expected_texts using a single wav2vec2 forward pass and a
+        batched CTC forced alignment.
+        :return: For every clip, a list holding the sample at which each character of its text starts. Characters the
+                 model cannot emit (and every character of a clip that is too short to fit its text) are interpolated
+                 between their aligned neighbours.
+        """
+        audios = [a.reshape(-1) for a in audios]
+        orig_lens = torch.tensor([a.shape[-1] for a in audios])
 
         with torch.no_grad():
             self.model = self.model.to(self.device)
-            audio = audio.to(self.device)
+            audio = torch.stack([F.pad(a, (0, int(orig_lens.max()) - a.shape[-1])) for a in audios]).to(self.device)
             audio = torchaudio.functional.resample(audio, audio_sample_rate, 16000)
-            clip_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
-            logits = self.model(clip_norm).logits
-            self.model = self.model.cpu()
-
-        logits = logits[0]
-        pred_string = self.tokenizer.decode(logits.argmax(-1).tolist())
-
-        fixed_expectation = max_alignment(expected_text.lower(), pred_string)
-        w2v_compression = orig_len // logits.shape[0]
-        expected_tokens = self.tokenizer.encode(fixed_expectation)
-        expected_chars = list(fixed_expectation)
-        if len(expected_tokens) == 1:
-            return [0]  # The alignment is simple; there is only one token.
-        expected_tokens.pop(0)  # The first token is a given.
-        expected_chars.pop(0)
-
-        alignments = [0]
-        def pop_till_you_win():
-            if len(expected_tokens) == 0:
-                return None
-            popped = expected_tokens.pop(0)
-            popped_char = expected_chars.pop(0)
-            while popped_char == '~':
-                alignments.append(-1)
-                if len(expected_tokens) == 0:
-                    return None
-                popped = expected_tokens.pop(0)
-                popped_char = expected_chars.pop(0)
-            return popped
-
-        next_expected_token = pop_till_you_win()
-        for i, logit in enumerate(logits):
-            top = logit.argmax()
-            if next_expected_token == top:
-                alignments.append(i * w2v_compression)
-                if len(expected_tokens) > 0:
-                    next_expected_token = pop_till_you_win()
-                else:
-                    break
-
-        pop_till_you_win()
-        if not (len(expected_tokens) == 0 and len(alignments) == len(expected_text)):
-            torch.save([audio, expected_text], 'alignment_debug.pth')
-            assert False, "Something went wrong with the alignment algorithm. I've dumped a file, 'alignment_debug.pth' to" \
-                          "your current working directory. Please report this along with the file so it can get fixed."
-
-        # Now fix up alignments. Anything with -1 should be interpolated.
-        alignments.append(orig_len)  # This'll get removed but makes the algorithm below more readable.
-        for i in range(len(alignments)):
-            if alignments[i] == -1:
-                for j in range(i+1, len(alignments)):
-                    if alignments[j] != -1:
-                        next_found_token = j
-                        break
-                for j in range(i, next_found_token):
-                    gap = alignments[next_found_token] - alignments[i-1]
-                    alignments[j] = (j-i+1) * gap // (next_found_token-i+1) + alignments[i-1]
-
-        return alignments[:-1]
+            lengths = torch.ceil(orig_lens * 16000 / audio_sample_rate).long().clamp(max=audio.shape[-1])
+            mask = (torch.arange(audio.shape[-1])[None] < lengths[:, None]).to(self.device)
+            # Each clip is normalized over its own samples only; the padding is zeroed afterwards.
+            n = lengths[:, None].to(self.device)
+            mean = (audio * mask).sum(-1, keepdim=True) / n
+            var = ((audio - mean) ** 2 * mask).sum(-1, keepdim=True) / (n - 1).clamp(min=1)
+            clip_norm = ((audio - mean) / torch.sqrt(var + 1e-7)) * mask
+            attention_mask = mask.long() if self.model.config.feat_extract_norm == 'layer' else None
+            logits = self.model(clip_norm, attention_mask=attention_mask).logits
+            if self.offload:
+                self.model = self.model.cpu()
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+
+            frame_lengths = self.model._get_feat_extract_output_lengths(lengths).clamp(max=logits.shape[1])
+            characters = [self.encode_characters(text.lower()) for text in expected_texts]
+            targets = [[tok for tok in chars if tok is not None] for chars in characters]
+            target_lengths = torch.tensor([len(tgt) for tgt in targets])
+            padded_targets = torch.zeros(len(targets), max(1, int(target_lengths.max())), dtype=torch.long)
+            for k, tgt in enumerate(targets):
+                padded_targets[k, :len(tgt)] = torch.tensor(tgt, dtype=torch.long)
+            starts, found = ctc_forced_align(log_probs, padded_targets.to(self.device), frame_lengths, target_lengths,
+                                             blank=self.model.config.pad_token_id)
+            starts, found = starts.cpu(), found.cpu()
+
+        results = []
+        for k, chars in enumerate(characters):
+            orig_len = int(orig_lens[k])
+            w2v_compression = orig_len // max(1, int(frame_lengths[k]))
+            alignments = np.full(len(chars) + 1, -1, dtype=np.int64)
+            if found[k]:
+                aligned = np.array([c is not None for c in chars] + [False])
+                alignments[aligned] = starts[k, :int(target_lengths[k])].numpy() * w2v_compression
+            alignments[0] = 0
+            alignments[-1] = orig_len  # This'll get removed but anchors the interpolation of trailing characters.
+            # Now fix up alignments. Anything with -1 is interpolated linearly between the aligned characters around it.
+            known = np.flatnonzero(alignments != -1)
+            alignments = np.floor(np.interp(np.arange(len(alignments)), known, alignments[known])).astype(np.int64)
+            results.append(alignments[:-1].tolist())
+        return results
 
     def redact(self, audio, expected_text, audio_sample_rate=24000):
+        return self.redact_batch([audio], expected_text, audio_sample_rate)[0]
+
+    def redact_batch(self, audios, expected_text, audio_sample_rate=24000):
+        """
+        Removes the spoken form of every bracketed span of expected_text from each clip in audios (e.g. all candidates
+        generated for one text). All clips are aligned with a single wav2vec2 forward; nothing runs when there is
+        nothing to redact.
+        """
         if '[' not in expected_text:
-            return audio
+            return audios
         splitted = expected_text.split('[')
         fully_split = [splitted[0]]
         for spl in splitted[1:]:
@@ -141,10 +189,99 @@ class Wav2VecAlignment:
             last_point += len(fully_split[i])
 
         bare_text = ''.join(fully_split)
-        alignments = self.align(audio, bare_text, audio_sample_rate)
+        batch_alignments = self.align_batch(audios, [bare_text] * len(audios), audio_sample_rate)
 
-        output_audio = []
-        for nri in non_redacted_intervals:
-            start, stop = nri
-            output_audio.append(audio[:, alignments[start]:alignments[stop]])
-        return torch.cat(output_audio, dim=-1)
+        redacted = []
+        for audio, alignments in zip(audios, batch_alignments):
+            output_audio = []
+            for nri in non_redacted_intervals:
+                start, stop = nri
+                output_audio.append(audio[:, alignments[start]:alignments[stop]])
+            redacted.append(torch.cat(output_audio, dim=-1))
+        return redacted
+
+
+class LazyWav2VecAlignment:
+    """
+    Stand-in for Wav2VecAlignment that only loads the wav2vec2 model, feature extractor and tokenizer when they are first
+    needed. Most texts contain nothing to redact, so loading them up front costs start-up time and memory for nothing.
+    :param warm_up: When true, the aligner is loaded right away in a background thread instead of on first use.
+    :param idle_timeout: When set, the aligner is released after this many seconds without use and reloaded on demand.
+    Remaining keyword arguments are passed to Wav2VecAlignment. The model stays resident on its device (offload=False)
+    unless asked otherwise: memory is given back through idle_timeout instead of a transfer on every redaction.
+    """
+    def __init__(self, warm_up=False, idle_timeout=None, **kwargs):
+        kwargs.setdefault('offload', False)
+        self.kwargs = kwargs
+        self.idle_timeout = idle_timeout
+        self._aligner = None
+        self._users = 0
+        self._release_timer = None
+        self._lock = threading.Lock()
+        if warm_up:
+            threading.Thread(target=self._warm_up, name='aligner-warm-up', daemon=True).start()
+
+    @property
+    def loaded(self):
+        return self._aligner is not None
+
+    def _warm_up(self):
+        with self._lock:
+            if self._aligner is None:
+                self._aligner = Wav2VecAlignment(**self.kwargs)
+            self._schedule_release()
+
+    def _schedule_release(self):
+        # Must be called with the lock held.
+        if self._release_timer is not None:
+            self._release_timer.cancel()
+            self._release_timer = None
+        if self.idle_timeout is not None and self._users == 0 and self._aligner is not None:
+            self._release_timer = threading.Timer(self.idle_timeout, self.release)
+            self._release_timer.daemon = True
+            self._release_timer.start()
+
+    def release(self):
+        """
+        Drops the aligner (unless it is in use) so its memory can be reclaimed. It is reloaded on the next call.
+        """
+        with self._lock:
+            if self._users > 0 or self._aligner is None:
+                return
+            self._aligner = None
+            if self._release_timer is not None:
+                self._release_timer.cancel()
+                self._release_timer = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            if self._aligner is None:
+                self._aligner = Wav2VecAlignment(**self.kwargs)
+            aligner = self._aligner
+            self._users += 1
+            self._schedule_release()
+        try:
+            return getattr(aligner, method)(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._users -= 1
+                self._schedule_release()
+
+    def align(self, *args, **kwargs):
+        return self._call('align', *args, **kwargs)
+
+    def align_batch(self, *args, **kwargs):
+        return self._call('align_batch', *args, **kwargs)
+
+    def redact(self, audio, expected_text, audio_sample_rate=24000):
+        if '[' not in expected_text:
+            return audio
+        return self._call('redact', audio, expected_text, audio_sample_rate)
+
+    def redact_batch(self, audios, expected_text, audio_sample_rate=24000):
+        if '[' not in expected_text:
+            return audios
+        return self._call('redact_batch', audios, expected_text, audio_sample_rate)
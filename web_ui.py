@@ -3,18 +3,31 @@ Simple Web UI for Tortoise TTS
 """
 import os
 import sys
-import io
 import base64
+import itertools
+import json
+import queue
 import subprocess
+import shutil
+import tempfile
 import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, redirect, render_template, request, jsonify, stream_with_context, url_for
 from werkzeug.utils import secure_filename
 import torch
 import torchaudio
 from tortoise.api import TextToSpeech
-from tortoise.utils.audio import load_audio, load_voices
+from tortoise.utils.audio import iter_voice_segments, load_audio, load_voices
+from tortoise.utils.cancellation import CancellationToken, GenerationCancelled, release_memory
+from tortoise.utils.metrics import CONTENT_TYPE, REGISTRY, SERVER_QUEUE_DEPTH, SERVER_QUEUE_SECONDS, SERVER_REQUESTS
+from tortoise.utils.progress import ProgressTracker
+from tortoise.utils.cache import PhraseCache, SynthesisCache, stream_audio_chunks, voice_digest
+from tortoise.utils.text import iter_split_by_token_budget
+from tortoise.utils.encoding import available_encodings, encode_chunks, make_encoder
 
 # Avoid duplicate OpenMP runtime crashes on Windows when NumPy/Numba and PyTorch both load Intel runtimes.
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
@@ -29,52 +42,285 @@ app.config['OUTPUT_FOLDER'] = str(MUSIC_FOLDER)
 
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 
-# Initialize TTS (lazy loading)
-tts = None
-current_generation_thread = None
-generation_cancelled = False
+# Set TORTOISE_WARMUP=0 to load the models on the first request instead of warming them up at startup
+WARMUP_AT_STARTUP = os.environ.get('TORTOISE_WARMUP', '1') != '0'
+# The models are shared by generation and voice cloning jobs; only one of them may drive them at a time.
+tts_lock = threading.RLock()
+
+# Voice cloning ingestion runs in the background so large uploads don't block the Flask worker
+voice_ingest_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='voice-ingest')
+segment_writer_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='segment-writer')
+voice_jobs = {}
+voice_jobs_lock = threading.Lock()
+MAX_FINISHED_VOICE_JOBS = 50
+
+# Speech generation jobs run on their own worker and outlive the request that submitted them. The models are shared,
+# so more workers would only queue on tts_lock. Job records are kept in JOBS_FOLDER, so finished results can still be
+# looked up after the browser tab or the web UI itself was closed.
+generation_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generation')
+generation_jobs = {}
+generation_jobs_lock = threading.Lock()
+MAX_FINISHED_GENERATION_JOBS = 100
+JOBS_FOLDER = MUSIC_FOLDER / '.jobs'
+JOBS_FOLDER.mkdir(parents=True, exist_ok=True)
+
+# Served on /metrics together with the generation, stage and cache metrics tortoise records by itself
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('tortoise_http_request_seconds',
+                                          'Time to answer web UI requests, up to the start of streamed bodies.',
+                                          ('endpoint',))
+SERVER_QUEUE_DEPTH.set_function(
+    lambda: sum(1 for job in list(generation_jobs.values()) if job['state'] == 'queued'), server='web_ui')
+
+# Opt-in cache of finished generations for phrases that are requested over and over. Set TORTOISE_PHRASE_CACHE_MB
+# to enable it, and TORTOISE_PHRASE_CACHE_DIR to also keep the phrases on disk across restarts.
+PHRASE_CACHE_MB = int(os.environ.get('TORTOISE_PHRASE_CACHE_MB', '0'))
+PHRASE_CACHE_DIR = os.environ.get('TORTOISE_PHRASE_CACHE_DIR')
+phrase_cache = None
+if PHRASE_CACHE_MB > 0:
+    phrase_cache = PhraseCache(PHRASE_CACHE_MB * 1024 ** 2,
+                               disk_cache=SynthesisCache(PHRASE_CACHE_DIR) if PHRASE_CACHE_DIR else None)
 
 # Debug log buffer for web display
-debug_logs = []
-MAX_DEBUG_LOGS = 100
+MAX_DEBUG_LOGS = 500
+DEBUG_LOG_LEVELS = ('debug', 'info', 'success', 'warning', 'error')
+
+
+class DebugLog:
+    """
+    Ring buffer of the last max_entries log entries, each numbered with a sequence number, so pollers can ask for only
+    what they haven't seen yet. The lock only covers numbering and appending (the deque drops its oldest entry by
+    itself once full), so entries are stored in sequence order and no writer ever waits on I/O.
+    """
+    def __init__(self, max_entries=MAX_DEBUG_LOGS):
+        self._entries = deque(maxlen=max_entries)
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.last_seq = 0
+
+    def add(self, message, level='info'):
+        entry = {
+            'time': time.time(),
+            'timestamp': time.strftime('%H:%M:%S'),
+            'level': level if level in DEBUG_LOG_LEVELS else 'info',
+            'message': str(message),
+        }
+        with self._lock:
+            entry['seq'] = self.last_seq = next(self._seq)
+            self._entries.append(entry)
+        return entry
+
+    def since(self, seq=0, min_level=None):
+        """Entries newer than seq (oldest first, at min_level or more severe) and the sequence number to poll from next"""
+        with self._lock:
+            entries = [e for e in self._entries if e['seq'] > seq]
+            last_seq = self.last_seq
+        if min_level in DEBUG_LOG_LEVELS:
+            rank = DEBUG_LOG_LEVELS.index(min_level)
+            entries = [e for e in entries if DEBUG_LOG_LEVELS.index(e['level']) >= rank]
+        return entries, last_seq
+
+    def clear(self):
+        # Sequence numbers keep counting, so pollers just see no new entries.
+        with self._lock:
+            self._entries.clear()
+
+
+debug_log = DebugLog()
+
+# Console output is written by its own thread, so logging never waits on the terminal (or on a redirected stdout).
+console_lines = queue.SimpleQueue()
+
+def write_console_lines():
+    while True:
+        lines = [console_lines.get()]
+        while not console_lines.empty():
+            lines.append(console_lines.get_nowait())
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
+
+threading.Thread(target=write_console_lines, name='console-log', daemon=True).start()
 
 def add_debug_log(message, level="info"):
     """Add a debug message to the log buffer"""
-    import datetime
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    log_entry = {
-        'timestamp': timestamp,
-        'level': level,
-        'message': str(message)
-    }
-    debug_logs.append(log_entry)
-    # Keep only last MAX_DEBUG_LOGS entries
-    if len(debug_logs) > MAX_DEBUG_LOGS:
-        debug_logs.pop(0)
-    print(f"[{level.upper()}] {message}", flush=True)
-    sys.stdout.flush()
+    entry = debug_log.add(message, level)
+    console_lines.put(f"[{entry['level'].upper()}] {entry['message']}\n")
 
-def get_tts():
-    global tts
-    if tts is None:
-        add_debug_log("Loading Tortoise TTS models...", "info")
+class WarmModel:
+    """
+    Holds one engine's TextToSpeech instance. start() loads it in the background and warms it up with a tiny
+    synthesis, so weights, CUDA kernels and allocator pools are in place before the first real request; get() loads it
+    on the spot when nobody did. reload() is a rolling restart: the replacement is loaded and warmed up while the
+    current instance keeps serving, and only then swapped in. This briefly needs memory for both copies.
+    """
+    def __init__(self, name, load, warm_up):
+        self.name = name
+        self._load = load
+        self._warm_up = warm_up
+        self.instance = None
+        self.state = 'cold'  # cold, loading, warming, ready, reloading or failed
+        self.error = None
+        self.loaded_at = None
+        self.reloads = 0
+        self._lock = threading.Lock()  # Held while the first instance is loading
+        self._reload_lock = threading.Lock()  # Held while a replacement is loading
+
+    def get(self):
+        if self.instance is not None:
+            return self.instance
+        with self._lock:
+            if self.instance is None:
+                self._set_state('loading')
+                try:
+                    self.instance = self._load()
+                except Exception as e:
+                    self._set_state('failed', e)
+                    raise
+                self.loaded_at = time.time()
+                self._set_state('ready')
+        return self.instance
+
+    def start(self):
+        """Load and warm up the models in the background"""
+        threading.Thread(target=self._load_and_warm_up, name=f'{self.name}-warm-up', daemon=True).start()
+
+    def _load_and_warm_up(self):
+        try:
+            with self._lock:
+                if self.instance is not None:
+                    return
+                self._set_state('loading')
+                instance = self._load()
+                self._set_state('warming')
+                self._run_warm_up(instance)
+                self.instance = instance
+                self.loaded_at = time.time()
+                self._set_state('ready')
+        except Exception as e:
+            self._set_state('failed', e)
+
+    def reload(self):
+        """Rolling restart; returns False when a reload is already running"""
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload, name=f'{self.name}-reload', daemon=True).start()
+        return True
+
+    def _reload(self):
         try:
-            # Initialize with smaller batch size to prevent system overload
-            # batch_size=4 means 96//4=24 batches for 'fast' preset (safer for low-end systems)
-            tts = TextToSpeech(autoregressive_batch_size=4)
-            add_debug_log("Models loaded successfully!", "success")
-            add_debug_log(f"Using batch size: 4 (optimized for stability)", "info")
-            add_debug_log(f"CUDA available: {torch.cuda.is_available()}", "info")
-            if torch.cuda.is_available():
-                add_debug_log(f"GPU: {torch.cuda.get_device_name(0)}", "info")
+            self._set_state('reloading')
+            replacement = self._load()
+            self._run_warm_up(replacement)
+            # Waits for the generation that is running on the old instance, if any
+            with tts_lock:
+                retired, self.instance = self.instance, replacement
+            self.loaded_at = time.time()
+            self.reloads += 1
+            self._set_state('ready')
+            aligner = getattr(retired, 'aligner', None)
+            if aligner is not None:
+                aligner.release()
+            del retired
+            release_memory()
         except Exception as e:
-            add_debug_log(f"Failed to load models: {str(e)}", "error")
-            raise
-    return tts
+            # The old instance (if any) keeps serving.
+            self._set_state('ready' if self.instance is not None else 'failed', e)
+        finally:
+            self._reload_lock.release()
+
+    def _run_warm_up(self, instance):
+        start = time.time()
+        with tts_lock:
+            self._warm_up(instance)
+        add_debug_log(f"🔥 {self.name} warmed up in {time.time() - start:.1f}s", "success")
+
+    def _set_state(self, state, error=None):
+        self.state = state
+        self.error = str(error) if error is not None else None
+        if error is not None:
+            add_debug_log(f"{self.name}: {state}: {error}", "error")
+
+    def status(self):
+        return {
+            'state': self.state,
+            'loaded': self.instance is not None,
+            'error': self.error,
+            'loaded_at': self.loaded_at,
+            'reloads': self.reloads,
+        }
+
+
+def load_tts():
+    add_debug_log("Loading Tortoise TTS models...", "info")
+    try:
+        # Initialize with smaller batch size to prevent system overload
+        # batch_size=4 means 96//4=24 batches for 'fast' preset (safer for low-end systems)
+        # The redaction aligner loads on the first bracketed text and is freed again after 10 idle minutes
+        instance = TextToSpeech(autoregressive_batch_size=4, aligner_idle_timeout=600)
+        add_debug_log("Models loaded successfully!", "success")
+        add_debug_log(f"Using batch size: 4 (optimized for stability)", "info")
+        add_debug_log(f"CUDA available: {torch.cuda.is_available()}", "info")
+        if torch.cuda.is_available():
+            add_debug_log(f"GPU: {torch.cuda.get_device_name(0)}", "info")
+    except Exception as e:
+        add_debug_log(f"Failed to load models: {str(e)}", "error")
+        raise
+    return instance
+
+def warm_up_tts(instance):
+    # One autoregressive batch and a few diffusion steps run every model once, with the random voice
+    instance.tts("Warming up.", k=1, verbose=False, num_autoregressive_samples=instance.autoregressive_batch_size,
+                 diffusion_iterations=4, cond_free=False)
+
+def load_fast_tts():
+    add_debug_log("Loading the streaming TTS models...", "info")
+    from tortoise.api_fast import TextToSpeech as FastTextToSpeech
+    instance = FastTextToSpeech()
+    add_debug_log("Streaming models loaded!", "success")
+    return instance
+
+def warm_up_fast_tts(instance):
+    for _ in instance.tts_stream("Warming up.", verbose=False, stream_chunk_size=40):
+        pass
+
+tts_model = WarmModel('Tortoise TTS', load_tts, warm_up_tts)
+# The streaming engine (tortoise.api_fast) is only loaded by the first /api/stream request
+fast_tts_model = WarmModel('Streaming TTS', load_fast_tts, warm_up_fast_tts)
+
+def get_tts():
+    return tts_model.get()
+
+def get_fast_tts():
+    return fast_tts_model.get()
+
+def save_conditioning_latents(voice_name, conds, tts_instance=None):
+    """
+    Compute conditioning latents for a voice from in-memory (1, samples) clips and save them as <voice>.pth.
+    All clips are encoded in one batched pass.
+    """
+    tts_instance = tts_instance or get_tts()
+    voice_dir = os.path.join(app.config['UPLOAD_FOLDER'], voice_name)
+
+    add_debug_log(f"Computing conditioning latents from {len(conds)} samples...", "info")
+    with tts_lock:
+        conditioning_latents = tts_instance.get_conditioning_latents(conds)
+
+    # CRITICAL FIX: Move conditioning latents to CPU before saving
+    # This prevents "cuda:0 and cpu device mismatch" errors during generation
+    if isinstance(conditioning_latents, tuple):
+        conditioning_latents = tuple(c.cpu() if torch.is_tensor(c) else c for c in conditioning_latents)
+    elif torch.is_tensor(conditioning_latents):
+        conditioning_latents = conditioning_latents.cpu()
+
+    output_path = os.path.join(voice_dir, f'{voice_name}.pth')
+    torch.save(conditioning_latents, output_path)
+
+    add_debug_log(f"✅ Saved conditioning latents to {voice_name}.pth", "success")
+    add_debug_log("Voice will now load instantly!", "success")
+
 
 def generate_conditioning_latents(voice_name):
     """
-    Generate conditioning latents (.pth) for a voice.
+    Generate conditioning latents (.pth) for a voice from the audio files in its directory.
     This pre-computes voice embeddings for instant loading.
     
     Returns: True if successful, False otherwise
@@ -116,27 +362,7 @@ def generate_conditioning_latents(voice_name):
             add_debug_log("No valid audio samples loaded", "error")
             return False
         
-        add_debug_log(f"Computing conditioning latents from {len(conds)} samples...", "info")
-        
-        # Generate conditioning latents
-        conditioning_latents = tts_instance.get_conditioning_latents(conds)
-        
-        # CRITICAL FIX: Move conditioning latents to CPU before saving
-        # This prevents "cuda:0 and cpu device mismatch" errors during generation
-        if isinstance(conditioning_latents, tuple):
-            conditioning_latents = tuple(c.cpu() if torch.is_tensor(c) else c for c in conditioning_latents)
-        elif torch.is_tensor(conditioning_latents):
-            conditioning_latents = conditioning_latents.cpu()
-        
-        add_debug_log("Moved conditioning latents to CPU for saving", "info")
-        
-        # Save to voice directory
-        output_path = os.path.join(voice_dir, f'{voice_name}.pth')
-        torch.save(conditioning_latents, output_path)
-        
-        add_debug_log(f"✅ Saved conditioning latents to {voice_name}.pth", "success")
-        add_debug_log("Voice will now load instantly!", "success")
-        
+        save_conditioning_latents(voice_name, conds, tts_instance)
         return True
         
     except Exception as e:
@@ -145,153 +371,188 @@ def generate_conditioning_latents(voice_name):
         add_debug_log(traceback.format_exc(), "error")
         return False
 
-def process_audio_for_cloning(audio_path, output_dir, base_name):
+
+class VoiceJobCancelled(Exception):
+    pass
+
+
+def new_voice_job(voice_name, kind):
+    """Register a voice ingestion job and return its record."""
+    job = {
+        'id': uuid.uuid4().hex,
+        'voice_name': voice_name,
+        'kind': kind,
+        'state': 'queued',
+        'stage': 'Waiting for a free worker...',
+        'progress': 0.0,
+        'segments': 0,
+        'result': None,
+        'error': None,
+        'created': time.time(),
+        'cancel_event': threading.Event(),
+    }
+    with voice_jobs_lock:
+        voice_jobs[job['id']] = job
+        # Forget old finished jobs so the table doesn't grow forever.
+        finished = [j for j in voice_jobs.values() if j['state'] in ('done', 'failed', 'cancelled')]
+        for old in sorted(finished, key=lambda j: j['created'])[:-MAX_FINISHED_VOICE_JOBS]:
+            del voice_jobs[old['id']]
+    return job
+
+
+def voice_job_status(job):
+    """JSON-safe view of a voice job."""
+    return {k: v for k, v in job.items() if k != 'cancel_event'}
+
+
+def process_audio_for_cloning(audio_path, output_dir, base_name, job=None):
     """
-    Process audio file for voice cloning:
-    - Split into 10-second segments
-    - Convert to 22050Hz sample rate
-    - Save as WAV with float32 format
+    Process audio file for voice cloning. The file is streamed through decoding (FFmpeg for WebM and friends),
+    silence trimming, 10-second segmentation and normalization:
+    - Converted to 22050Hz mono
+    - DC offset removed and each segment normalized to [-1, 1]
+    - Segments saved as WAV by a background writer pool
     
-    Returns: list of processed filenames
+    Returns: (list of processed filenames, list of (1, samples) segment tensors)
     """
     add_debug_log(f"Processing audio: {audio_path}", "info")
-    
+    sr = 22050
+    processed_files = []
+    segments = []
+    writes = []
+    segment_stream = iter_voice_segments(audio_path, sampling_rate=sr, segment_seconds=10)
     try:
-        # Check if file is WebM and convert to WAV first
-        if audio_path.lower().endswith('.webm'):
-            add_debug_log("Converting WebM to WAV...", "info")
+        for i, segment in enumerate(segment_stream):
+            if job is not None and job['cancel_event'].is_set():
+                raise VoiceJobCancelled()
+            output_filename = f"{base_name}_{i}.wav"
+            writes.append(segment_writer_pool.submit(torchaudio.save, os.path.join(output_dir, output_filename), segment, sr))
+            processed_files.append(output_filename)
+            segments.append(segment)
+            if job is not None:
+                job['segments'] += 1
+            add_debug_log(f"Segment {i+1}: {segment.shape[-1]/sr:.1f}s", "info")
+    except Exception:
+        for f in writes:
+            f.cancel()
+        for filename in processed_files:
+            path = os.path.join(output_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        segment_stream.close()
+
+    for f in writes:
+        f.result()
+    add_debug_log(f"Successfully processed {len(processed_files)} segments", "success")
+    return processed_files, segments
+
+
+def run_voice_ingestion(job, voice_dir, temp_dir, uploads):
+    """
+    Background worker for a voice ingestion job: segments every upload, then computes the conditioning latents straight
+    from the in-memory segments (no write-then-reread round trip).
+    :param uploads: list of (temp file path, segment base name, display name)
+    """
+    voice_name = job['voice_name']
+    all_processed_files = []
+    all_segments = []
+    try:
+        job['state'] = 'running'
+        add_debug_log("🎙️ Starting audio preprocessing for voice cloning...", "info")
+        add_debug_log("Converting to: 22050Hz, float32 WAV, 10s segments", "info")
+        for idx, (path, base_name, display_name) in enumerate(uploads):
+            if job['cancel_event'].is_set():
+                raise VoiceJobCancelled()
+            job['stage'] = f"Processing {display_name} ({idx + 1}/{len(uploads)})"
+            job['progress'] = 0.8 * idx / len(uploads)
             try:
-                import subprocess
-                # Create temp WAV file
-                temp_wav = audio_path.rsplit('.', 1)[0] + '_temp.wav'
-                
-                # Use ffmpeg to convert WebM to WAV
-                result = subprocess.run(
-                    ['ffmpeg', '-y', '-i', audio_path, '-ar', '22050', '-ac', '1', temp_wav],
-                    capture_output=True,
-                    text=True,
-                    timeout=30
-                )
-                
-                if result.returncode != 0:
-                    add_debug_log(f"FFmpeg error: {result.stderr}", "error")
-                    raise Exception("FFmpeg conversion failed")
-                
-                # Use the converted WAV file
-                audio_path = temp_wav
-                add_debug_log("WebM converted to WAV successfully", "success")
-                
-            except FileNotFoundError:
-                add_debug_log("FFmpeg not found! Installing ffmpeg...", "warning")
-                # Try to install ffmpeg-python
-                subprocess.run([sys.executable, '-m', 'pip', 'install', 'ffmpeg-python'], 
-                             capture_output=True)
-                add_debug_log("Please install FFmpeg: https://ffmpeg.org/download.html", "error")
-                raise Exception("FFmpeg not installed. Please install FFmpeg and add it to PATH.")
-            except subprocess.TimeoutExpired:
-                add_debug_log("WebM conversion timed out", "error")
-                raise Exception("WebM conversion took too long")
-        
-        # Load audio using torchaudio
-        audio, orig_sr = torchaudio.load(audio_path)
-        add_debug_log(f"Loaded audio: {audio.shape} at {orig_sr}Hz", "info")
-        
-        # Convert to mono if stereo
-        if audio.shape[0] > 1:
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            add_debug_log("Converted stereo to mono", "info")
-        
-        # Resample to 22050Hz if needed
-        if orig_sr != 22050:
-            resampler = torchaudio.transforms.Resample(orig_sr, 22050)
-            audio = resampler(audio)
-            add_debug_log(f"Resampled from {orig_sr}Hz to 22050Hz", "info")
-        
-        sr = 22050
-        audio = audio.squeeze(0)  # Remove channel dimension: (1, samples) -> (samples)
-        
-        # Remove DC offset (center audio around zero) - CRITICAL for voice cloning
-        audio = audio - audio.mean()
-        add_debug_log(f"Removed DC offset (mean was {audio.mean():.6f})", "info")
-        
-        # Normalize audio to [-1, 1] range (CRITICAL for Tortoise)
-        max_val = torch.max(torch.abs(audio))
-        if max_val > 0:
-            audio = audio / max_val
-            add_debug_log(f"Normalized audio to [-1, 1] range (max was {max_val:.4f})", "info")
+                processed, segments = process_audio_for_cloning(path, voice_dir, base_name, job)
+                all_processed_files.extend(processed)
+                all_segments.extend(segments)
+            except VoiceJobCancelled:
+                raise
+            except Exception as e:
+                add_debug_log(f"Failed to process {display_name}: {str(e)}", "error")
+
+        if not all_processed_files:
+            raise ValueError(f"No valid {'recordings' if job['kind'] == 'recording' else 'audio files'} could be processed")
+
+        segment_count = len(all_processed_files)
+        if segment_count < 7:
+            add_debug_log(f"⚠️ Warning: Only {segment_count} segments created", "warning")
+            if segment_count < 5:
+                add_debug_log("⚠️ CRITICAL: Less than 5 segments - cloning quality will be poor!", "error")
         else:
-            add_debug_log("⚠️ WARNING: Audio is silent (all zeros)!", "error")
-            raise ValueError("Audio file is silent or corrupted")
-        
-        # Verify audio has both positive and negative values (Tortoise expects this)
-        if not (torch.any(audio > 0) and torch.any(audio < 0)):
-            add_debug_log("⚠️ WARNING: Audio doesn't have both positive and negative values!", "warning")
-            add_debug_log(f"Min: {audio.min():.6f}, Max: {audio.max():.6f}", "warning")
-        
-        # Verify audio quality
-        if torch.any(torch.isnan(audio)) or torch.any(torch.isinf(audio)):
-            add_debug_log("⚠️ WARNING: Audio contains NaN or Inf values!", "error")
-            raise ValueError("Audio file contains invalid values")
-        
-        # Calculate segment length (10 seconds)
-        segment_length = 10 * sr  # 10 seconds * sample_rate
-        total_duration = audio.shape[0] / sr
-        
-        # If audio is shorter than 10 seconds, keep as is
-        if total_duration < 10:
-            add_debug_log(f"Audio is {total_duration:.1f}s - saving as single segment", "warning")
-            output_path = os.path.join(output_dir, f"{base_name}_0.wav")
-            # Save as 16-bit PCM (standard WAV format that Tortoise expects)
-            torchaudio.save(output_path, audio.unsqueeze(0), sr)
-            return [f"{base_name}_0.wav"]
-        
-        # Split into 10-second segments
-        processed_files = []
-        segment_count = int(torch.ceil(torch.tensor(audio.shape[0] / segment_length)).item())
-        
-        add_debug_log(f"Splitting {total_duration:.1f}s audio into {segment_count} segments", "info")
-        
-        for i in range(segment_count):
-            start_idx = i * segment_length
-            end_idx = min((i + 1) * segment_length, audio.shape[0])
-            segment = audio[start_idx:end_idx]
-            
-            # Only save if segment is at least 1 second
-            if segment.shape[0] >= sr:
-                output_filename = f"{base_name}_{i}.wav"
-                output_path = os.path.join(output_dir, output_filename)
-                
-                # Save as 16-bit PCM WAV (standard format that Tortoise expects)
-                # Audio is already normalized to [-1, 1] range above
-                torchaudio.save(output_path, segment.unsqueeze(0), sr)
-                processed_files.append(output_filename)
-                add_debug_log(f"Saved segment {i+1}/{segment_count}: {segment.shape[0]/sr:.1f}s", "info")
-        
-        add_debug_log(f"Successfully processed {len(processed_files)} segments", "success")
-        
-        # Clean up temp WAV file if it was created from WebM
-        if audio_path.endswith('_temp.wav') and os.path.exists(audio_path):
-            try:
-                os.remove(audio_path)
-                add_debug_log("Cleaned up temporary WAV file", "info")
-            except:
-                pass  # Ignore cleanup errors
-        
-        return processed_files
-        
+            add_debug_log(f"✅ Created {segment_count} segments - good for cloning!", "success")
+
+        if job['cancel_event'].is_set():
+            raise VoiceJobCancelled()
+        job['stage'] = 'Computing conditioning latents...'
+        job['progress'] = 0.8
+        add_debug_log("🔄 Automatically generating .pth file...", "info")
+        try:
+            save_conditioning_latents(voice_name, all_segments)
+            pth_success = True
+            pth_message = "Voice ready! .pth file created for instant loading."
+        except Exception as e:
+            add_debug_log(f"Error generating .pth: {str(e)}", "error")
+            pth_success = False
+            pth_message = "Voice segments created. .pth generation failed (see logs)."
+            add_debug_log("💡 You can manually generate .pth later if needed", "warning")
+
+        more = 'record more clips' if job['kind'] == 'recording' else None
+        if segment_count < 5:
+            recommendation = f"Critical: Need at least 5 segments ({more or '50+ seconds'})"
+        elif segment_count < 7:
+            recommendation = f"Warning: Recommended 7+ segments ({more or '70+ seconds'})"
+        else:
+            recommendation = 'Good for cloning!'
+
+        job['result'] = {
+            'success': True,
+            'message': f'Processed {segment_count} audio segments for voice "{voice_name}"',
+            'files': all_processed_files,
+            'segment_count': segment_count,
+            'pth_generated': pth_success,
+            'recommendation': recommendation,
+            'status': pth_message
+        }
+        job['stage'] = 'Done'
+        job['progress'] = 1.0
+        job['state'] = 'done'
+        add_debug_log(f"Voice '{voice_name}' ready for cloning", "success")
+    except VoiceJobCancelled:
+        for filename in all_processed_files:
+            path = os.path.join(voice_dir, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        job['stage'] = 'Cancelled'
+        job['state'] = 'cancelled'
+        add_debug_log(f"Voice ingestion for '{voice_name}' cancelled", "warning")
     except Exception as e:
-        add_debug_log(f"Error processing audio: {str(e)}", "error")
+        job['error'] = str(e)
+        job['stage'] = 'Failed'
+        job['state'] = 'failed'
+        add_debug_log(f"Error processing voice '{voice_name}': {str(e)}", "error")
         import traceback
         add_debug_log(traceback.format_exc(), "error")
-        
-        # Clean up temp WAV file on error too
-        if 'audio_path' in locals() and audio_path.endswith('_temp.wav') and os.path.exists(audio_path):
-            try:
-                os.remove(audio_path)
-            except:
-                pass
-        
-        raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def submit_voice_ingestion(voice_name, voice_dir, temp_dir, uploads, kind):
+    """Queue a voice ingestion job on the worker pool and return the 202 response for it."""
+    job = new_voice_job(voice_name, kind)
+    voice_ingest_pool.submit(run_voice_ingestion, job, voice_dir, temp_dir, uploads)
+    add_debug_log(f"Queued voice ingestion job {job['id'][:8]} for '{voice_name}' ({len(uploads)} files)", "info")
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status_url': f"/api/voice_jobs/{job['id']}",
+        'message': f'Processing {len(uploads)} files for voice "{voice_name}"'
+    }), 202
 
 def get_available_voices():
     """Get list of available voices from the voices directory"""
@@ -313,6 +574,16 @@ def get_available_voices():
     
     return sorted(voices)
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_time(response):
+    if request.endpoint is not None and 'request_started' in g:
+        HTTP_REQUEST_SECONDS.observe(time.monotonic() - g.request_started, endpoint=request.endpoint)
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -334,211 +605,469 @@ def get_next_filename(voice, preset, candidates):
             return filename, str(filepath)
         counter += 1
 
-@app.route('/api/generate', methods=['POST'])
-def api_generate():
-    """Generate speech from text"""
-    global generation_cancelled, current_generation_thread
-    
+GENERATION_PRESET_INFO = {
+    'ultra_fast': ('16 samples', '30 diffusion steps'),
+    'fast': ('96 samples', '80 diffusion steps'),
+    'standard': ('256 samples', '200 diffusion steps'),
+    'high_quality': ('256 samples', '400 diffusion steps')
+}
+
+# Share of a job's progress bar taken by each stage of TextToSpeech.tts(), and its label
+GENERATION_STAGES = {
+    'conditioning': (0.05, 0.08, 'Computing voice latents'),
+    'autoregressive': (0.08, 0.55, 'Sampling speech tokens'),
+    'clvp': (0.55, 0.60, 'Ranking candidates'),
+    'latents': (0.60, 0.62, 'Preparing the best candidates'),
+    'diffusion': (0.62, 0.96, 'Diffusion and vocoder'),
+    'redaction': (0.96, 0.98, 'Redacting'),
+}
+
+
+class GenerationJobCancelled(Exception):
+    pass
+
+
+def new_generation_job(params):
+    """Register a speech generation job and return its record."""
+    job = {
+        'id': uuid.uuid4().hex,
+        'params': params,
+        'state': 'queued',
+        'stage': 'Waiting for a free worker...',
+        'progress': 0.0,
+        'result': None,
+        'error': None,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'eta': None,
+        'timings': None,
+        'cancel_token': CancellationToken(),
+        'done_event': threading.Event(),
+    }
+    with generation_jobs_lock:
+        generation_jobs[job['id']] = job
+        # Forget old finished jobs so the table (and the jobs folder) doesn't grow forever.
+        finished = [j for j in generation_jobs.values() if j['state'] in ('done', 'failed', 'cancelled')]
+        for old in sorted(finished, key=lambda j: j['created'])[:-MAX_FINISHED_GENERATION_JOBS]:
+            del generation_jobs[old['id']]
+            try:
+                os.remove(JOBS_FOLDER / f"{old['id']}.json")
+            except FileNotFoundError:
+                pass
+    save_generation_job(job)
+    return job
+
+
+def generation_job_status(job):
+    """JSON-safe view of a generation job."""
+    status = {k: v for k, v in job.items() if k not in ('cancel_token', 'done_event')}
+    if job['started'] is not None:
+        status['elapsed'] = round((job['finished'] or time.time()) - job['started'], 1)
+    return status
+
+
+def save_generation_job(job):
+    """Persist a job record, so it outlives both the browser tab and the web UI process."""
+    path = JOBS_FOLDER / f"{job['id']}.json"
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(generation_job_status(job), f)
+    os.replace(tmp_path, path)
+
+
+def load_generation_jobs():
+    """Reload the job records of previous runs. Jobs that were still queued or running have been lost with it."""
+    for path in JOBS_FOLDER.glob('*.json'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        job.pop('elapsed', None)
+        job['cancel_token'] = CancellationToken()
+        job['done_event'] = threading.Event()
+        job['done_event'].set()
+        if job['state'] in ('queued', 'running'):
+            job['state'] = 'failed'
+            job['stage'] = 'Failed'
+            job['error'] = 'Interrupted by a restart of the web UI'
+            job['finished'] = job['finished'] or time.time()
+            save_generation_job(job)
+        generation_jobs[job['id']] = job
+
+
+def set_generation_stage(job, stage, progress):
+    if job['cancel_token'].cancelled:
+        raise GenerationJobCancelled()
+    job['stage'] = stage
+    job['progress'] = progress
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}m {seconds % 60}s" if seconds >= 60 else f"{seconds}s"
+
+
+def generation_progress_tracker(job, segments=1):
+    """
+    A progress_callback for tts() that turns its stage and step events into the job's stage, progress and ETA. Long
+    texts are generated in segments; set tracker.segment before each one and the bar moves through them in turn.
+    """
+    job_tag = job['id'][:8]
+    first, last = GENERATION_STAGES['conditioning'][0], GENERATION_STAGES['redaction'][1]
+
+    def on_event(event):
+        if event['stage'] not in GENERATION_STAGES:
+            return
+        low, high, label = GENERATION_STAGES[event['stage']]
+        if segments > 1:
+            # Squeeze the stage ranges into this segment's share of the bar
+            share = (last - first) / segments
+            low, high = (first + share * (tracker.segment + (p - first) / (last - first)) for p in (low, high))
+            label = f"Segment {tracker.segment + 1}/{segments}: {label}"
+        if event['event'] == 'stage_start':
+            job['stage'] = f"{label}..."
+            job['progress'] = low
+            job['eta'] = None
+        elif event['event'] == 'progress':
+            # Stages of unknown length (total None or 0) only report how many steps are done.
+            fraction, eta = tracker.fraction(), tracker.eta()
+            if fraction is not None:
+                job['progress'] = low + (high - low) * fraction
+            if eta is None:
+                job['eta'] = None
+                job['stage'] = f"{label}: {tracker.done}" + (f"/{tracker.total}" if tracker.total else "")
+                return
+            job['eta'] = round(eta, 1)
+            job['stage'] = f"{label}: {tracker.done}/{tracker.total} (~{format_duration(eta)} left)"
+            if event['stage'] == 'autoregressive' and tracker.done == 1:
+                add_debug_log(f"Job {job_tag}: sampling should take another ~{format_duration(eta)}", "info")
+        elif event['event'] == 'stage_end':
+            job['progress'] = high
+            job['eta'] = None
+            add_debug_log(f"Job {job_tag}: {event['stage']} took {event['seconds']:.1f}s", "info")
+
+    tracker = ProgressTracker(on_event)
+    tracker.segment = 0
+    return tracker
+
+
+def run_generation_job(job):
+    """Background worker for a speech generation job."""
+    params = job['params']
+    text, voice, preset, candidates = params['text'], params['voice'], params['preset'], params['candidates']
+    job_tag = job['id'][:8]
     try:
-        generation_cancelled = False
-        data = request.json
-        text = data.get('text', '').strip()
-        voice = data.get('voice', 'random')
-        preset = data.get('preset', 'fast')
-        candidates = int(data.get('candidates', 1))
-        
-        add_debug_log(f"New generation request: voice={voice}, preset={preset}, candidates={candidates}", "info")
-        
-        if not text:
-            add_debug_log("Error: No text provided", "error")
-            return jsonify({'error': 'No text provided'}), 400
-        
+        job['state'] = 'running'
+        job['started'] = time.time()
+        SERVER_QUEUE_SECONDS.observe(job['started'] - job['created'], server='web_ui')
+        if params.get('deadline'):
+            # Past the deadline, generation takes fewer samples and steps instead of running over
+            job['cancel_token'].deadline = time.monotonic() + params['deadline']
+        save_generation_job(job)
+        add_debug_log(f"Job {job_tag}: voice={voice}, preset={preset}, candidates={candidates}", "info")
         add_debug_log(f"Text to generate: {text[:100]}...", "info")
-        
-        # Get TTS instance
-        add_debug_log("Initializing TTS engine...", "info")
+
+        set_generation_stage(job, 'Loading models...', 0.01)
         tts_instance = get_tts()
-        
+
         # Load voice samples (load_voices handles 'random' properly)
+        set_generation_stage(job, 'Loading voice...', 0.03)
         add_debug_log(f"Loading voice samples for: {voice}", "info")
         voice_samples, conditioning_latents = load_voices([voice])
-        
-        add_debug_log(f"Starting speech generation (this may take a while)...", "info")
-        
-        # Check if cancelled before generation
-        if generation_cancelled:
-            add_debug_log("Generation cancelled by user", "warning")
-            return jsonify({'error': 'Generation cancelled'}), 400
-        
-        # Generate speech with timeout protection
+
         # Note: k parameter controls how many final outputs to return (best candidates)
         # num_autoregressive_samples is controlled by the preset
-        add_debug_log("Starting speech generation...", "info")
         add_debug_log(f"Text length: {len(text)} characters", "info")
-        
-        # Show expected parameters based on preset
-        preset_info = {
-            'ultra_fast': ('16 samples', '30 diffusion steps'),
-            'fast': ('96 samples', '80 diffusion steps'),
-            'standard': ('256 samples', '200 diffusion steps'),
-            'high_quality': ('256 samples', '400 diffusion steps')
-        }
-        if preset in preset_info:
-            samples, steps = preset_info[preset]
-            num_batches = int(samples.split()[0])//4
-            estimated_mins = (num_batches * 20) // 60
-            add_debug_log(f"Preset: {preset} → {num_batches} batches (~{estimated_mins}min)", "info")
-            
-            if preset == 'fast' and estimated_mins > 3:
-                add_debug_log("⚠️ TIP: Use 'ultra_fast' for 30sec instead of ~8min", "warning")
-        
-        add_debug_log("🚀 Generation starting... (check terminal for progress bars)", "info")
-        
-        # Progress tracker with stage awareness
-        import time as time_module
-        start_time = time_module.time()
-        progress_running = {'active': True, 'stage': 'starting', 'progress': 0}
-        
-        def progress_updater():
-            last_stage = None
-            while progress_running['active']:
-                time_module.sleep(5)  # Check every 5 seconds
-                if not progress_running['active']:
-                    break
-                    
-                elapsed = int(time_module.time() - start_time)
-                stage = progress_running['stage']
-                
-                # Log stage changes
-                if stage != last_stage:
-                    if stage == 'autoregressive':
-                        add_debug_log(f"🎯 Stage 1/2: Generating autoregressive samples... ({elapsed}s)", "info")
-                    elif stage == 'diffusion':
-                        add_debug_log(f"🎨 Stage 2/2: Diffusion processing... ({elapsed}s)", "info")
-                    last_stage = stage
-                
-                # Periodic updates
-                if elapsed % 15 == 0 and elapsed > 0:
-                    if stage == 'autoregressive':
-                        add_debug_log(f"⏳ Autoregressive: {elapsed}s elapsed...", "info")
-                    elif stage == 'diffusion':
-                        add_debug_log(f"⏳ Diffusion: {elapsed}s elapsed...", "info")
-                    else:
-                        add_debug_log(f"⏳ {elapsed}s elapsed...", "info")
-                
-                # Check if generation was cancelled
-                if generation_cancelled:
-                    progress_running['active'] = False
-                    break
-        
-        progress_thread = threading.Thread(target=progress_updater, daemon=True)
-        progress_thread.start()
-        
-        try:
-            # Check for cancellation before starting
-            if generation_cancelled:
-                progress_running['active'] = False
-                add_debug_log("Generation cancelled before starting", "warning")
-                return jsonify({'error': 'Generation cancelled'}), 400
-            
-            # Stage 1: Autoregressive generation (70% of total time typically)
-            progress_running['stage'] = 'autoregressive'
-            add_debug_log("Starting autoregressive generation...", "info")
-            
-            # Run generation with verbose=True for terminal progress bars
-            gen = tts_instance.tts_with_preset(
-                text, 
-                voice_samples=voice_samples, 
-                conditioning_latents=conditioning_latents,
-                preset=preset,
-                k=candidates,
-                verbose=True  # Shows progress bars in terminal window
-            )
-            
-            # Stage 2: Diffusion is part of tts_with_preset, but we mark it here
-            progress_running['stage'] = 'complete'
-            
-            # Check if cancelled after generation
-            if generation_cancelled:
-                progress_running['active'] = False
-                add_debug_log("Generation cancelled after completion", "warning")
-                return jsonify({'error': 'Generation cancelled'}), 400
-            
-            progress_running['active'] = False
-            elapsed = int(time_module.time() - start_time)
-            add_debug_log(f"✅ Done in {elapsed//60}m {elapsed%60}s!", "success")
-        except KeyboardInterrupt:
-            add_debug_log("Generation interrupted", "warning")
-            raise
-        except RuntimeError as e:
-            if "out of memory" in str(e).lower():
-                add_debug_log("CUDA Out of Memory! Try:", "error")
-                add_debug_log("1. Use 'fast' or 'ultra_fast' preset", "warning")
-                add_debug_log("2. Reduce candidates to 1", "warning")
-                add_debug_log("3. Close other GPU applications", "warning")
-                add_debug_log("4. Restart the service", "warning")
-            raise
-        
-        # Check if cancelled after generation
-        if generation_cancelled:
-            add_debug_log("Generation cancelled by user", "warning")
-            return jsonify({'error': 'Generation cancelled'}), 400
-        
-        add_debug_log("Speech generation completed!", "success")
-        add_debug_log(f"Output tensor shape: {gen.shape}", "info")
-        
-        # Handle different tensor shapes
-        # Shape can be (k, 1, samples) for multiple candidates or (1, samples) for single
-        if len(gen.shape) == 3:
-            # Multiple candidates: (k, 1, samples) - take first (best)
-            gen = gen[0]
-        
+        if preset in GENERATION_PRESET_INFO:
+            samples, steps = GENERATION_PRESET_INFO[preset]
+            add_debug_log(f"Preset: {preset} → {samples}, {steps}", "info")
+
+        # The autoregressive model takes a limited number of text tokens, so long texts are spoken segment by segment
+        segments = list(iter_split_by_token_budget(text, tts_instance.tokenizer))
+        if len(segments) > 1:
+            add_debug_log(f"Text split into {len(segments)} segments", "info")
+        set_generation_stage(job, 'Generating speech...', 0.05)
+        progress = generation_progress_tracker(job, len(segments))
+        digest = voice_digest(voice_samples, conditioning_latents) if phrase_cache is not None else None
+        clips = []
+        for index, segment in enumerate(segments):
+            progress.segment = index
+            cache_key = None
+            gen = None
+            if phrase_cache is not None:
+                cache_key = phrase_cache.key(tts_instance, segment, digest, preset=preset, k=candidates)
+                gen = phrase_cache.get(cache_key)
+                if gen is not None:
+                    add_debug_log("♻️ Served from the phrase cache, no generation needed", "success")
+
+            if gen is None:
+                add_debug_log("🚀 Generation starting...", "info")
+                try:
+                    # Run generation with verbose=True for terminal progress bars
+                    with tts_lock:
+                        gen = tts_instance.tts_with_preset(
+                            segment,
+                            voice_samples=voice_samples,
+                            conditioning_latents=conditioning_latents,
+                            preset=preset,
+                            k=candidates,
+                            verbose=True,  # Shows progress bars in terminal window
+                            cancel_token=job['cancel_token'],  # Stops within one step when the job is cancelled
+                            progress_callback=progress  # Drives the job's stage, progress and ETA
+                        )
+                except RuntimeError as e:
+                    if "out of memory" in str(e).lower():
+                        add_debug_log("CUDA Out of Memory! Try:", "error")
+                        add_debug_log("1. Use 'fast' or 'ultra_fast' preset", "warning")
+                        add_debug_log("2. Reduce candidates to 1", "warning")
+                        add_debug_log("3. Close other GPU applications", "warning")
+                        add_debug_log("4. Restart the service", "warning")
+                    raise
+                if cache_key is not None and not params.get('deadline'):
+                    phrase_cache.put(cache_key, gen)
+
+            # Multiple candidates come as a list of (1, 1, samples) tensors, best first; a single one as (1, samples)
+            if isinstance(gen, (list, tuple)):
+                gen = gen[0]
+            clips.append(gen.reshape(-1).cpu())
+        if progress.stages:
+            job['timings'] = progress.stages
+            add_debug_log(f"⏱️ {progress.summary()}", "info")
+
+        set_generation_stage(job, 'Saving...', 0.98)
         # Ensure we have (channels, samples) shape for torchaudio.save
-        # gen is now either (1, samples) or could be (samples,)
-        if len(gen.shape) == 1:
-            gen = gen.unsqueeze(0)  # Add channel dimension: (samples,) -> (1, samples)
-        
-        add_debug_log(f"Final tensor shape for saving: {gen.shape}", "info")
-        
+        gen = torch.cat(clips).unsqueeze(0)
+        add_debug_log(f"Output tensor shape: {gen.shape}", "info")
+
         # Generate filename and save to Music folder
         filename, filepath = get_next_filename(voice, preset, candidates)
-        add_debug_log(f"Saving audio to: {filename}", "info")
         torchaudio.save(filepath, gen.cpu(), 24000)
         add_debug_log(f"File saved successfully: {filepath}", "success")
-        
-        # Also convert to base64 for immediate playback
-        audio_buffer = io.BytesIO()
-        torchaudio.save(audio_buffer, gen.cpu(), 24000, format='wav')
-        audio_buffer.seek(0)
-        audio_base64 = base64.b64encode(audio_buffer.read()).decode('utf-8')
-        
-        return jsonify({
+
+        job['finished'] = time.time()
+        elapsed = int(job['finished'] - job['started'])
+        add_debug_log(f"✅ Done in {elapsed//60}m {elapsed%60}s!", "success")
+        job['result'] = {
             'success': True,
-            'audio': audio_base64,
             'filename': filename,
             'filepath': filepath,
+            'audio_url': f'/api/audio/{filename}',
             'message': f'Audio generated and saved to {filename}'
-        })
-        
+        }
+        job['stage'] = 'Done'
+        job['progress'] = 1.0
+        job['state'] = 'done'
+    except (GenerationJobCancelled, GenerationCancelled):
+        job['stage'] = 'Cancelled'
+        job['state'] = 'cancelled'
+        add_debug_log(f"Generation job {job_tag} cancelled", "warning")
     except Exception as e:
-        if generation_cancelled:
-            add_debug_log("Generation cancelled by user", "warning")
-            return jsonify({'error': 'Generation cancelled by user'}), 400
-        
-        error_msg = str(e)
-        add_debug_log(f"ERROR generating speech: {error_msg}", "error")
-        
+        job['error'] = str(e)
+        job['stage'] = 'Failed'
+        job['state'] = 'failed'
+        add_debug_log(f"ERROR generating speech: {str(e)}", "error")
         import traceback
-        tb = traceback.format_exc()
-        add_debug_log(f"Traceback:\n{tb}", "error")
-        
-        return jsonify({'error': error_msg}), 500
+        add_debug_log(f"Traceback:\n{traceback.format_exc()}", "error")
     finally:
-        current_generation_thread = None
+        job['finished'] = job['finished'] or time.time()
+        save_generation_job(job)
+        job['done_event'].set()
+
+
+def submit_generation(data):
+    """Validate a generation request and queue it as a job. Returns (job, None) or (None, error response)."""
+    text = data.get('text', '').strip()
+    if not text:
+        add_debug_log("Error: No text provided", "error")
+        SERVER_REQUESTS.inc(server='web_ui', outcome='invalid')
+        return None, (jsonify({'error': 'No text provided'}), 400)
+    params = {
+        'text': text,
+        'voice': data.get('voice', 'random'),
+        'preset': data.get('preset', 'fast'),
+        'candidates': int(data.get('candidates', 1)),
+        'deadline': float(data['deadline']) if data.get('deadline') else None,
+    }
+    job = new_generation_job(params)
+    generation_pool.submit(run_generation_job, job)
+    SERVER_REQUESTS.inc(server='web_ui', outcome='accepted')
+    add_debug_log(f"Queued generation job {job['id'][:8]}", "info")
+    return job, None
+
+
+@app.route('/api/jobs', methods=['POST'])
+def api_jobs_submit():
+    """Queue a speech generation job; poll its status_url, then fetch the audio from its result"""
+    job, error = submit_generation(request.json or {})
+    if error is not None:
+        return error
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status_url': f"/api/jobs/{job['id']}",
+        'events_url': f"/api/jobs/{job['id']}/events",
+    }), 202
+
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs_list():
+    """List known generation jobs, newest first"""
+    with generation_jobs_lock:
+        jobs = sorted(generation_jobs.values(), key=lambda j: j['created'], reverse=True)
+    return jsonify({'jobs': [generation_job_status(job) for job in jobs]})
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    """Get the progress (and, once finished, the result) of a generation job"""
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(generation_job_status(job))
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    """Server-sent events with the job status, sent whenever it changes until the job has finished"""
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def events():
+        last = None
+        while True:
+            status = generation_job_status(job)
+            status.pop('elapsed', None)
+            if status != last:
+                yield f"data: {json.dumps(generation_job_status(job))}\n\n"
+                last = status
+            if job['done_event'].wait(0.5) and last['state'] not in ('queued', 'running'):
+                break
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def api_job_result(job_id):
+    """Redirect to the audio of a finished job (?encoding= is passed on to /api/audio)"""
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['state'] != 'done':
+        return jsonify({'error': f"Job is {job['state']}", 'state': job['state']}), 409
+    return redirect(url_for('api_audio', filename=job['result']['filename'],
+                            encoding=request.args.get('encoding', 'wav')))
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    """Cancel a queued or running generation job"""
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['cancel_token'].cancel()
+    add_debug_log(f"Cancellation requested for generation job {job_id[:8]}", "warning")
+    return jsonify({'success': True, 'message': 'Cancellation requested'})
+
+
+@app.route('/api/generate', methods=['POST'])
+def api_generate():
+    """Generate speech from text, waiting for the result (the job API does the same without holding the request)"""
+    data = request.json or {}
+    job, error = submit_generation(data)
+    if error is not None:
+        return error
+    job['done_event'].wait()
+    if job['state'] == 'cancelled':
+        return jsonify({'error': 'Generation cancelled by user'}), 400
+    if job['state'] != 'done':
+        return jsonify({'error': job['error']}), 500
+    result = job['result']
+    filename, filepath = result['filename'], result['filepath']
+
+    encoding_name = data.get('encoding')
+    if encoding_name:
+        # The audio is fetched as binary from /api/audio, compressed if asked, instead of base64 inside the JSON
+        if encoding_name not in available_encodings():
+            add_debug_log(f"Encoding {encoding_name} unavailable here, sending WAV", "warning")
+            encoding_name = 'wav'
+        return jsonify(dict(result, audio_url=f'/api/audio/{filename}?encoding={encoding_name}'))
+
+    # Also convert to base64 for immediate playback
+    with open(filepath, 'rb') as f:
+        audio_base64 = base64.b64encode(f.read()).decode('utf-8')
+
+    return jsonify({
+        'success': True,
+        'audio': audio_base64,
+        'filename': filename,
+        'filepath': filepath,
+        'message': result['message']
+    })
+
+@app.route('/api/audio/<filename>', methods=['GET'])
+def api_audio(filename):
+    """Stream a generated file, encoded on the fly (?encoding=wav|opus|int16|mulaw|float32)"""
+    encoding_name = request.args.get('encoding', 'wav')
+    if encoding_name not in available_encodings():
+        return jsonify({'error': f'Unsupported encoding: {encoding_name}'}), 400
+    filepath = os.path.join(app.config['OUTPUT_FOLDER'], secure_filename(filename))
+    if not os.path.isfile(filepath):
+        return jsonify({'error': 'File not found'}), 404
+
+    audio, sample_rate = torchaudio.load(filepath)
+    audio = audio.mean(dim=0)
+    settings = {'num_samples': audio.shape[-1]} if encoding_name == 'wav' else {}
+    encoder = make_encoder(encoding_name, sample_rate, **settings)
+    return Response(stream_with_context(encode_chunks(stream_audio_chunks(audio, sample_rate), encoder)),
+                    mimetype=encoder.mime_type)
+
+@app.route('/api/stream', methods=['GET', 'POST'])
+def api_stream():
+    """Speak text with the streaming engine, sending audio (16 bit PCM by default, ?encoding=) as it is produced"""
+    data = request.json if request.is_json else request.args
+    text = data.get('text', '').strip()
+    voice = data.get('voice', 'random')
+    encoding_name = data.get('encoding', 'int16')
+    if not text:
+        return jsonify({'error': 'No text provided'}), 400
+    if encoding_name not in available_encodings():
+        return jsonify({'error': f'Unsupported encoding: {encoding_name}'}), 400
+
+    tts_instance = get_fast_tts()
+    voice_samples, conditioning_latents = load_voices([voice])
+    filename, filepath = get_next_filename(voice, 'stream', 1)
+    encoder = make_encoder(encoding_name, 24000)
+    add_debug_log(f"Streaming request: voice={voice}, {len(text)} characters", "info")
+
+    def audio_chunks():
+        start = time.time()
+        rendered = []
+        # Holding the lock while the client listens keeps batch generations off the GPU in the meantime; a client that
+        # goes away closes this generator, which releases it.
+        with tts_lock:
+            for segment in iter_split_by_token_budget(text, tts_instance.tokenizer):
+                for chunk in tts_instance.tts_stream(segment, voice_samples=voice_samples,
+                                                     conditioning_latents=conditioning_latents,
+                                                     verbose=False, stream_chunk_size=40):
+                    chunk = chunk.detach().cpu().reshape(-1)
+                    if not rendered:
+                        add_debug_log(f"⚡ First audio after {time.time() - start:.1f}s", "success")
+                    rendered.append(chunk)
+                    yield chunk
+        if rendered:
+            torchaudio.save(filepath, torch.cat(rendered).unsqueeze(0), 24000)
+            add_debug_log(f"Streamed audio saved to: {filename}", "success")
+
+    return Response(stream_with_context(encode_chunks(audio_chunks(), encoder)), mimetype=encoder.mime_type,
+                    headers={'X-Tortoise-Filename': filename, 'X-Sample-Rate': '24000', 'Cache-Control': 'no-cache'})
 
 @app.route('/api/upload_voice', methods=['POST'])
 def api_upload_voice():
-    """Upload custom voice samples with automatic preprocessing for cloning"""
+    """Upload custom voice samples. Preprocessing for cloning runs as a background job (see /api/voice_jobs)."""
     try:
         voice_name = request.form.get('voice_name', '').strip()
         
@@ -552,10 +1081,6 @@ def api_upload_voice():
         voice_name = secure_filename(voice_name)
         voice_dir = os.path.join(app.config['UPLOAD_FOLDER'], voice_name)
         
-        # Create directory if it doesn't exist
-        os.makedirs(voice_dir, exist_ok=True)
-        add_debug_log(f"Created voice directory: {voice_dir}", "info")
-        
         # Save uploaded files
         files = request.files.getlist('audio_files')
         
@@ -563,87 +1088,28 @@ def api_upload_voice():
             add_debug_log("Error: No audio files provided", "error")
             return jsonify({'error': 'No audio files provided'}), 400
         
-        # Create temp directory for original uploads
-        temp_dir = os.path.join(voice_dir, '_temp')
-        os.makedirs(temp_dir, exist_ok=True)
+        # Create directory if it doesn't exist
+        os.makedirs(voice_dir, exist_ok=True)
+        add_debug_log(f"Created voice directory: {voice_dir}", "info")
         
-        all_processed_files = []
-        file_counter = 0
-        
-        add_debug_log("🎙️ Starting audio preprocessing for voice cloning...", "info")
-        add_debug_log("Converting to: 22050Hz, float32 WAV, 10s segments", "info")
+        # Uploads are parked in a per-job temp directory until the ingestion worker has consumed them
+        temp_dir = tempfile.mkdtemp(prefix='_temp_', dir=voice_dir)
         
+        uploads = []
         for file in files:
             if file and file.filename:
                 original_filename = secure_filename(file.filename)
                 if original_filename.endswith(('.wav', '.mp3', '.flac', '.ogg', '.m4a')):
-                    # Save to temp location first
                     temp_filepath = os.path.join(temp_dir, original_filename)
                     file.save(temp_filepath)
-                    add_debug_log(f"Processing: {original_filename}", "info")
-                    
-                    try:
-                        # Process audio: split, resample, convert to float32 WAV
-                        base_name = f"clip_{file_counter:02d}"
-                        processed = process_audio_for_cloning(temp_filepath, voice_dir, base_name)
-                        all_processed_files.extend(processed)
-                        file_counter += 1
-                    except Exception as e:
-                        add_debug_log(f"Failed to process {original_filename}: {str(e)}", "error")
-                        continue
-        
-        # Clean up temp directory
-        import shutil
-        shutil.rmtree(temp_dir)
+                    uploads.append((temp_filepath, f"clip_{len(uploads):02d}", original_filename))
         
-        if not all_processed_files:
+        if not uploads:
+            shutil.rmtree(temp_dir, ignore_errors=True)
             add_debug_log("Error: No valid audio files could be processed", "error")
             return jsonify({'error': 'No valid audio files could be processed'}), 400
         
-        segment_count = len(all_processed_files)
-        
-        # Check if we have at least 7 segments (recommended minimum)
-        if segment_count < 7:
-            add_debug_log(f"⚠️ Warning: Only {segment_count} segments created", "warning")
-            add_debug_log("Recommendation: Provide more audio (at least 70 seconds total)", "warning")
-            if segment_count < 5:
-                add_debug_log("⚠️ CRITICAL: Less than 5 segments - cloning quality will be poor!", "error")
-        else:
-            add_debug_log(f"✅ Created {segment_count} segments - good for cloning!", "success")
-        
-        add_debug_log(f"Voice '{voice_name}' ready for cloning", "success")
-        
-        # Automatically generate .pth file for instant loading
-        add_debug_log("", "info")  # Blank line for readability
-        add_debug_log("🔄 Automatically generating .pth file...", "info")
-        add_debug_log("💡 NOTE: If voice quality is poor, delete the .pth file and try without it", "warning")
-        add_debug_log("   Tortoise will load audio files directly (slower but may work better)", "warning")
-        
-        pth_success = generate_conditioning_latents(voice_name)
-        
-        if pth_success:
-            pth_message = "Voice ready! .pth file created for instant loading."
-        else:
-            pth_message = "Voice segments created. .pth generation failed (see logs)."
-            add_debug_log("💡 You can manually generate .pth later if needed", "warning")
-        
-        # Determine recommendation message
-        if segment_count < 5:
-            recommendation = 'Critical: Need at least 5 segments (50+ seconds)'
-        elif segment_count < 7:
-            recommendation = 'Warning: Recommended 7+ segments (70+ seconds)'
-        else:
-            recommendation = 'Good for cloning!'
-        
-        return jsonify({
-            'success': True,
-            'message': f'Processed {segment_count} audio segments for voice "{voice_name}"',
-            'files': all_processed_files,
-            'segment_count': segment_count,
-            'pth_generated': pth_success,
-            'recommendation': recommendation,
-            'status': pth_message
-        })
+        return submit_voice_ingestion(voice_name, voice_dir, temp_dir, uploads, 'upload')
         
     except Exception as e:
         error_msg = str(e)
@@ -655,6 +1121,24 @@ def api_upload_voice():
         
         return jsonify({'error': error_msg}), 500
 
+@app.route('/api/voice_jobs/<job_id>', methods=['GET'])
+def api_voice_job(job_id):
+    """Get the progress (and, once finished, the result) of a voice ingestion job"""
+    job = voice_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(voice_job_status(job))
+
+@app.route('/api/voice_jobs/<job_id>/cancel', methods=['POST'])
+def api_voice_job_cancel(job_id):
+    """Cancel a queued or running voice ingestion job"""
+    job = voice_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['cancel_event'].set()
+    add_debug_log(f"Cancellation requested for voice job {job_id[:8]}", "warning")
+    return jsonify({'success': True, 'message': 'Cancellation requested'})
+
 @app.route('/api/delete_voice/<voice_name>', methods=['DELETE'])
 def api_delete_voice(voice_name):
     """Delete a custom voice"""
@@ -708,7 +1192,7 @@ def api_get_recording_paragraph():
 
 @app.route('/api/recording/upload', methods=['POST'])
 def api_recording_upload():
-    """Upload recorded audio clips"""
+    """Upload recorded audio clips. Processing runs as a background job (see /api/voice_jobs)."""
     try:
         voice_name = request.form.get('voice_name', '').strip()
         
@@ -718,11 +1202,6 @@ def api_recording_upload():
         # Sanitize voice name
         voice_name = secure_filename(voice_name)
         voice_dir = os.path.join(app.config['UPLOAD_FOLDER'], voice_name)
-        os.makedirs(voice_dir, exist_ok=True)
-        
-        # Create temp directory
-        temp_dir = os.path.join(voice_dir, '_temp')
-        os.makedirs(temp_dir, exist_ok=True)
         
         # Get all recorded audio blobs
         recorded_files = request.files.getlist('recordings')
@@ -730,73 +1209,23 @@ def api_recording_upload():
         if not recorded_files:
             return jsonify({'error': 'No recordings provided'}), 400
         
-        add_debug_log(f"🎙️ Processing {len(recorded_files)} recorded clips for voice '{voice_name}'...", "info")
-        add_debug_log("Converting to: 22050Hz, float32 WAV, 10s segments", "info")
+        os.makedirs(voice_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='_temp_', dir=voice_dir)
         
-        all_processed_files = []
+        add_debug_log(f"🎙️ Received {len(recorded_files)} recorded clips for voice '{voice_name}'...", "info")
         
+        uploads = []
         for idx, audio_file in enumerate(recorded_files):
             if audio_file and audio_file.filename:
-                # Save recording to temp
                 temp_filepath = os.path.join(temp_dir, f'recording_{idx}.webm')
                 audio_file.save(temp_filepath)
-                
-                try:
-                    # Process the recording
-                    base_name = f"rec_{idx:02d}"
-                    processed = process_audio_for_cloning(temp_filepath, voice_dir, base_name)
-                    all_processed_files.extend(processed)
-                    add_debug_log(f"Processed recording {idx + 1}/{len(recorded_files)}", "info")
-                except Exception as e:
-                    add_debug_log(f"Failed to process recording {idx + 1}: {str(e)}", "error")
-                    continue
+                uploads.append((temp_filepath, f"rec_{idx:02d}", f"recording {idx + 1}"))
         
-        # Clean up temp directory
-        import shutil
-        shutil.rmtree(temp_dir)
-        
-        if not all_processed_files:
+        if not uploads:
+            shutil.rmtree(temp_dir, ignore_errors=True)
             return jsonify({'error': 'No valid recordings could be processed'}), 400
         
-        segment_count = len(all_processed_files)
-        
-        # Check segment count
-        if segment_count < 7:
-            add_debug_log(f"⚠️ Warning: Only {segment_count} segments from recordings", "warning")
-            add_debug_log("Recommendation: Record more clips (at least 7 total)", "warning")
-            if segment_count < 5:
-                add_debug_log("⚠️ CRITICAL: Less than 5 segments - cloning quality will be poor!", "error")
-        else:
-            add_debug_log(f"✅ Created {segment_count} segments from recordings - good for cloning!", "success")
-        
-        # Automatically generate .pth file
-        add_debug_log("", "info")
-        add_debug_log("🔄 Automatically generating .pth file...", "info")
-        
-        pth_success = generate_conditioning_latents(voice_name)
-        
-        if pth_success:
-            pth_message = "Voice ready! .pth file created for instant loading."
-        else:
-            pth_message = "Voice segments created. .pth generation failed (see logs)."
-        
-        # Determine recommendation
-        if segment_count < 5:
-            recommendation = 'Critical: Need at least 5 segments (record more clips)'
-        elif segment_count < 7:
-            recommendation = 'Warning: Recommended 7+ segments (record more clips)'
-        else:
-            recommendation = 'Good for cloning!'
-        
-        return jsonify({
-            'success': True,
-            'message': f'Processed {segment_count} segments from {len(recorded_files)} recordings',
-            'files': all_processed_files,
-            'segment_count': segment_count,
-            'pth_generated': pth_success,
-            'recommendation': recommendation,
-            'status': pth_message
-        })
+        return submit_voice_ingestion(voice_name, voice_dir, temp_dir, uploads, 'recording')
         
     except Exception as e:
         add_debug_log(f"Error processing recordings: {str(e)}", "error")
@@ -804,24 +1233,33 @@ def api_recording_upload():
         add_debug_log(traceback.format_exc(), "error")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    """Hit/miss counters of the phrase cache"""
+    if phrase_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **phrase_cache.stats()})
+
 @app.route('/api/cancel', methods=['POST'])
 def api_cancel():
-    """Cancel ongoing generation"""
-    global generation_cancelled
-    generation_cancelled = True
+    """Cancel every queued or running generation job"""
+    with generation_jobs_lock:
+        for job in generation_jobs.values():
+            if job['state'] in ('queued', 'running'):
+                job['cancel_token'].cancel()
     add_debug_log("Generation cancellation requested by user", "warning")
     return jsonify({'success': True, 'message': 'Generation cancellation requested'})
 
 @app.route('/api/debug/logs', methods=['GET'])
 def api_get_debug_logs():
-    """Get debug logs"""
-    return jsonify({'logs': debug_logs})
+    """Get debug logs; ?since=<seq> returns only newer entries, ?level=warning only warnings and errors"""
+    logs, last_seq = debug_log.since(request.args.get('since', 0, type=int), request.args.get('level'))
+    return jsonify({'logs': logs, 'last_seq': last_seq})
 
 @app.route('/api/debug/clear', methods=['POST'])
 def api_clear_debug_logs():
     """Clear debug logs"""
-    global debug_logs
-    debug_logs = []
+    debug_log.clear()
     add_debug_log("Debug logs cleared", "info")
     return jsonify({'success': True, 'message': 'Logs cleared'})
 
@@ -850,7 +1288,8 @@ def api_service_status():
     
     # Get system resources
     try:
-        cpu_percent = psutil.cpu_percent(interval=0.1)
+        # Usage since the previous call, instead of holding the request for a sampling interval
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory = psutil.virtual_memory()
         memory_percent = memory.percent
         memory_available_gb = memory.available / (1024**3)
@@ -874,6 +1313,8 @@ def api_service_status():
     
     return jsonify({
         'running': True,
+        'ready': tts_model.instance is not None,
+        'models': {'tts': tts_model.status(), 'stream': fast_tts_model.status()},
         'output_folder': str(MUSIC_FOLDER),
         'system': {
             'cpu_percent': cpu_percent,
@@ -883,6 +1324,11 @@ def api_service_status():
         }
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: generation latency, time to first chunk, real-time factor, stage times, caches and queues"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @app.route('/api/service/stop', methods=['POST'])
 def api_service_stop():
     """Stop the service"""
@@ -893,29 +1339,51 @@ def api_service_stop():
     threading.Thread(target=shutdown).start()
     return jsonify({'success': True, 'message': 'Service stopping...'})
 
+@app.route('/api/service/ready', methods=['GET'])
+def api_service_ready():
+    """Readiness check: 200 once the models are loaded and warmed up, 503 before"""
+    status = {'ready': tts_model.instance is not None, 'models': tts_model.status()}
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/api/service/restart', methods=['POST'])
 def api_service_restart():
-    """Restart the service"""
-    def restart():
-        time.sleep(1)
-        python = sys.executable
-        os.execl(python, python, *sys.argv)
-    
-    threading.Thread(target=restart).start()
-    return jsonify({'success': True, 'message': 'Service restarting...'})
+    """
+    Rolling restart: reload the loaded models behind the current ones, which keep serving until the new ones are warm.
+    ?mode=process re-executes the whole web UI instead (needed to pick up code changes; drops the loaded models).
+    """
+    if request.args.get('mode') == 'process':
+        def restart():
+            time.sleep(1)
+            python = sys.executable
+            os.execl(python, python, *sys.argv)
+
+        threading.Thread(target=restart).start()
+        return jsonify({'success': True, 'message': 'Service restarting...'})
+
+    reloading = [model.name for model in (tts_model, fast_tts_model) if model.instance is not None and model.reload()]
+    if tts_model.instance is None and tts_model.state not in ('loading', 'warming'):
+        tts_model.start()
+        reloading.append(tts_model.name)
+    add_debug_log(f"🔄 Rolling restart: reloading {', '.join(reloading) or 'nothing'}", "info")
+    return jsonify({'success': True, 'reloading': reloading,
+                    'message': 'Reloading models; generation continues on the current ones meanwhile'})
 
 if __name__ == '__main__':
     # Create necessary directories
     os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
     
+    load_generation_jobs()
     add_debug_log("Starting Tortoise TTS Web UI...", "info")
     add_debug_log(f"Output folder: {MUSIC_FOLDER}", "info")
     add_debug_log("Server starting on http://localhost:5000", "info")
-    add_debug_log("Note: First generation will take time as models load", "info")
+    if WARMUP_AT_STARTUP:
+        add_debug_log("Loading and warming up the models in the background...", "info")
+        tts_model.start()
+    else:
+        add_debug_log("Note: First generation will take time as models load", "info")
     
     print("Starting Tortoise TTS Web UI...")
     print("Open http://localhost:5000 in your browser")
     print(f"Output folder: {MUSIC_FOLDER}")
-    print("\nNote: First generation will take time as models load...")
     
     app.run(host='0.0.0.0', port=5000, debug=False)